@@ -1,6 +1,11 @@
 from .sched import SS_Scheduler
+from .executor import RunExecutor
+from .leases import LeaseRegistry
 
 ss_sched = SS_Scheduler()
+ss_sched.register_metrics()
+ss_executor = RunExecutor()
+ss_leases = LeaseRegistry()
 
 
 from .main_db import get_ss_db_object
@@ -1,21 +1,282 @@
 import random
 import hashlib
+import time
+import threading
+from contextlib import contextmanager
+from functools import partial
 
 import sqlite3
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
 
 
 
+# row classes and column names cached per cursor description. queries are constants (see queries.py), so these stay small
+_ROW_CLASSES = {}
+_ROW_FIELDS = {}
+_LAST_ROW_CLASS = (None, None) # (description, class) - skips the dict lookup for consecutive rows of one cursor
+
+
+def _row_fields(description):
+    fields = _ROW_FIELDS.get(description)
+    if fields is None:
+        fields = _ROW_FIELDS[description] = tuple(col[0] for col in description)
+    return fields
+
+
+def _row_class(description):
+    cls = _ROW_CLASSES.get(description)
+    if cls is None:
+        cls = _ROW_CLASSES[description] = namedtuple("Row", _row_fields(description))
+    return cls
+
+
 def namedtuple_factory(cursor, row):
-    fields = [col[0] for col in cursor.description]
-    Row = namedtuple("Row", fields)
-    return Row(*row)
+    global _LAST_ROW_CLASS
+    description = cursor.description
+    last_description, cls = _LAST_ROW_CLASS
+    if description is not last_description:
+        cls = _row_class(description)
+        _LAST_ROW_CLASS = (description, cls)
+    return cls._make(row)
+
+
+def dict_factory(cursor, row):
+    '''rows as plain dicts - ready to be json serialized without an extra _asdict() copy'''
+    return dict(zip(_row_fields(cursor.description), row))
+
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+
+class StatementCacheStats:
+    '''
+    statements executed, and an ESTIMATE of the hits and misses of sqlite's per-connection prepared statement cache
+    - sqlite3 doesn't expose its cache, so each connection mirrors it with an LRU of sql strings of the same size.
+      the real cache can differ (statements it won't cache, ones still in use by a cursor), so the est_* counts are
+      a guide to whether the cache is big enough, not a measurement
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, seen, sql):
+        if sql in seen:
+            seen.move_to_end(sql)
+            self.hits += 1
+            return
+        self.misses += 1
+        seen[sql] = None
+        if len(seen) > self.size:
+            seen.popitem(last=False)
+
+    def to_dict(self):
+        total = self.hits + self.misses
+        return {
+            'size': self.size,
+            'statements': total,
+            'est_hits': self.hits,
+            'est_misses': self.misses,
+            'est_hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+
+
+class _PooledConnection(sqlite3.Connection):
+    '''sqlite3 connection that remembers pool bookkeeping'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+        self.funcs_applied = set()
+        self.seen_statements = OrderedDict()
+        self.stmt_stats = None
+        self.deferred = {} # deferred function -> arguments collected in the current transaction
+
+    def track_statement(self, sql):
+        if self.stmt_stats is not None:
+            self.stmt_stats.record(self.seen_statements, sql)
+
+    def defer(self, func, arg):
+        '''body of a deferred sql function - see DB.add_deferred_function'''
+        args = self.deferred.get(func)
+        if args is None:
+            args = self.deferred[func] = []
+        args.append(arg)
+
+    def take_deferred(self):
+        deferred, self.deferred = self.deferred, {}
+        return deferred
+
+
+
+class ConnectionPool:
+    '''
+    thread-aware pool of long lived sqlite connections to a single database file
+    - pragmas and custom functions are applied once, when a connection is opened
+    - nested checkouts from the same thread reuse the connection that thread already holds
+    - idle connections are health checked before they are handed out again
+    '''
+
+    def __init__(self, db_path, size=8, timeout=30, ping_after=60, statement_cache_size=128, custom_funcs=None, deferred_funcs=None):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout # seconds to wait for a free connection
+        self.ping_after = ping_after # idle seconds after which a connection is health checked
+        self.stmt_stats = StatementCacheStats(statement_cache_size)
+        self._custom_funcs = custom_funcs if custom_funcs is not None else set()
+        self._deferred_funcs = deferred_funcs if deferred_funcs is not None else set()
+
+        self._idle = deque()
+        self._n_open = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._closed = False
+
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.stmt_stats.size,
+            factory=_PooledConnection
+        )
+        conn.stmt_stats = self.stmt_stats
+        conn.row_factory = namedtuple_factory
+        conn.execute('''PRAGMA foreign_keys=ON;''')
+        conn.execute('''PRAGMA journal_mode=WAL;''')
+        return conn
+
+
+    def _is_healthy(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if time.monotonic() - conn.last_used < self.ping_after:
+            return True
+        try:
+            conn.execute('''SELECT 1''').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._n_open -= 1
+            self._cond.notify()
+
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolExhaustedError("connection pool is closed")
+                if self._idle:
+                    conn = self._idle.pop()
+                elif self._n_open < self.size:
+                    self._n_open += 1
+                    conn = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(f"no free database connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except:
+                    with self._cond:
+                        self._n_open -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            # custom functions registered after this connection was opened
+            for func in self._custom_funcs - conn.funcs_applied:
+                conn.create_function(*func)
+                conn.funcs_applied.add(func)
+            for name, func in self._deferred_funcs - conn.funcs_applied:
+                conn.create_function(name, 1, partial(conn.defer, func))
+                conn.funcs_applied.add((name, func))
+            return conn
+
+
+    def _checkin(self, conn):
+        conn.last_used = time.monotonic()
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._n_open -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+
+    @contextmanager
+    def connection(self):
+        '''
+        context manager yielding a connection
+        - commits on success and rolls back on error when the outermost block exits
+        - deferred functions called by the transaction run after it commits, and not at all if it rolls back
+        '''
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None: # this thread already holds a connection
+            yield conn
+            return
+
+        conn = self._checkout()
+        local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.deferred.clear()
+            conn.rollback()
+            raise
+        finally:
+            local.conn = None
+            deferred = conn.take_deferred()
+            self._checkin(conn)
+        # called once per function with everything the transaction collected, after the connection is back in the pool
+        for func, args in deferred.items():
+            try:
+                func(args)
+            except Exception as e:
+                print("deferred-function-error:", str(e))
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._n_open -= 1
 
 
 
 class DB:
 
     CUSTOM_FUNCS = set()
+    DEFERRED_FUNCS = set()
+    POOL_SIZE = 8
+    STATEMENT_CACHE_SIZE = 128
+
+    _POOLS = {}
+    _POOLS_LOCK = threading.Lock()
 
     def __init__(self, db_path) -> None:
         self.db_path = db_path
@@ -33,24 +294,77 @@ class DB:
         cls.CUSTOM_FUNCS.add((name, nparams, func))
 
 
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = namedtuple_factory
-        for func in self.CUSTOM_FUNCS:
-            conn.create_function(*func)
-        return conn
+    @classmethod
+    def add_deferred_function(cls, name, func):
+        '''
+        sql function name(x) that only collects x
+        - func(list of x) is called once after the transaction that called name() commits, never if it rolls back
+        - for side effects of triggers that fire once per row, like cascading deletes
+        '''
+        cls.DEFERRED_FUNCS.add((name, func))
 
 
-    def execute(self, sql, conn=None, fetch_one=False, fetch_n=None):
-        created_conn = False
+    @classmethod
+    def _new_pool(cls, db_path, size=None, statement_cache_size=None, **kwargs):
+        return ConnectionPool(
+            db_path,
+            size=size or cls.POOL_SIZE,
+            statement_cache_size=statement_cache_size or cls.STATEMENT_CACHE_SIZE,
+            custom_funcs=cls.CUSTOM_FUNCS,
+            deferred_funcs=cls.DEFERRED_FUNCS,
+            **kwargs
+        )
+
+
+    @classmethod
+    def init_pool(cls, db_path, size=None, statement_cache_size=None, **kwargs):
+        '''create (or replace) the connection pool shared by every DB object using db_path'''
+        pool = cls._new_pool(db_path, size=size, statement_cache_size=statement_cache_size, **kwargs)
+        with cls._POOLS_LOCK:
+            old = cls._POOLS.get(db_path)
+            cls._POOLS[db_path] = pool
+        if old is not None:
+            old.close()
+        return pool
+
+
+    @property
+    def pool(self):
+        p = self._POOLS.get(self.db_path)
+        if p is None:
+            with self._POOLS_LOCK:
+                p = self._POOLS.get(self.db_path)
+                if p is None:
+                    p = self._POOLS[self.db_path] = self._new_pool(self.db_path)
+        return p
+
+
+    def connection(self):
+        '''context manager yielding a pooled connection. see ConnectionPool.connection'''
+        return self.pool.connection()
+
+
+    def statement_cache_stats(self):
+        '''returns the statements executed and the estimated prepared statement cache hits (est_*) for this database. see StatementCacheStats'''
+        return self.pool.stmt_stats.to_dict()
+
+
+    def execute(self, sql, params=None, conn=None, fetch_one=False, fetch_n=None, row_factory=namedtuple_factory):
+        '''
+        run a single statement with bound parameters
+        - sql should be a constant (see queries.py) and values passed in params, never formatted into sql
+        - row_factory can be namedtuple_factory (default), dict_factory, sqlite3.Row or None for plain tuples
+        '''
         if conn is None:
-            conn = self.get_connection()
-            created_conn = True
+            with self.connection() as conn:
+                return self.execute(sql, params, conn=conn, fetch_one=fetch_one, fetch_n=fetch_n, row_factory=row_factory)
+
         try:
             cur = conn.cursor()
-            cur.execute('''PRAGMA foreign_keys=ON;''')
-            cur.execute('''PRAGMA journal_mode=WAL;''')
-            cur.execute(sql)
+            cur.row_factory = row_factory
+            if hasattr(conn, 'track_statement'):
+                conn.track_statement(sql)
+            cur.execute(sql, params or ())
             if fetch_one is True:
                 res = cur.fetchone()
             elif isinstance(fetch_n, int):
@@ -62,10 +376,21 @@ class DB:
         except:
             print(sql)
             raise
-        finally:
-            if created_conn:
-                conn.commit()
-                conn.close()
 
 
+    def executemany(self, sql, seq_of_params, conn=None):
+        '''run one statement for every set of bound parameters in seq_of_params (single transaction)'''
+        if conn is None:
+            with self.connection() as conn:
+                return self.executemany(sql, seq_of_params, conn=conn)
 
+        try:
+            if hasattr(conn, 'track_statement'):
+                conn.track_statement(sql)
+            cur = conn.executemany(sql, seq_of_params)
+            rowcount = cur.rowcount
+            cur.close()
+            return rowcount
+        except:
+            print(sql)
+            raise
@@ -0,0 +1,61 @@
+'''
+index of the top-level callables of a project's .py files
+
+each file is parsed with ast once per (mtime, size) and its module level functions are
+stored in inventory.db (callable_files / callables), so listing or validating entry points
+is a lookup that only re-parses the files changed since the last one.
+
+plain, async and decorated functions are all indexed, with their signatures. an entry
+point is called without arguments, so only functions whose parameters all have defaults
+(required == 0) can be one.
+'''
+import ast
+import os
+
+
+def _signature(args):
+    '''ast.arguments -> "(a, b=1, *args, c, **kw)", and how many of them have no default'''
+    sig = ast.unparse(args)
+    positional = args.posonlyargs + args.args
+    required = len(positional) - len(args.defaults)
+    required += sum(1 for d in args.kw_defaults if d is None)
+    return f'({sig})', required
+
+
+def scan(src, filename='<unknown>'):
+    '''
+    the module level functions of src, in source order - dicts with keys:
+        name:str, kind:'def'|'async def', lineno:int, signature:str, required:int, decorators:str
+    - raises SyntaxError if src doesn't parse
+    '''
+    tree = ast.parse(src, filename=filename)
+    found = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        signature, required = _signature(node.args)
+        found.append({
+            'name': node.name,
+            'kind': 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def',
+            'lineno': node.lineno,
+            'signature': signature,
+            'required': required,
+            'decorators': ', '.join('@' + ast.unparse(d) for d in node.decorator_list),
+        })
+    return found
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def scan_file(path):
+    '''(callables, error) of a file. error is a "line n: msg" str if it doesn't parse'''
+    with open(path, 'rb') as f:
+        src = f.read()
+    try:
+        return scan(src, filename=path), None
+    except (SyntaxError, ValueError) as e: # ValueError: null bytes
+        lineno = getattr(e, 'lineno', None)
+        return [], f"line {lineno}: {e.msg}" if lineno else str(e)
@@ -1,5 +1,5 @@
 '''
-code derived from stdio_proxy package - https://github.com/bonprosoft/stdio_proxy
+thread-local stdout capture - based on the redirect approach of stdio_proxy - https://github.com/bonprosoft/stdio_proxy
 
 MIT License
 
@@ -24,93 +24,72 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import _pyio
+import codecs
 import threading
+import time
 import sys
 
 
 
-class _ThreadSafeTextIOWrapperProxy(_pyio.TextIOWrapper):  # type: ignore
-    def __init__(self, *args, **kwargs):  # type: ignore
-        self._local_objects = threading.local()
-        super().__init__(*args, **kwargs)
+class _ThreadSafeStdoutProxy:
+    '''
+    stands in for sys.stdout while any capture is active
+    - writes from a thread with a registered capture go to that capture (innermost one if nested)
+    - writes from every other thread go to the original stdout, untouched
+    '''
+    def __init__(self, target):
+        self._target = target
+        self._local = threading.local()
 
-    def register(self, new_buffer, no_close=True):
-        # type: (BinaryIO, bool) -> None
-        self._local_objects.buffer = new_buffer
-        self._local_objects.no_close = no_close
-        self._local_objects.registered = True
+    def _captures(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
 
-    def unregister(self):
-        # type: () -> None
-        self._local_objects.buffer = None
-        self._local_objects.registered = False
+    def register(self, capture):
+        self._captures().append(capture)
 
-    @property
-    def _registered(self):
-        # type: () -> bool
-        return getattr(self._local_objects, "registered", False)
+    def unregister(self, capture):
+        self._captures().remove(capture)
+
+    def _current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
 
     @property
     def buffer(self):
-        # type: () -> BinaryIO
-        if not self._registered:
-            return self._buffer
-
-        buf = self._local_objects.buffer
-        assert buf is not None
-        return buf
-
-    def close(self):
-        # type: () -> None
-        if self._registered and self._local_objects.no_close:
-            self.buffer.flush()
-        else:
-            super().buffer.flush()
+        capture = self._current()
+        return capture if capture is not None else self._target.buffer
 
     def write(self, s):
-        # type: (str) -> None
-        return super().write(s)
+        stack = getattr(self._local, 'stack', None) # inlined _current(), this is the hot path
+        if not stack:
+            return self._target.write(s)
+        stack[-1].write(s.encode('utf-8', 'surrogateescape'))
+        return len(s)
 
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
 
-def _create_proxy(target):
-    # type: (TextIO) -> ThreadSafeTextIOWrapperProxy
-    return _ThreadSafeTextIOWrapperProxy(
-        target.buffer,
-        target.encoding,
-        getattr(target, "errors", "strict"),
-        getattr(target, "newlines", None),
-        getattr(target, "line_buffering", True),
-    )
-
-
-
-class _redirect_stdout(object):
-    """Context manager for temporarily redirecting stdout to an object.
+    def flush(self):
+        if self._current() is None:
+            self._target.flush()
 
-    Note:
-        For Python 3 environments, ``dst_obj`` is supposed to handle ``bytes``, not ``str``.
-        For Python 2 environments, ``str``, not ``unicode``.
-        The easiest way to prepare ``dst_obj`` for both environments is to use an ``io.BytesIO`` object.
+    def __getattr__(self, name):
+        return getattr(self._target, name)
 
-        For Python 3 environments, the interface of ``dst_obj`` should be compatible with that of ``io.BufferedWriter``.
-        For instance, if you use `sys.stdin.readline`, ``dst_obj`` must have ``write`` method, ``flush`` method, and ``closed`` property.
-        Note that the argument of ``write`` method is ``bytes``, not ``str``.
 
-        For Python 2 environments, the interface of ``dst_obj`` should be compatible with that of the Python file object.
-
-    Examples:
-        >>> buf = io.BytesIO()
-        >>> with redirect_stdout(buf):
-        ...     sys.stdout.write("Foo\n")
-        >>> print("Redirected: {}".format(buf.getvalue()))
-        Redirected: b'Foo\n'
-
-    """
 
+class _redirect_stdout(object):
+    '''
+    context manager that routes the current thread's stdout to new_obj
+    - sys.stdout is swapped for the proxy on first use and restored when the last capture exits
+    '''
     _lock = threading.Lock()
-    _original = None  # type: Dict[str, SysIO]
-    _proxy = None  # type: Dict[str, ProxyIO]
+    _original = None
+    _proxy = None
     _n_use = 0
 
     def __init__(self, new_obj):
@@ -119,45 +98,116 @@ class _redirect_stdout(object):
     def __enter__(self):
         with _redirect_stdout._lock:
             if _redirect_stdout._n_use == 0:
-                if _redirect_stdout._original is None:
-                    _redirect_stdout._original = getattr(sys, 'stdout')
-                    _redirect_stdout._proxy = _create_proxy(_redirect_stdout._original)
-
-                setattr(sys, 'stdout', _redirect_stdout._proxy)
+                _redirect_stdout._original = sys.stdout
+                _redirect_stdout._proxy = _ThreadSafeStdoutProxy(_redirect_stdout._original)
+                sys.stdout = _redirect_stdout._proxy
 
             _redirect_stdout._n_use += 1
-            _redirect_stdout._proxy.register(self._new_obj)
+            proxy = _redirect_stdout._proxy
+        proxy.register(self._new_obj)
+        self._new_obj.start()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        _redirect_stdout._proxy.unregister()
+        self._new_obj.stop()
         with _redirect_stdout._lock:
+            _redirect_stdout._proxy.unregister(self._new_obj)
             _redirect_stdout._n_use -= 1
 
             if _redirect_stdout._n_use == 0:
-                setattr(sys, 'stdout', _redirect_stdout._original)
+                sys.stdout = _redirect_stdout._original
 
 
 '''
 implementing print statement capture using the above thread safe stdout proxy
 '''
-# from stdio_proxy import redirect_stdout
 
-class _PrintCapture(_pyio.BytesIO):
-    '''File-like object that will be the destination of capture'''
-    def __init__(self, callback):
-        self._buf = b''
+class _PrintCapture:
+    '''
+    destination of a capture - collects bytes and hands them to callback in batches
+    - complete lines are held until BATCH_BYTES have built up
+    - a partial line (no newline yet) is flushed once it reaches MAX_LINE_BYTES
+    - a timer thread flushes whatever is left, partial line included, once nothing was emitted for FLUSH_INTERVAL
+    - callback gets str chunks that may hold many lines. it's never called concurrently
+
+    the buffer is a bytearray - appending and dropping the consumed front are both amortized O(1),
+    so output is handled in linear time however long the lines get
+    '''
+    BATCH_BYTES = 64 * 1024
+    MAX_LINE_BYTES = 64 * 1024
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, callback, batch_bytes=None, max_line_bytes=None, flush_interval=None):
         self._write_cb = callback
+        self.batch_bytes = batch_bytes or self.BATCH_BYTES
+        self.max_line_bytes = max_line_bytes or self.MAX_LINE_BYTES
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self._check_size = min(self.batch_bytes, self.max_line_bytes) # nothing to do below this
+        self._buf = bytearray()
+        self._lines_end = 0 # end of the last complete line in _buf
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore') # keeps multi-byte chars split across flushes intact
+        self._lock = threading.RLock() # callback may print
+        self._last_emit = time.monotonic()
+        self._stopped = threading.Event()
+        self._timer = None
+
+    @property
+    def closed(self):
+        return self._stopped.is_set()
+
+    def writable(self):
+        return True
 
     def write(self, b):
-        self._buf += b
-        if b.endswith(b'\n'):
-            line = self._buf.decode(errors='ignore')
-            self._write_cb(line)
-            self._buf = b''
+        if not isinstance(b, (bytes, bytearray)): # ex: memoryview written to sys.stdout.buffer
+            b = bytes(b)
+        with self._lock:
+            i = b.rfind(b'\n')
+            if i >= 0:
+                self._lines_end = len(self._buf) + i + 1
+            self._buf += b
+            if len(self._buf) >= self._check_size:
+                end = self._lines_end if len(self._buf) >= self.batch_bytes else 0
+                if len(self._buf) - self._lines_end >= self.max_line_bytes: # long partial line
+                    end = len(self._buf)
+                if end:
+                    self._emit(end)
+        return len(b)
+
+    def flush(self):
+        pass # batching is driven by size and time, see the class docstring
+
+    def _emit(self, end):
+        chunk = self._buf[:end]
+        del self._buf[:end]
+        self._lines_end = max(0, self._lines_end - end)
+        self._last_emit = time.monotonic()
+        text = self._decoder.decode(chunk)
+        if text:
+            self._write_cb(text)
+
+    def _flush_all(self):
+        with self._lock:
+            if self._buf:
+                self._emit(len(self._buf))
+
+    def _timer_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            if time.monotonic() - self._last_emit >= self.flush_interval:
+                self._flush_all()
+
+    def start(self):
+        self._timer = threading.Thread(target=self._timer_loop, daemon=True)
+        self._timer.start()
+
+    def stop(self):
+        '''flush what is left. the timer wakes on _stopped and exits on its own, it isn't joined - the lock orders its last flush before this one'''
+        self._stopped.set()
+        self._flush_all()
 
     def capture(self):
         return _redirect_stdout(self)
 
 
-def print_capture(callback):
-    return _PrintCapture(callback).capture()
+def print_capture(callback, **kwargs):
+    '''capture print statements of the current thread. see _PrintCapture for kwargs'''
+    return _PrintCapture(callback, **kwargs).capture()
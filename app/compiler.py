@@ -0,0 +1,74 @@
+'''
+byte-compilation of project sources
+
+saved .py files are compiled to <dir>/__pycache__/<name>.cpython-XY.pyc on a small thread
+pool, with the same timestamp check the import system uses - so a run's first import after
+an edit loads the .pyc instead of compiling, and a syntax error is reported at save time.
+
+a file is compiled by one thread at a time, so a slow compile of an older save can't
+finish last and leave a .pyc that doesn't match the source (it would be ignored by the
+import system anyway, as its recorded mtime and size wouldn't match). a path's lock is
+only kept while a compile of it is running or waiting.
+'''
+import os
+import fnmatch
+import py_compile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+MAX_WORKERS = 2
+DIAGNOSTIC_WAIT = 0.5 # seconds a save waits for its diagnostics before returning without them
+
+_POOL = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='ss-compile')
+_LOCKS = {} # path -> [lock held while it compiles, compiles running or waiting]
+_LOCKS_LOCK = threading.Lock()
+
+
+
+def _diagnostic(e, rel_path):
+    '''py_compile error -> {'path', 'line', 'col', 'type', 'msg'}'''
+    exc = e.exc_value
+    if isinstance(exc, SyntaxError):
+        return {'path': rel_path, 'line': exc.lineno, 'col': exc.offset, 'type': e.exc_type_name, 'msg': exc.msg}
+    return {'path': rel_path, 'line': None, 'col': None, 'type': e.exc_type_name, 'msg': str(exc)}
+
+
+def compile_file(path, rel_path=None):
+    '''compile one file. returns a diagnostic dict if it doesn't compile, else None'''
+    with _LOCKS_LOCK:
+        entry = _LOCKS.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            py_compile.compile(path, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.TIMESTAMP)
+    except py_compile.PyCompileError as e:
+        return _diagnostic(e, rel_path or path)
+    except OSError: # deleted or renamed since
+        return None
+    finally:
+        with _LOCKS_LOCK:
+            entry[1] -= 1
+            if not entry[1]:
+                del _LOCKS[path]
+    return None
+
+
+def submit(path, rel_path=None):
+    '''compile path on the pool - a Future of compile_file's result'''
+    return _POOL.submit(compile_file, path, rel_path)
+
+
+def diagnostics(futures, timeout=None):
+    '''diagnostics of the compiles done within timeout seconds, and whether they all were'''
+    done, pending = wait(futures, timeout=timeout)
+    return [d for d in (f.result() for f in futures if f in done) if d is not None], not pending
+
+
+def sources(src_path, ignores=()):
+    '''paths of the .py files under src_path, skipping names that match ignores'''
+    for root, dirs, files in os.walk(src_path):
+        dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pat) for pat in ignores)]
+        for name in files:
+            if name.endswith('.py') and not any(fnmatch.fnmatch(name, pat) for pat in ignores):
+                yield os.path.join(root, name)
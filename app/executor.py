@@ -0,0 +1,391 @@
+'''
+pool of warm worker processes that execute project runs (see worker.py)
+
+each run is handed to an idle worker over a pipe and its stdout is streamed back
+to the caller. runs on different workers are truly parallel and can't race on
+the server's cwd, sys.path or sys.modules.
+
+the pool size is the global concurrency limit. runs that find every worker busy
+wait in a fair queue: a free worker goes to the waiting run with the highest
+priority among users below their own limit (USER_LIMIT). between equal priorities,
+the user with the fewest running jobs goes first, then whoever was served longest
+ago - so one user's burst at the top of the hour can't starve everyone else.
+
+a run can be given a timeout and a cancel event. a run that is stopped gets a
+KeyboardInterrupt in its worker, so its finally blocks run and the warm worker is kept;
+if it hasn't ended STOP_GRACE seconds later the worker is killed and replaced. either
+way the run's worker is back in the pool and submit() raises RunStopped.
+
+warm runs (task['warm']) keep their project's modules loaded in the worker between runs.
+a waiting warm run is given, when there is a choice, an idle worker that already holds
+its project - the queue order above is not changed by it, only which idle worker is picked.
+'''
+import os, sys
+import signal
+import subprocess
+import threading
+import time
+import itertools
+import heapq
+import atexit
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_SCRIPT = os.path.join(APP_ROOT, 'app', 'worker.py') # run as a script - `-m app.worker` would run app/__init__ and create the server singletons in every worker
+WARM_PROJECTS = 4 # projects a worker keeps warm - worker._WarmCache.MAX_PROJECTS
+
+
+
+class WorkerDied(Exception):
+    pass
+
+
+
+class _PipeError(Exception):
+    '''the pipe to a worker closed, or carried something that isn't a message - the worker can't be used any more'''
+    pass
+
+
+
+class RunStopped(Exception):
+    '''a run was cancelled or ran out of time. reason is cancelled or timeout'''
+
+    def __init__(self, reason, msg=None, usage=None):
+        super().__init__(msg or f"run stopped: {reason}")
+        self.reason = reason
+        self.usage = usage # what it used, if it ended on its own
+
+
+
+class WorkerProcess:
+    '''parent side handle of a single worker process'''
+    STOP_GRACE = 5 # seconds a stopped run gets to unwind before its worker is killed
+    POLL = 0.5 # how often a run with a timeout or cancel event is checked on
+
+    def __init__(self):
+        child_recv, parent_send = os.pipe()
+        parent_recv, child_send = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, WORKER_SCRIPT, str(child_recv), str(child_send)],
+                pass_fds=(child_recv, child_send),
+                stdin=subprocess.DEVNULL,
+                cwd=APP_ROOT,
+            )
+        except:
+            for fd in (parent_send, parent_recv):
+                os.close(fd)
+            raise
+        finally:
+            os.close(child_recv)
+            os.close(child_send)
+
+        self._send = Connection(parent_send, readable=False)
+        self._recv = Connection(parent_recv, writable=False)
+        self.warm = OrderedDict() # src_paths of the projects whose modules the worker holds, least recently run first - see worker._WarmCache
+        self.busy = False # a task was sent and its 'done' hasn't been read yet - the pipe isn't in sync for another run
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def held_warm(self, src_path):
+        '''note that a warm run of src_path ended on this worker - it evicts its least recently run project, like the worker does'''
+        self.warm[src_path] = True
+        self.warm.move_to_end(src_path)
+        while len(self.warm) > WARM_PROJECTS:
+            self.warm.popitem(last=False)
+
+    def run(self, task, msg_cb, timeout=None, cancel=None):
+        '''
+        blocking - send task to the worker and stream its output to msg_cb
+        - returns the worker's result dict
+        - raises WorkerDied if the process exits before the run completes, or breaks the protocol (a message that
+          doesn't unpickle, isn't one of worker.py's) - either way the worker is killed
+        - raises RunStopped once timeout seconds have passed or cancel (a threading.Event) is set
+        - msg_cb(data) may return False if it can't take data yet (ex: a reader holds the output back). it should
+          wait a little (about POLL) before it does - data is offered again after timeout and cancel were checked
+        '''
+        watched = bool(timeout) or cancel is not None
+        deadline = time.monotonic() + timeout if timeout else None
+        stopping = kill_at = None
+        held = None # output msg_cb didn't take yet
+        try:
+            self.busy = True
+            self._write(task)
+            while True:
+                if watched:
+                    if stopping is None:
+                        if cancel is not None and cancel.is_set():
+                            stopping = 'cancelled'
+                        elif deadline is not None and time.monotonic() >= deadline:
+                            stopping = 'timeout'
+                        if stopping is not None:
+                            self.interrupt()
+                            kill_at = time.monotonic() + self.STOP_GRACE
+                    elif time.monotonic() >= kill_at:
+                        self.kill()
+                        raise RunStopped(stopping)
+                if held is not None:
+                    if msg_cb(held) is False:
+                        continue
+                    held = None
+                if watched and not self._poll(self.POLL):
+                    continue
+                kind, payload = self._read()
+                if kind == 'out':
+                    if msg_cb(payload) is False:
+                        held = payload
+                elif kind == 'done':
+                    self.busy = False
+                    if stopping is not None:
+                        raise RunStopped(stopping, usage=payload.get('usage'))
+                    return payload
+        except _PipeError as e:
+            self.kill() # wait for it, so it isn't taken for alive and handed out again
+            if stopping is not None: # ex: interrupted before it was ready to take the signal
+                raise RunStopped(stopping) from e
+            raise WorkerDied(f"worker process {self.pid} {e}") from e
+
+    def _write(self, task):
+        try:
+            self._send.send(task)
+        except (EOFError, OSError) as e:
+            raise _PipeError("exited unexpectedly") from e
+
+    def _poll(self, timeout):
+        try:
+            return self._recv.poll(timeout)
+        except (EOFError, OSError) as e:
+            raise _PipeError("exited unexpectedly") from e
+
+    def _read(self):
+        '''next (kind, payload) from the worker'''
+        try:
+            kind, payload = self._recv.recv()
+        except (EOFError, OSError) as e:
+            raise _PipeError("exited unexpectedly") from e
+        except Exception as e: # ex: a message cut short - UnpicklingError
+            raise _PipeError("sent a broken message") from e
+        if kind not in ('out', 'done'):
+            raise _PipeError(f"sent an unknown message {kind!r}")
+        return kind, payload
+
+    def interrupt(self):
+        '''raise KeyboardInterrupt in the run the worker is executing (see worker.py)'''
+        if self.is_alive():
+            self.proc.send_signal(signal.SIGINT)
+
+    def kill(self):
+        if self.is_alive():
+            self.proc.kill()
+        self.proc.wait()
+        self.close()
+
+    def close(self):
+        self._send.close()
+        self._recv.close()
+
+
+
+class _Ticket:
+    '''a submit() waiting for a worker'''
+    __slots__ = ('user', 'priority', 'seq', 'warm', 'granted', 'worker')
+
+    def __init__(self, user, priority, seq, warm=None):
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.warm = warm # src_path of a warm run - prefers a worker that holds it
+        self.granted = threading.Event()
+        self.worker = None # set when granted. None means: start a new worker
+
+
+
+class RunExecutor:
+    '''
+    bounded pool of pre-started worker processes
+    - submit() waits in the fair queue until it is given a worker, then runs the task on it
+    - workers that die are replaced on the next submit
+    '''
+    USER_LIMIT = None # max runs of one user at a time. None for no limit
+    TIMEOUT = None # seconds a run may take on its worker, if not given one. None for no limit
+    TRACE_ALLOC = False # have workers trace the allocations of every run - slows runs down
+
+    def __init__(self, size=None, user_limit=None, timeout=None, trace_alloc=None):
+        self.size = size or os.cpu_count() or 2
+        self.user_limit = user_limit or self.USER_LIMIT
+        self.timeout = timeout or self.TIMEOUT
+        self.trace_alloc = trace_alloc if trace_alloc is not None else self.TRACE_ALLOC
+        self._idle = []
+        self._n_workers = 0
+        self._cond = threading.Condition()
+        self._waiting = {} # user -> heap of (-priority, seq, ticket)
+        self._running = {} # user -> runs holding a worker
+        self._last_served = {} # user -> when they were last given a worker, for round robin
+        self._seq = itertools.count()
+        atexit.register(self.shutdown)
+
+
+    def start(self, size=None, user_limit=None, timeout=None, trace_alloc=None):
+        '''pre-start workers so the first runs don't pay for interpreter startup'''
+        with self._cond:
+            if trace_alloc is not None:
+                self.trace_alloc = trace_alloc
+            if size:
+                self.size = size
+            if user_limit:
+                self.user_limit = user_limit
+            if timeout:
+                self.timeout = timeout
+            while self._n_workers < self.size:
+                self._idle.append(WorkerProcess())
+                self._n_workers += 1
+
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # fair queue
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    def _free_worker(self, warm=None):
+        '''an idle live worker - one that holds the project warm if any -, None to start a new one, or False if the pool is busy. caller holds the lock'''
+        if warm is not None:
+            for i in range(len(self._idle) - 1, -1, -1):
+                w = self._idle[i]
+                if warm in w.warm and w.is_alive():
+                    del self._idle[i]
+                    return w
+        while self._idle:
+            w = self._idle.pop()
+            if w.is_alive():
+                return w
+            w.close()
+            self._n_workers -= 1
+        if self._n_workers < self.size:
+            self._n_workers += 1
+            return None
+        return False
+
+
+    def _next_user(self):
+        '''user whose waiting run goes next - (True, user), or (False, None) if none can go. caller holds the lock'''
+        best = best_key = None
+        for user, heap in self._waiting.items():
+            running = self._running.get(user, 0)
+            if self.user_limit and running >= self.user_limit:
+                continue
+            neg_priority, seq, _ = heap[0]
+            key = (neg_priority, running, self._last_served.get(user, -1), seq)
+            if best_key is None or key < best_key:
+                best, best_key = user, key
+        return best_key is not None, best
+
+
+    def _grant(self):
+        '''hand free workers to waiting runs. caller holds the lock'''
+        while self._waiting:
+            found, user = self._next_user()
+            if not found: # user None is a valid user - runs submitted without one
+                return
+            heap = self._waiting[user]
+            worker = self._free_worker(heap[0][2].warm)
+            if worker is False:
+                return
+            _, _, ticket = heapq.heappop(heap)
+            if not heap:
+                del self._waiting[user]
+            self._running[user] = self._running.get(user, 0) + 1
+            self._last_served[user] = next(self._seq)
+            ticket.worker = worker
+            ticket.granted.set()
+
+
+    def _acquire(self, user=None, priority=0, cancel=None, warm=None):
+        with self._cond:
+            ticket = _Ticket(user, priority, next(self._seq), warm)
+            entry = (-priority, ticket.seq, ticket)
+            heapq.heappush(self._waiting.setdefault(user, []), entry)
+            self._grant()
+        while not ticket.granted.wait(WorkerProcess.POLL if cancel is not None else None):
+            if cancel.is_set():
+                with self._cond:
+                    if not ticket.granted.is_set(): # else it was just given a worker - the run stops right away instead
+                        heap = self._waiting[user]
+                        heap.remove(entry)
+                        heapq.heapify(heap)
+                        if not heap:
+                            del self._waiting[user]
+                        raise RunStopped('cancelled')
+        if ticket.worker is not None:
+            return ticket.worker
+        try:
+            return WorkerProcess()
+        except:
+            self._release(None, user)
+            raise
+
+
+    def _release(self, worker, user=None):
+        with self._cond:
+            if worker is not None and worker.is_alive():
+                self._idle.append(worker)
+            else:
+                self._n_workers -= 1
+            n = self._running.get(user, 0) - 1
+            if n > 0:
+                self._running[user] = n
+            else:
+                self._running.pop(user, None)
+            self._grant()
+
+
+    def queue_stats(self):
+        '''{'waiting': runs waiting for a worker, 'running': runs on a worker}'''
+        with self._cond:
+            return {
+                'waiting': sum(len(h) for h in self._waiting.values()),
+                'running': sum(self._running.values()),
+            }
+
+
+    def submit(self, task, msg_cb, on_start=None, user=None, priority=0, timeout=None, cancel=None):
+        '''
+        run task on a worker (blocking). see WorkerProcess.run
+        - user and priority place the run in the fair queue. higher priority goes first
+        - on_start is called once a worker has been assigned, i.e. when the run leaves the queue
+        - timeout (seconds on the worker) and cancel (threading.Event, also honoured in the queue) stop the run - raises RunStopped
+        '''
+        if self.trace_alloc:
+            task = dict(task, trace_alloc=True)
+        warm = task['src_path'] if task.get('warm') else None
+        worker = self._acquire(user, priority, cancel, warm)
+        try:
+            if on_start is not None:
+                on_start()
+            res = worker.run(task, msg_cb, timeout=timeout or self.timeout, cancel=cancel)
+            if warm is not None:
+                worker.held_warm(warm)
+            return res
+        except BaseException as e:
+            # a worker is only reused once its run ended cleanly - else the rest of that run's
+            # messages are still in the pipe and would be read by the next run
+            if worker.busy or not isinstance(e, RunStopped):
+                worker.kill()
+            elif warm is not None:
+                worker.held_warm(warm)
+            raise
+        finally:
+            self._release(worker, user)
+
+
+    def shutdown(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._n_workers -= len(idle)
+        for w in idle:
+            w.kill()
@@ -0,0 +1,120 @@
+'''
+schedule leases - one run of a schedule at a time, across every process sharing inventory.db
+
+a lease is a row in schedule_leases. taking it is a single upsert that only succeeds if
+there is no row or the holder's lease has expired, so two processes can't both get it.
+leases are renewed by one heartbeat thread per process while their runs go on; a process
+that dies stops renewing and its leases expire after TTL seconds.
+
+a firing that finds the lease taken is, depending on the schedule's overlap policy:
+    skip   - dropped
+    queue  - marked pending on the lease row. the holder runs it when it finishes, under the
+             same lease. firings while one is already pending are coalesced into it. if the holder
+             dies, the pending mark stays on the row and whoever takes the expired lease over runs
+             it after its own firing
+    allow  - no lease, runs alongside
+'''
+import os
+import socket
+import threading
+import time
+import uuid
+
+from . import queries
+
+
+OVERLAP_POLICIES = ('skip', 'queue', 'allow')
+
+# outcomes of LeaseRegistry.acquire
+LEASED = 'leased'
+QUEUED = 'queued'
+SKIPPED = 'skipped'
+COALESCED = 'coalesced'
+
+
+
+class LeaseRegistry:
+    '''
+    leases held by this process, by sched_id
+    - acquire() / release() take the DB object to run their queries on (any DB of inventory.db)
+    '''
+    TTL = 60
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or self.TTL
+        self.owner_prefix = f'{socket.gethostname()}:{os.getpid()}:'
+        self._held = {} # sched_id -> owner token of its lease
+        self._lock = threading.Lock()
+        self._db = None
+        self._thread = None
+
+
+    def acquire(self, db, sched_id, queue=False):
+        '''take the lease of a schedule. returns LEASED, or what became of the firing: QUEUED, COALESCED or SKIPPED'''
+        owner = self.owner_prefix + uuid.uuid4().hex
+        now = time.time()
+        with db.connection() as conn: # one transaction - the row can't be released between the two statements
+            db.execute(queries.ACQUIRE_LEASE, {'sched_id': sched_id, 'owner': owner, 'now': now, 'expires_ts': now + self.ttl}, conn=conn)
+            if db.execute(queries.CHANGES, conn=conn, fetch_one=True).n:
+                with self._lock:
+                    self._held[sched_id] = owner
+                    self._db = db
+                self._ensure_thread()
+                return LEASED
+            if not queue:
+                return SKIPPED
+            db.execute(queries.QUEUE_ON_LEASE, {'sched_id': sched_id}, conn=conn)
+            return QUEUED if db.execute(queries.CHANGES, conn=conn, fetch_one=True).n else COALESCED
+
+
+    def release(self, db, sched_id, take_queued=False):
+        '''
+        give up the lease of a schedule
+        - with take_queued, a pending firing keeps the lease instead and True is returned - the caller runs it
+        '''
+        with self._lock:
+            owner = self._held.get(sched_id)
+        if owner is None:
+            return False
+        params = {'sched_id': sched_id, 'owner': owner, 'expires_ts': time.time() + self.ttl}
+        with db.connection() as conn:
+            if take_queued:
+                db.execute(queries.TAKE_QUEUED_ON_LEASE, params, conn=conn)
+                if db.execute(queries.CHANGES, conn=conn, fetch_one=True).n:
+                    return True
+            db.execute(queries.RELEASE_LEASE, params, conn=conn)
+        with self._lock:
+            self._held.pop(sched_id, None)
+        return False
+
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # heartbeat
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._renew_loop, name='ss-leases', daemon=True)
+                self._thread.start()
+
+
+    def _renew_loop(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception as e:
+                print("lease-renew-error:", str(e))
+
+
+    def renew(self):
+        '''push back the expiry of every lease held - one transaction'''
+        with self._lock:
+            held, db = list(self._held.items()), self._db
+        if not held:
+            return 0
+        expires_ts = time.time() + self.ttl
+        return db.executemany(queries.RENEW_LEASE, [
+            {'sched_id': sched_id, 'owner': owner, 'expires_ts': expires_ts} for sched_id, owner in held
+        ])
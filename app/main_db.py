@@ -3,114 +3,68 @@ from datetime import datetime as dt
 
 from .base import DB
 from .user import User, LoginError
+from . import queries, migrations
 
 from . import ss_sched
 
 
 __SS_DB_SINGLETON = None
 
-def get_ss_db_object(workspace_path):
+def get_ss_db_object(workspace_path, pool_size=None, statement_cache_size=None):
     global __SS_DB_SINGLETON
     if __SS_DB_SINGLETON is None:
-        __SS_DB_SINGLETON = SelfSchedulerDB(workspace_path)
+        __SS_DB_SINGLETON = SelfSchedulerDB(workspace_path, pool_size=pool_size, statement_cache_size=statement_cache_size)
     return __SS_DB_SINGLETON
 
 
-# adding a custom function that will be triggered from SQL
-DB.add_custom_function('sched_delete_job', 1, ss_sched.delete_job)
+# called by the sched_delete trigger for every deleted schedule row. cascading deletes hand the scheduler one batch, after commit
+DB.add_deferred_function('sched_delete_job', ss_sched.delete_jobs)
 
 
 class SelfSchedulerDB(DB):
 
-    def __init__(self, workspace_path) -> None:
+    def __init__(self, workspace_path, pool_size=None, statement_cache_size=None) -> None:
         if not os.path.isdir(workspace_path):
             os.makedirs(workspace_path)
         db_path = os.path.join(workspace_path, "inventory.db")
         super().__init__(db_path)
+        self.init_pool(db_path, size=pool_size, statement_cache_size=statement_cache_size) # shared by User and Project objects too
         self.workspace_path = workspace_path
-        self._create_tables()
+        self._migrate()
         self._reload_jobs()
 
 
-    def _create_tables(self):
-        conn = self.get_connection()
-        cur = conn.cursor()
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                first_name TEXT NOT NULL,
-                last_name TEXT DEFAULT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                salt TEXT NOT NULL,
-                is_admin INTEGER DEFAULT 0,
-                create_dt TEXT NOT NULL
-            )
-        ''')
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS projects (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                name_hash TEXT NOT NULL,
-                descr TEXT,
-                create_dt TEXT NOT NULL,
-                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-            )
-        ''')
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS entry_points (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                project_id INTEGER NOT NULL,
-                file TEXT NOT NULL,
-                func TEXT NOT NULL,
-                is_default INTEGER DEFAULT 0,
-                create_dt TEXT NOT NULL,
-                UNIQUE(project_id, file, func),
-                FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
-            )
-        ''')
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS schedule (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ep_id INTEGER NOT NULL,
-                every TEXT DEFAULT NULL,
-                at TEXT DEFAULT NULL,
-                tzname TEXT DEFAULT NULL,
-                is_scheduled INTEGER DEFAULT 0,
-                last_run_dt TEXT DEFAULT NULL,
-                last_run_res TEXT DEFAULT NULL,
-                create_dt TEXT NOT NULL,
-                UNIQUE(ep_id, every, at, tzname),
-                FOREIGN KEY(ep_id) REFERENCES entry_points(id) ON DELETE CASCADE
-            )
-        ''')
-
-        cur.execute('''
-            CREATE TRIGGER IF NOT EXISTS sched_delete
-            AFTER DELETE ON schedule
-            BEGIN
-                SELECT sched_delete_job(OLD.id);
-            END;
-        ''')
-
-        conn.commit()
-        conn.close()
+    def _migrate(self):
+        with self.connection() as conn:
+            migrations.migrate(conn)
 
 
     def _reload_jobs(self):
-        res = self.execute('''SELECT DISTINCT email FROM users''')
-        for r in res:
-            if r.email is None:
-                continue
-            u = self.get_user(r.email)
-            u.logged_in = True # Force logged in just for this function
-            for p in u.get_all_projects():
-                p.reload_schedules()
+        '''register every schedule with one query, enabled if is_scheduled is set. users and projects are only loaded when a job fires'''
+        res = self.execute(queries.ALL_SCHEDULE_JOBS)
+        offsets, new = ss_sched.assign_offsets(res)
+        if new:
+            self.executemany(queries.SET_SCHEDULE_OFFSET, new)
+        ss_sched.add_jobs([dict(
+            sched_id=r.id,
+            every=r.every,
+            at=r.at,
+            tz=r.tzname,
+            func=self._schedule_runner(r.email, r.name_hash, r.ep_id, r.id),
+            enabled=bool(r.is_scheduled),
+            offset=offsets.get(r.id, 0),
+        ) for r in res])
+
+
+    def _schedule_runner(self, email, name_hash, epid, sched_id):
+        # a one line lambda - the scheduler reads the source of every job function, and a short one is cheap to read
+        return lambda: self._run_schedule(email, name_hash, epid, sched_id)
+
+
+    def _run_schedule(self, email, name_hash, epid, sched_id):
+        u = self.get_user(email)
+        u.logged_in = True # Force logged in just for this function
+        u.get_project(name_hash).blocking_run(epid, sched_id=sched_id)
 
 
     def get_user(self, email):
@@ -124,23 +78,20 @@ class SelfSchedulerDB(DB):
         if not User.email_format_ok(email):
             raise Exception("Invalid email")
 
-        res = self.execute(f'''SELECT email FROM users WHERE email = '{email}' ''', fetch_one=True)
+        res = self.execute(queries.USER_EMAIL_EXISTS, {'email': email}, fetch_one=True)
         if res is not None:
             raise Exception("User already exists")
 
         salt = self.create_salt()
         passhash = self.hash_password(password=password, salt=salt)
-        self.execute(f'''
-            INSERT INTO users (
-                first_name, last_name, email,
-                password, salt, create_dt
-            )
-            VALUES (
-                '{first_name}', '{last_name}', '{email}',
-                '{passhash}', '{salt}',
-                '{dt.now().strftime('%Y-%m-%d %H:%M:%S')}'
-            );
-        ''')
+        self.execute(queries.INSERT_USER, {
+            'first_name': first_name,
+            'last_name': last_name,
+            'email': email,
+            'password': passhash,
+            'salt': salt,
+            'create_dt': dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+        })
 
         return self.get_user(email)
 
@@ -0,0 +1,125 @@
+'''
+in-process metrics in the prometheus text format
+
+histograms keep a fixed list of bucket counts per label set, so observe() is a bisect
+and two additions under a lock. render() writes every registered metric for the
+/metrics endpoint - https://prometheus.io/docs/instrumenting/exposition_formats/
+'''
+import bisect
+import threading
+
+
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+_REGISTRY = []
+
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _num(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+
+class Histogram:
+    '''
+    - observe(value, *labelvalues) adds one observation to the series of those label values
+    - remove(*labelvalues) forgets a series, e.g. when the job it describes is deleted
+    '''
+
+    def __init__(self, name, descr, buckets=LAG_BUCKETS, labelnames=()):
+        self.name = name
+        self.descr = descr
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {} # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labelvalues)
+            if s is None:
+                s = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+
+    def remove(self, *labelvalues):
+        with self._lock:
+            self._series.pop(labelvalues, None)
+
+
+    def render(self):
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        out = [f'# HELP {self.name} {self.descr}', f'# TYPE {self.name} histogram']
+        for labelvalues, s in series:
+            total = 0
+            for le, n in zip(self.buckets + (float('inf'),), s):
+                total += n
+                le = 'le="' + _num(le) + '"'
+                out.append(f'{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {total}')
+            out.append(f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {_num(s[-1])}')
+            out.append(f'{self.name}_count{_labels(self.labelnames, labelvalues)} {total}')
+        return out
+
+
+
+class Gauge:
+    '''
+    a value per label set, set() by the code it describes
+    - or, with fn, a single value read when metrics are rendered
+    '''
+
+    def __init__(self, name, descr, labelnames=(), fn=None):
+        self.name = name
+        self.descr = descr
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        _REGISTRY.append(self)
+
+
+    def set(self, value, *labelvalues):
+        self._values[labelvalues] = value
+
+
+    def remove(self, *labelvalues):
+        self._values.pop(labelvalues, None)
+
+
+    def render(self):
+        out = [f'# HELP {self.name} {self.descr}', f'# TYPE {self.name} gauge']
+        if self.fn is not None:
+            value = self.fn()
+            if value is not None:
+                out.append(f'{self.name} {_num(value)}')
+            return out
+        for labelvalues, value in list(self._values.items()):
+            out.append(f'{self.name}{_labels(self.labelnames, labelvalues)} {_num(value)}')
+        return out
+
+
+
+def render():
+    '''every registered metric, in the prometheus text exposition format'''
+    lines = []
+    for m in _REGISTRY:
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,213 @@
+'''
+versioned schema migrations for inventory.db
+
+the schema version is stored in PRAGMA user_version. on startup every migration
+newer than that version is applied in order, each one in its own transaction,
+so existing deployments roll forward and new ones build the full schema.
+
+to change the schema, append a new (version, description, statements) entry.
+never edit a migration that has already been released.
+'''
+
+
+MIGRATIONS = [
+    (1, "base tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT NOT NULL,
+            last_name TEXT DEFAULT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            is_admin INTEGER DEFAULT 0,
+            create_dt TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            name_hash TEXT NOT NULL,
+            descr TEXT,
+            create_dt TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS entry_points (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            func TEXT NOT NULL,
+            is_default INTEGER DEFAULT 0,
+            create_dt TEXT NOT NULL,
+            UNIQUE(project_id, file, func),
+            FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schedule (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ep_id INTEGER NOT NULL,
+            every TEXT DEFAULT NULL,
+            at TEXT DEFAULT NULL,
+            tzname TEXT DEFAULT NULL,
+            is_scheduled INTEGER DEFAULT 0,
+            last_run_dt TEXT DEFAULT NULL,
+            last_run_res TEXT DEFAULT NULL,
+            create_dt TEXT NOT NULL,
+            UNIQUE(ep_id, every, at, tzname),
+            FOREIGN KEY(ep_id) REFERENCES entry_points(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS sched_delete
+        AFTER DELETE ON schedule
+        BEGIN
+            SELECT sched_delete_job(OLD.id);
+        END;
+        ''',
+    ]),
+
+    # entry_points(project_id) and schedule(ep_id) lookups are already served by the
+    # autoindexes behind UNIQUE(project_id, file, func) and UNIQUE(ep_id, every, at, tzname)
+    (2, "index projects by owner", [
+        '''CREATE INDEX IF NOT EXISTS idx_projects_user_hash ON projects(user_id, name_hash)''',
+    ]),
+
+    (3, "run history", [
+        '''
+        CREATE TABLE IF NOT EXISTS runs (
+            id TEXT PRIMARY KEY,
+            project_id INTEGER NOT NULL,
+            ep_id INTEGER DEFAULT NULL,
+            sched_id INTEGER DEFAULT NULL,
+            trigger TEXT NOT NULL,
+            status TEXT NOT NULL,
+            queue_dt TEXT NOT NULL,
+            start_dt TEXT DEFAULT NULL,
+            end_dt TEXT DEFAULT NULL,
+            duration REAL DEFAULT NULL,
+            output_bytes INTEGER DEFAULT 0,
+            FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE,
+            FOREIGN KEY(ep_id) REFERENCES entry_points(id) ON DELETE SET NULL,
+            FOREIGN KEY(sched_id) REFERENCES schedule(id) ON DELETE SET NULL
+        )
+        ''',
+        '''CREATE INDEX IF NOT EXISTS idx_runs_project_queue ON runs(project_id, queue_dt)''',
+        '''CREATE INDEX IF NOT EXISTS idx_runs_ep ON runs(ep_id)''', # needed by the ON DELETE SET NULL foreign keys
+        '''CREATE INDEX IF NOT EXISTS idx_runs_sched ON runs(sched_id)''',
+    ]),
+
+    (4, "schedule priority", [
+        '''ALTER TABLE schedule ADD COLUMN priority INTEGER DEFAULT 0''',
+    ]),
+
+    # jitter is the window a schedule asked for. jitter_offset is the offset it was given,
+    # NULL until it gets one (see SS_Scheduler.offset_for)
+    (5, "schedule jitter", [
+        '''ALTER TABLE schedule ADD COLUMN jitter INTEGER DEFAULT 0''',
+        '''ALTER TABLE schedule ADD COLUMN jitter_offset INTEGER DEFAULT NULL''',
+    ]),
+
+    (6, "schedule overlap policy", [
+        """ALTER TABLE schedule ADD COLUMN overlap TEXT DEFAULT 'skip'""",
+        '''
+        CREATE TABLE IF NOT EXISTS schedule_leases (
+            sched_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_ts REAL NOT NULL,
+            pending INTEGER DEFAULT 0,
+            FOREIGN KEY(sched_id) REFERENCES schedule(id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+
+    (7, "entry point timeout", [
+        '''ALTER TABLE entry_points ADD COLUMN timeout INTEGER DEFAULT NULL''',
+    ]),
+
+    # top_allocs is json - see worker._RunUsage
+    (8, "run resource usage", [
+        '''ALTER TABLE runs ADD COLUMN cpu_user REAL DEFAULT NULL''',
+        '''ALTER TABLE runs ADD COLUMN cpu_system REAL DEFAULT NULL''',
+        '''ALTER TABLE runs ADD COLUMN peak_rss INTEGER DEFAULT NULL''',
+        '''ALTER TABLE runs ADD COLUMN top_allocs TEXT DEFAULT NULL''',
+    ]),
+
+    (9, "schedule profile flag", [
+        '''ALTER TABLE schedule ADD COLUMN profile INTEGER DEFAULT 0''',
+    ]),
+
+    # import_saved: seconds a warm run saved importing its entry point - see worker._WarmCache
+    (10, "warm entry points", [
+        '''ALTER TABLE entry_points ADD COLUMN warm INTEGER DEFAULT 0''',
+        '''ALTER TABLE runs ADD COLUMN import_time REAL DEFAULT NULL''',
+        '''ALTER TABLE runs ADD COLUMN import_saved REAL DEFAULT NULL''',
+    ]),
+
+    # a file's row is replaced when it changes, its callables go with it - see callables.py
+    (11, "callables index", [
+        '''
+        CREATE TABLE IF NOT EXISTS callable_files (
+            project_id INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            error TEXT DEFAULT NULL,
+            PRIMARY KEY(project_id, file),
+            FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS callables (
+            project_id INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            lineno INTEGER NOT NULL,
+            signature TEXT NOT NULL,
+            required INTEGER NOT NULL,
+            decorators TEXT DEFAULT NULL,
+            PRIMARY KEY(project_id, file, name),
+            FOREIGN KEY(project_id, file) REFERENCES callable_files(project_id, file) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+]
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+
+def get_version(conn):
+    return conn.execute('''PRAGMA user_version''').fetchone()[0]
+
+
+def migrate(conn):
+    '''
+    apply pending migrations on conn
+    - returns list of applied versions
+    '''
+    applied = []
+    for version, descr, statements in MIGRATIONS:
+        if version <= get_version(conn):
+            continue
+        conn.execute('''BEGIN IMMEDIATE''') # take the write lock before re-checking, in case another process is migrating
+        try:
+            if version <= get_version(conn):
+                conn.rollback()
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f'''PRAGMA user_version = {int(version)}''') # pragmas can't take bound parameters
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        print(f"> migrated inventory.db to v{version}: {descr}")
+        applied.append(version)
+    return applied
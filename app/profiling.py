@@ -0,0 +1,131 @@
+'''
+cProfile output of profiled runs
+
+a run started with profile=True has its entry point called under cProfile in the
+worker (see worker.py), and the stats are dumped to <run_id>.pstats next to its log.
+runs without the flag don't touch the profiler at all.
+
+    top_functions()     the most expensive functions by cumulative time
+    collapsed_stacks()  "frame;frame;frame <microseconds>" lines, the input of flamegraph.pl,
+                        speedscope, inferno and the like
+
+cProfile only records caller -> callee pairs, not whole stacks, so the stacks are rebuilt
+from the call graph: each function's time on a path is split between its callees in
+proportion to the time they took when called from it. exact for trees, an estimate where
+a function is called from several places.
+
+branches below MIN_STACK_SHARE of the profile's total time are folded into their parent,
+so the work is bounded by the shape of the profile, not by how long the run took. the
+stacks of a run are folded once, when it finishes, and kept next to its .pstats as
+<run_id>.collapsed (see cached_collapsed_stacks).
+'''
+import os
+import pstats
+
+
+MIN_STACK_SHARE = 1e-4 # of the total time - smaller branches are folded into their parent
+MAX_STACK_DEPTH = 128
+MAX_STACK_LINES = 10000 # the most expensive ones are kept
+
+
+
+def profile_path(log_dir, run_id):
+    return os.path.join(log_dir, f'{run_id}.pstats')
+
+
+def collapsed_path(log_dir, run_id):
+    return os.path.join(log_dir, f'{run_id}.collapsed')
+
+
+def _labeler(src_path):
+    '''func key -> frame name. project files relative to src_path, anything else by file name only'''
+    src_path = os.path.join(os.path.realpath(src_path), '')
+    def label(func):
+        file, line, name = func
+        if file.startswith(src_path):
+            file = file[len(src_path):]
+        elif file != '~':
+            file = os.path.basename(file)
+        if file == '~': # builtins
+            return name
+        return f'{name} ({file}:{line})'
+    return label
+
+
+def top_functions(path, src_path, n=30):
+    '''n functions with the highest cumulative time'''
+    stats = pstats.Stats(path).stats
+    label = _labeler(src_path)
+    rows = sorted(stats.items(), key=lambda kv: kv[1][3], reverse=True)[:n]
+    return [{
+        'func': label(func),
+        'ncalls': nc,
+        'primitive_calls': cc,
+        'tottime': tt,
+        'cumtime': ct,
+    } for func, (cc, nc, tt, ct, _) in rows]
+
+
+def collapsed_stacks(path, src_path):
+    '''folded stacks with their time in microseconds, one per line'''
+    stats = pstats.Stats(path).stats
+    label = _labeler(src_path)
+
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3] # cumulative time of func when called from caller
+
+    roots = [(func, ct) for func, (_, _, _, ct, callers) in stats.items() if not callers and ct > 0]
+    min_time = sum(ct for _, ct in roots) * MIN_STACK_SHARE
+    labels = {}
+    folded = {}
+    on_stack, frames = set(), [] # the stack being walked - one of each, pushed and popped
+    def walk(func, budget):
+        if func not in labels:
+            labels[func] = label(func)
+        on_stack.add(func)
+        frames.append(labels[func])
+        ct = stats[func][3]
+        scale = budget / ct if ct else 0
+        spent = 0
+        if len(frames) < MAX_STACK_DEPTH:
+            for child, child_ct in callees.get(func, {}).items():
+                share = child_ct * scale
+                if child in on_stack or share < min_time: # recursion is counted where it starts
+                    continue
+                walk(child, share)
+                spent += share
+        own = budget - spent
+        if own > 0:
+            key = ';'.join(frames)
+            folded[key] = folded.get(key, 0) + own
+        frames.pop()
+        on_stack.discard(func)
+
+    for func, ct in roots:
+        walk(func, ct)
+
+    lines = [(k, round(v * 1e6)) for k, v in folded.items()]
+    if len(lines) > MAX_STACK_LINES:
+        lines = sorted(lines, key=lambda kv: kv[1], reverse=True)[:MAX_STACK_LINES]
+    return ''.join(f'{k} {us}\n' for k, us in sorted(lines) if us > 0)
+
+
+def fold_run(log_dir, run_id, src_path):
+    '''fold the stacks of a finished profiled run and keep them next to its .pstats. returns them'''
+    text = collapsed_stacks(profile_path(log_dir, run_id), src_path)
+    path = collapsed_path(log_dir, run_id)
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path) # readers never see half of it
+    return text
+
+
+def cached_collapsed_stacks(log_dir, run_id, src_path):
+    '''folded stacks of a profiled run - kept from when it finished, folded now for runs from before that'''
+    try:
+        with open(collapsed_path(log_dir, run_id)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return fold_run(log_dir, run_id, src_path)
@@ -1,18 +1,25 @@
-import os, sys, shutil
-import importlib
-import fnmatch, glob
+import os, shutil
 import traceback
 from datetime import datetime as dt
 from dateutil import tz
 import threading
-import re
 import sqlite3
-import queue
 
-from .base import DB
+from .base import DB, dict_factory
 from .capture import print_capture
+from .runs import Run, get_run_history, track_run, untrack_run, get_active_run
+from .executor import RunStopped, WorkerProcess
+from . import stream
+from . import runlog
+from . import queries
+from . import leases
+from . import profiling
+from . import compiler
+from . import callables
+from . import tree
 
-from . import ss_sched
+from . import ss_sched, ss_executor, ss_leases
+from .sched import QUEUE_WAIT, RUN_DURATION, MAX_JITTER
 
 
 SRC_MAIN_PYTHON_STARTER = '''
@@ -42,7 +49,7 @@ SUPPORTED_LANGUAGES = {
     ".ini": "ini"
 }
 
-FS_IGNORES = ["*.pyc", '__pycache__']
+FS_IGNORES = ["*.pyc", '__pycache__', runlog.RUNS_DIR]
 
 
 
@@ -63,6 +70,12 @@ FS_IGNORES = ["*.pyc", '__pycache__']
 
 
 
+class RunError(Exception):
+    '''user code failed - message is the traceback from the worker process'''
+    pass
+
+
+
 class Project(DB):
 
     def __init__(self, workspace_path, db_path, user, project_id, name, name_hash, descr):
@@ -75,7 +88,7 @@ class Project(DB):
         self.user = user
         self._src_path = None
 
-        self._is_running = False
+        self.history = get_run_history(db_path)
 
 
     @property
@@ -94,15 +107,17 @@ class Project(DB):
         return self._src_path
 
 
+    @property
+    def runs_path(self):
+        '''folder holding run output logs'''
+        return os.path.join(self.src_path, runlog.RUNS_DIR)
+
+
     def delete(self):
         shutil.rmtree(self.src_path)
-        conn = self.get_connection()
-        try:
-            self.execute("PRAGMA foreign_keys=ON", conn=conn) # required for foreign key cascade on delete
-            self.execute(f"DELETE FROM projects WHERE id = {self.project_id};", conn=conn)
-        finally:
-            conn.commit()
-            conn.close()
+        tree.drop_tree(self.src_path)
+        # pooled connections always have foreign_keys=ON - required for foreign key cascade on delete
+        self.execute(queries.DELETE_PROJECT, {'project_id': self.project_id})
         return True
 
 
@@ -116,10 +131,8 @@ class Project(DB):
             raise Exception(f"Project named '{new_name}' already exists")
 
         os.rename(old_src_path, new_src_path)
-        self.execute(f'''UPDATE projects
-            SET name = '{new_name}'
-            WHERE id = {self.project_id};
-        ''')
+        tree.drop_tree(old_src_path)
+        self.execute(queries.RENAME_PROJECT, {'name': new_name, 'project_id': self.project_id})
 
         self.name = new_name
         self._src_path = None # reset src_path
@@ -154,200 +167,209 @@ class Project(DB):
 
 
     def get_default_entry_point(self):
-        return self.execute(
-            f"SELECT file, func FROM entry_points WHERE project_id = {self.project_id} AND is_default = 1;",
-            fetch_one=True
-        )
+        return self.execute(queries.DEFAULT_ENTRY_POINT, {'project_id': self.project_id}, fetch_one=True)
 
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
     # =-=-=-=-=-=-=-=-=-=  Properties  =-=-=-=-=-=-=-=-=-=-=-=
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-    def create_entry_point(self, file, func, is_default: bool=False):
-        src_dict = self.get_file_src(path=file)
-        definition = f"^def\s*{func}\s*\(\):\s*$"
-
-        matches = []
-        for line in src_dict['src'].split('\n'):
-            matches = re.findall(definition, line.strip())
-            if matches:
-                break
-
-        if not matches:
+    def create_entry_point(self, file, func, is_default: bool=False, timeout=None, warm: bool=False):
+        '''
+        timeout: seconds its runs may take before they are stopped. None for the server wide limit
+        warm: keep the project's modules loaded between its runs, re-importing only what changed.
+              module level state then persists from one run to the next - see worker._WarmCache
+        '''
+        file = os.path.normpath(file)
+        if not os.path.isfile(os.path.join(self.src_path, file)):
+            raise ValueError(f"'{file}' not a file")
+
+        self._index_callables([file])
+        fn = self.execute(queries.CALLABLE_BY_NAME, {'project_id': self.project_id, 'file': file, 'name': func}, fetch_one=True)
+        if fn is None:
+            indexed = self.execute(queries.CALLABLE_FILE_ERROR, {'project_id': self.project_id, 'file': file}, fetch_one=True)
+            if indexed is not None and indexed.error:
+                raise Exception(f"'{file}' doesn't parse - {indexed.error}")
             raise Exception(f"function '{func}' not found")
+        if fn.required:
+            raise Exception(f"function '{func}{fn.signature}' takes required arguments - entry points are called without any")
 
-        conn = self.get_connection()
         try:
-            if is_default:
-                # mark all others as not default
-                self.execute(f'''
-                    UPDATE entry_points
-                    SET is_default = 0
-                    WHERE project_id = {self.project_id}
-                ''', conn=conn)
-
-            self.execute(f'''
-                INSERT INTO entry_points (
-                    project_id, file, func, is_default, create_dt
-                )
-                VALUES (
-                    {self.project_id}, '{file}', '{func}', {1 if is_default else 0},
-                    '{dt.now().strftime('%Y-%m-%d %H:%M:%S')}'
-                );
-            ''', conn=conn)
-            conn.commit()
+            with self.connection() as conn:
+                if is_default:
+                    # mark all others as not default
+                    self.execute(queries.CLEAR_DEFAULT_ENTRY_POINT, {'project_id': self.project_id}, conn=conn)
+
+                self.execute(queries.INSERT_ENTRY_POINT, {
+                    'project_id': self.project_id,
+                    'file': file,
+                    'func': func,
+                    'is_default': 1 if is_default else 0,
+                    'timeout': int(timeout) if timeout else None,
+                    'warm': 1 if warm else 0,
+                    'create_dt': dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+                }, conn=conn)
         except sqlite3.IntegrityError as e:
             if 'unique constraint failed' in str(e).lower():
                 raise Exception("Entry point already exists") from e
             raise
-        finally:
-            conn.close()
 
 
     def delete_entry_point(self, epid):
-        self.execute(f'''DELETE FROM entry_points WHERE project_id = {self.project_id} AND id = {epid};''')
+        self.execute(queries.DELETE_ENTRY_POINT, {'project_id': self.project_id, 'epid': epid})
 
 
     def get_entry_point(self, epid=None):
         if epid is None:
             return self.get_default_entry_point()
-        ep = self.execute(
-            f"SELECT file, func FROM entry_points WHERE project_id = {self.project_id} AND id = {epid};",
-            fetch_one=True
-        )
+        ep = self.execute(queries.ENTRY_POINT_BY_ID, {'project_id': self.project_id, 'epid': epid}, fetch_one=True)
         if ep is None:
             raise Exception(f"Entry point {epid} not found.")
         return ep
 
 
+    def get_callables(self):
+        '''
+        top-level functions of the project's .py files, from the index (see callables.py). returns
+            callables: list of dicts - file, name, kind, lineno, signature, required, decorators
+            errors: list of dicts - file, error - for files that don't parse
+        '''
+        self._index_callables()
+        params = {'project_id': self.project_id}
+        return {
+            'callables': self.execute(queries.PROJECT_CALLABLES, params, row_factory=dict_factory),
+            'errors': self.execute(queries.PROJECT_CALLABLE_ERRORS, params, row_factory=dict_factory),
+        }
+
+
+    def _index_callables(self, files=None):
+        '''re-parse the given .py files (paths relative to src_path, every one if None) that changed since they were indexed'''
+        everything = files is None
+        if everything:
+            files = [os.path.relpath(pp, self.src_path) for pp in compiler.sources(self.src_path, FS_IGNORES)]
+        stamps = {r.file: (r.mtime_ns, r.size) for r in self.execute(queries.CALLABLE_FILE_STAMPS, {'project_id': self.project_id})}
+
+        parsed, present = [], set()
+        for file in files:
+            full_path = os.path.join(self.src_path, file)
+            try:
+                stamp = callables.file_stamp(full_path)
+                if stamps.get(file) != stamp:
+                    parsed.append((file, stamp, *callables.scan_file(full_path)))
+            except OSError:
+                continue
+            present.add(file)
+        gone = [f for f in (stamps if everything else files) if f in stamps and f not in present]
+        if not parsed and not gone:
+            return
+
+        with self.connection() as conn:
+            self.executemany(queries.DELETE_CALLABLE_FILE, [
+                {'project_id': self.project_id, 'file': f} for f in gone + [p[0] for p in parsed]
+            ], conn=conn)
+            self.executemany(queries.INSERT_CALLABLE_FILE, [
+                {'project_id': self.project_id, 'file': f, 'mtime_ns': stamp[0], 'size': stamp[1], 'error': error}
+                for f, stamp, _, error in parsed
+            ], conn=conn)
+            self.executemany(queries.INSERT_CALLABLE, [
+                dict(fn, project_id=self.project_id, file=f)
+                for f, _, found, _ in parsed for fn in found
+            ], conn=conn)
+
+
     def get_all_entry_points(self):
-        eps = self.execute(f'''
-            SELECT
-            p.name || '::' || ep.file || '::' || ep.func as name,
-            ep.*
-            FROM projects p
-            LEFT JOIN entry_points ep
-                ON p.id = ep.project_id
-            WHERE p.id = {self.project_id}
-            order by ep.id
-        ''')
-        if len(eps)==1 and eps[0].name is None:
+        eps = self.execute(queries.PROJECT_ENTRY_POINTS, {'project_id': self.project_id}, row_factory=dict_factory)
+        if len(eps)==1 and eps[0]['name'] is None:
             return []
-        return [ep._asdict() for ep in eps]
+        return eps
 
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-    def create_schedule(self, epid, every, at, tzname=None):
+    def create_schedule(self, epid, every, at, tzname=None, priority=0, jitter=0, overlap='skip', profile=False):
+        '''
+        - jitter: fire up to this many seconds after the scheduled time, at an offset fixed per schedule.
+          0 leaves it to the server wide spread (see SS_Scheduler)
+        - overlap: what a firing does while the schedule's previous run is still going - see leases.py
+        - profile: run it under cProfile - see profiling.py
+        '''
         self.get_entry_point(epid) # will raise error if epid not found
-        conn = self.get_connection()
         tztest = tz.gettz(tzname)
         if tztest is None:
             raise ValueError(f"unknown timezone '{tzname}'")
+        jitter = int(jitter or 0)
+        if not 0 <= jitter <= MAX_JITTER:
+            raise ValueError(f"jitter must be between 0 and {MAX_JITTER} seconds")
+        overlap = overlap or 'skip'
+        if overlap not in leases.OVERLAP_POLICIES:
+            raise ValueError(f"overlap must be one of {', '.join(leases.OVERLAP_POLICIES)}")
         try:
-            self.execute(f'''
-                INSERT INTO schedule (
-                    ep_id, every, at, tzname, create_dt
-                )
-                VALUES (
-                    {epid}, '{every}', '{at}', {"'"+ tzname + "'" if tzname else 'NULL'},
-                    '{dt.now().strftime('%Y-%m-%d %H:%M:%S')}'
-                );
-            ''', conn=conn)
-            sched_id = self.execute('select seq from sqlite_sequence where name="schedule"', conn=conn, fetch_one=True)
-
-            ss_sched.add_job(
-                sched_id=sched_id,
-                every=every,
-                at=at,
-                tz=tzname,
-                func=lambda: self.blocking_run(epid),
-                enabled=False
-            )
-            conn.commit()
+            with self.connection() as conn:
+                self.execute(queries.INSERT_SCHEDULE, {
+                    'epid': epid,
+                    'every': every,
+                    'at': at,
+                    'tzname': tzname or None,
+                    'priority': int(priority or 0),
+                    'jitter': jitter,
+                    'overlap': overlap,
+                    'profile': 1 if profile else 0,
+                    'create_dt': dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+                }, conn=conn)
+                sched_id = self.execute(queries.LAST_INSERT_ID, conn=conn, fetch_one=True).id
+                offset = None
+                if jitter or ss_sched.spread:
+                    offset = ss_sched.offset_for(sched_id, jitter)
+                    self.execute(queries.SET_SCHEDULE_OFFSET, {'sched_id': sched_id, 'offset': offset}, conn=conn)
         except sqlite3.IntegrityError as e:
             if 'unique constraint failed' in str(e).lower():
                 raise Exception("Schedule already exists") from e
             raise
-        finally:
-            conn.close()
-
-
-    def reload_schedules(self):
-        jobs = self.execute(f'''
-            SELECT
-            sched.id,
-            sched.ep_id,
-            sched.every,
-            sched.at,
-            sched.tzname,
-            sched.is_scheduled
-            FROM entry_points ep
-            LEFT JOIN schedule sched
-                ON ep.id = sched.ep_id
-            WHERE ep.project_id = {self.project_id}
-        ''')
-        for j in jobs:
-            if j.id is None:
-                continue
-            ss_sched.add_job(
-                sched_id=j.id,
-                every=j.every,
-                at=j.at,
-                tz=j.tzname,
-                func=lambda: self.blocking_run(j.ep_id),
-                enabled=(True if j.is_scheduled else False)
-            )
+
+        # once the schedule is committed - a job for a sched_id that was rolled back would fire for nothing
+        ss_sched.add_job(
+            sched_id=sched_id,
+            every=every,
+            at=at,
+            tz=tzname,
+            func=lambda: self.blocking_run(epid, sched_id=sched_id),
+            enabled=False,
+            offset=offset or 0,
+        )
 
 
     def delete_schedule(self, epid, sched_id):
         self.get_entry_point(epid) # will raise error if epid not found
-        self.execute(f'''DELETE FROM schedule WHERE ep_id = {epid} AND id = {sched_id};''')
+        self.execute(queries.DELETE_SCHEDULE, {'epid': epid, 'sched_id': sched_id})
 
 
     def get_full_schedule(self):
-        scheds = self.execute(f'''
-            SELECT
-            p.name || '::' || ep.file || '::' || ep.func as name,
-            sched.*
-            FROM projects p
-            LEFT JOIN entry_points ep
-                ON p.id = ep.project_id
-            LEFT JOIN schedule sched
-                ON ep.id = sched.ep_id
-            WHERE p.id = {self.project_id}
-            AND sched.id IS NOT NULL
-            order by sched.id
-        ''')
-        if len(scheds)==1 and scheds[0].name is None:
+        scheds = self.execute(queries.PROJECT_FULL_SCHEDULE, {'project_id': self.project_id}, row_factory=dict_factory)
+        if len(scheds)==1 and scheds[0]['name'] is None:
             return []
-        return [s._asdict() for s in scheds]
+        return scheds
 
 
     def get_properties(self):
         return {
             'entry_points':self.get_all_entry_points(),
             'schedule': self.get_full_schedule(),
+            'usage': self.history.get_usage_stats(self.project_id),
         }
 
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
     # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
+    @property
+    def _tree(self):
+        return tree.get_tree(self.src_path, FS_IGNORES, SUPPORTED_LANGUAGES)
+
+
     def _get_file_dict(self, path):
         '''
         returns a dictionary describing a file with keys:
-            name:str, type:str, path:str, selected:bool
+            name:str, type:str, path:str, language:str, selected:bool
         '''
-        name = os.path.basename(path)
-        ext = os.path.splitext(path)[-1]
-        out = {
-            'name': name,
-            'type': 'file',
-            'path': os.path.relpath(path, self.src_path),
-            'language': SUPPORTED_LANGUAGES.get(ext, ''),
-            'selected': (name == "main.py"),
-        }
-        return out
+        return self._tree.file_dict(os.path.relpath(path, self.src_path))
 
 
     def _get_folder_dict(self, path):
@@ -357,49 +379,30 @@ class Project(DB):
 
         elements of 'children' can be files of folders
         '''
-        return {
-            'name': os.path.basename(path),
-            'type': 'folder',
-            'path': os.path.relpath(path, self.src_path),
-            'open': True, # open by default??
-            'children': self._children_to_list(path)
-        }
+        return self._tree.folder_dict(os.path.relpath(path, self.src_path))
 
 
-    def _children_to_list(self, path):
-        d = []
-        for f in glob.glob(os.path.join(path, "*")):
-            name = os.path.basename(f)
-            ignore = False
-            for pat in FS_IGNORES:
-                if fnmatch.fnmatch(name, pat):
-                    ignore = True
-                    break
-            if ignore:
-                continue
-
-            if os.path.isfile(f):
-                d.append(self._get_file_dict(f))
-
-            elif os.path.isdir(f):
-                d.append(self._get_folder_dict(f))
-        return d
-
-
-    def get_file_struct_dict(self):
+    def get_file_tree(self):
         '''
-        returns a list of dictionaries describing the full project files with keys:
+        returns (tree, etag) - tree is a list of dictionaries describing the full project files with keys:
             name:str, type:str, path:str, open:bool, children:list
 
-        elements of 'children' can be files of folders
+        elements of 'children' can be files of folders. the etag changes whenever the tree does
+        - the tree is cached and only the folders changed since the last call are listed again, see tree.py
         '''
+        children, etag = self._tree.get()
         return [{
             'name': self.name,
             'type': 'folder',
             'path':'',
             'open': True, # open by default
-            'children': self._children_to_list(self.src_path),
-        }]
+            'children': children,
+        }], etag
+
+
+    def get_file_struct_dict(self):
+        '''the tree of get_file_tree()'''
+        return self.get_file_tree()[0]
 
 
     def get_file_src(self, path):
@@ -433,20 +436,39 @@ class Project(DB):
 
         with open(fpath, 'w') as f:
             f.write('\n')
+        self._tree.refresh(path)
         return self._get_file_dict(fpath)
 
 
     def save_file(self, path, src):
+        '''
+        .py files are also byte-compiled, in the background (see compiler.py). returns
+            diagnostics: list of syntax errors, or None if the compile took longer than compiler.DIAGNOSTIC_WAIT
+        '''
         pp = os.path.join(self.src_path, path)
         with open(pp, 'w') as f:
             f.write(src)
-        return True
+        if not pp.endswith('.py'):
+            return {'diagnostics': []}
+        diagnostics, done = compiler.diagnostics([compiler.submit(pp, path)], timeout=compiler.DIAGNOSTIC_WAIT)
+        return {'diagnostics': diagnostics if done else None}
+
+
+    def compile_all(self):
+        '''byte-compile every .py file of the project. returns files:int, diagnostics:list'''
+        futures = [
+            compiler.submit(pp, os.path.relpath(pp, self.src_path))
+            for pp in compiler.sources(self.src_path, FS_IGNORES)
+        ]
+        diagnostics, _ = compiler.diagnostics(futures)
+        return {'files': len(futures), 'diagnostics': diagnostics}
 
 
     def delete_file(self, path):
         pp = os.path.join(self.src_path, path)
         if os.path.isfile(pp):
             os.remove(pp)
+            self._tree.refresh(os.path.dirname(path))
             return True #self.get_file_struct_dict()
         raise Exception(f"Path not found - {path}")
 
@@ -461,6 +483,7 @@ class Project(DB):
             raise Exception(f"Folder exists - {os.path.join(path, name)}")
 
         os.makedirs(fpath)
+        self._tree.refresh(path)
         return self._get_folder_dict(fpath)
 
 
@@ -469,26 +492,13 @@ class Project(DB):
         if not os.path.isdir(fldr):
             raise Exception(f"Path not found - {path}")
 
-        if force is True:
-            shutil.rmtree(fldr)
-            return True
-
-        dir_empty = True
-        for f in glob.glob(os.path.join(fldr, "*")):
-            name = os.path.basename(f)
-            ignore = False
-            for pat in FS_IGNORES:
-                if fnmatch.fnmatch(name, pat):
-                    ignore = True
-                    break
-            if not ignore:
-                dir_empty = False
-                break
-
-        if dir_empty:
-            shutil.rmtree(fldr)
-        else:
-            raise Exception("Directory not empty")
+        if force is not True:
+            with os.scandir(fldr) as it:
+                if any(not self._tree.ignored(entry.name) for entry in it):
+                    raise Exception("Directory not empty")
+
+        shutil.rmtree(fldr)
+        self._tree.refresh(os.path.dirname(os.path.normpath(path)))
         return True
 
 
@@ -502,6 +512,7 @@ class Project(DB):
             raise Exception(f"Name already exists")
 
         os.rename(src, dst)
+        self._tree.refresh(os.path.dirname(os.path.normpath(path)))
         return True
 
 
@@ -509,94 +520,233 @@ class Project(DB):
     # =-=-=-=-=-=-=-=-=-=-=-=  RUN!  =-=-=-=-=-=-=-=-=-=-=-=-=
     # =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
-    def _run(self, epid=None):
-        self._is_running = True
-        orig_dir = os.getcwd()
-        orig_syspath = sys.path.copy()
-
-        # caution: path[0] is reserved for script path (or '' in REPL)
-        sys.path.remove(sys.path[0])
-        sys.path.insert(0, self.src_path)
-        os.chdir(self.src_path)
-
-        # read config
+    def _run(self, run, epid, msg_cb):
+        '''execute entry point in a worker process (see executor.py), streaming output to msg_cb'''
         ep = self.get_entry_point(epid)
-        print(ep)
-        main_file = os.path.realpath(ep.file)
-        main_function = ep.func
+        run.ep_id = ep.id
+
+        def _on_start():
+            run.start()
+            self.history.record(run)
+            if run.sched_id is not None:
+                QUEUE_WAIT.observe(run.start_ts - run.queue_ts)
+
+        task = {
+            'src_path': os.path.realpath(self.src_path),
+            'file': ep.file,
+            'func': ep.func,
+            'label': os.path.join(self.user.email, self.name),
+            'warm': bool(ep.warm),
+        }
+        if run.profile:
+            task['profile_path'] = profiling.profile_path(os.path.realpath(self.runs_path), run.run_id)
+
+        res = ss_executor.submit(task, msg_cb=msg_cb, on_start=_on_start, user=self.user.user_id, priority=run.priority,
+            timeout=ep.timeout or None, cancel=run.cancel_event) # None for the executor's default timeout
+        run.set_usage(res.get('usage'))
 
-        if not os.path.isfile(main_file):
-            raise FileNotFoundError(f"{main_file} file not found")
+        if not res['ok']:
+            raise RunError(res['error'])
+        return res
 
-        main_path = os.path.dirname(main_file)
-        main_file = os.path.splitext(os.path.basename(main_file))[0]
-        if main_path not in sys.path: # if main_file is in a subfolder, it should be added to sys.path for import to work
-            sys.path.insert(0, main_path)
 
-        # import and immediately reload module to account for any changes
-        module = importlib.import_module(main_file)
+    def _run_print_wrapper(self, run, epid, channel):
+        '''run and publish everything it prints to channel. the run log and output counter listen on the channel'''
+        log = runlog.RunLog(self.runs_path, run.run_id)
+        channel.add_listener(log.write)
+        channel.add_listener(run.count_output)
 
+        status = 'error'
+        track_run(run)
         try:
-            print(f"> imported {module.__name__} from {os.path.join(self.user.email, self.name)}\n")
-            runner = getattr(module, main_function)
-            res = runner()
-            print("\n> done")
+            with print_capture(channel.publish):
+                try:
+                    # bounded, so a reader that holds the output back can't keep the executor from checking for cancel and timeout
+                    self._run(run, epid, lambda data: channel.publish(data, timeout=WorkerProcess.POLL))
+                    status = 'success'
+                except RunStopped as e:
+                    status = e.reason
+                    run.set_usage(e.usage)
+                    print(f"\n> {str(e)}")
+                except RunError as e:
+                    print(self._scrub_paths(str(e)))
+                except:
+                    print(self._scrub_paths(traceback.format_exc()))
+        finally:
+            # after the capture has flushed, so nothing it held back is lost
+            untrack_run(run)
+            run.finish(status)
+            self.history.record(run)
+            if run.sched_id is not None:
+                RUN_DURATION.observe(run.duration, status)
+            log.close()
+            channel.close() # last - readers take a closed channel to mean the run is over
+        if run.profile:
+            self._fold_profile(run.run_id)
+
+
+    def _fold_profile(self, run_id):
+        '''fold the stacks of a profiled run now, so /profile.collapsed doesn't on every request'''
+        if not os.path.isfile(profiling.profile_path(self.runs_path, run_id)): # stopped before the worker wrote it
+            return
+        try:
+            profiling.fold_run(self.runs_path, run_id, self.src_path)
+        except Exception:
+            traceback.print_exc() # folded on request instead
+
+
+    def _scrub_paths(self, err):
+        '''hide server side paths from error messages'''
+        err = err.replace(os.path.join(self.workspace_path, self.user.email), '')
+        err = err.replace(self.workspace_path, '')
+        # err = err.replace(CWD, '')
+        return err
+
+
+    def new_run(self, epid=None, trigger='manual', sched_id=None, priority=0, profile=False):
+        '''create and record a queued run. epid is resolved when the run starts'''
+        run = Run(self.project_id, epid, trigger=trigger, sched_id=sched_id, priority=priority, profile=profile)
+        self.history.record(run)
+        return run
+
+
+    def start_run_thread(self, run, epid):
+        '''start run in a thread. returns the stream.RunChannel its output is published to'''
+        channel = stream.open_channel(run.run_id, log_dir=self.runs_path)
+        t = threading.Thread(target=self._run_print_wrapper, args=(run, epid, channel))
+        t.daemon = True # makes sure it dies with parent process
+        t.start()
+        return channel
+
+
+    def run_with_progress(self, epid, trigger='manual', sched_id=None, run=None):
+        '''
+        generator that yields progress messages, coalesced into chunks (see stream.OutputStream)
+        - pass run (see new_run) to know its id before the generator starts
+        '''
+        if run is None:
+            run = self.new_run(epid, trigger=trigger, sched_id=sched_id)
+        channel = self.start_run_thread(run, epid)
+        yield from stream.OutputStream(channel)
+
 
+    def watch_run(self, run_id, offset=0):
+        '''
+        generator that yields the output of a run from offset, following it live if it's still running
+        - attaching never starts another execution - every viewer reads the same published output
+        '''
+        self.get_run(run_id)
+        channel = stream.get_channel(run_id)
+        if channel is None: # finished - it's all in the log
+            _, _, chunks = runlog.read_range(self.runs_path, run_id, offset=max(0, offset))
+            yield from chunks
+            return
+        yield from stream.OutputStream(channel, offset=max(0, offset), overflow='spill') # a viewer never holds back the run
+
+
+    def blocking_run(self, epid, sched_id=None):
+        '''
+        run in the calling thread and wait for it to finish - for scheduled jobs
+        - output goes to the run log and its viewers (see watch_run)
+        - scheduled runs take the priority and profile flag of their schedule and follow its overlap policy (see leases.py).
+          a firing that is skipped or coalesced is recorded in run history with that status
+        - returns the last Run executed, or None if the firing didn't run here
+        '''
+        if sched_id is None:
+            return self._blocking_run(epid)
+
+        sched = self.execute(queries.SCHEDULE_RUN_OPTIONS, {'sched_id': sched_id}, fetch_one=True)
+        priority = (sched.priority or 0) if sched is not None else 0
+        profile = bool(sched.profile) if sched is not None else False
+        overlap = (sched.overlap if sched is not None else None) or 'skip'
+        if overlap == 'allow':
+            return self._blocking_run(epid, sched_id, priority, profile)
+
+        outcome = ss_leases.acquire(self, sched_id, queue=(overlap == 'queue'))
+        if outcome != leases.LEASED:
+            if outcome != leases.QUEUED: # a queued firing is recorded when the lease holder runs it
+                run = self.new_run(epid, trigger='schedule', sched_id=sched_id)
+                run.drop(outcome)
+                self.history.record(run)
+            return None
+
+        run = None
+        held = True
+        try:
+            while held:
+                run = self._blocking_run(epid, sched_id, priority, profile)
+                held = ss_leases.release(self, sched_id, take_queued=True) # run the firing that queued up meanwhile
         finally:
-            sys.path = orig_syspath
-            os.chdir(orig_dir)
+            if held:
+                ss_leases.release(self, sched_id)
+        return run
+
 
-            print("> clean up sys.modules")
-            to_remove = []
-            for mod_name, mod in sys.modules.items():
-                if hasattr(mod, '__file__') and mod.__file__ is not None and self.src_path in mod.__file__:
-                    to_remove.append(mod_name)
+    def _blocking_run(self, epid, sched_id=None, priority=0, profile=False):
+        trigger = 'schedule' if sched_id is not None else 'manual'
+        run = self.new_run(epid, trigger=trigger, sched_id=sched_id, priority=priority, profile=profile)
+        self._run_print_wrapper(run, epid, stream.open_channel(run.run_id, log_dir=self.runs_path))
+        return run
 
-            for mod_name in to_remove:
-                del sys.modules[mod_name]
 
-            self._is_running = False
+    def get_runs(self, page=1, page_size=50, days=7):
+        '''paginated run history plus p50/p95 duration per entry point over the last n days'''
+        res = self.history.get_project_runs(self.project_id, page=page, page_size=page_size)
+        res['stats'] = self.history.get_duration_stats(self.project_id, days=days)
         return res
 
 
-    def _run_print_wrapper(self, epid, msg_cb):
-        with print_capture(msg_cb):
-            try:
-                self._run(epid)
-            except:
-                err = traceback.format_exc()
-                err = err.replace(os.path.join(self.workspace_path, self.user.email), '')
-                err = err.replace(self.workspace_path, '')
-                # err = err.replace(CWD, '')
-                print(err)
+    def start_run(self, epid, priority=0, profile=False):
+        '''start a run in the background and return its id. see watch_run'''
+        run = self.new_run(epid, priority=priority, profile=profile)
+        self.start_run_thread(run, epid)
+        return run.run_id
 
 
-    def create_run_thread(self, epid, msg_queue):
+    def get_run(self, run_id):
+        run = self.history.get_run(self.project_id, run_id) if runlog.RUN_ID_RE.match(run_id) else None
+        if run is None:
+            raise Exception(f"Run not found - {run_id}")
+        return run
 
-        def _thread_target():
-            def _cb(msg):
-                msg_queue.put_nowait(str(msg))
 
-            self._run_print_wrapper(epid, msg_cb=_cb)
+    def get_run_profile(self, run_id, top=30):
+        '''cProfile summary of a profiled run: its top functions by cumulative time and its folded stacks'''
+        path = self._profile_path(run_id)
+        return {
+            'top': profiling.top_functions(path, self.src_path, n=max(1, int(top))),
+            'collapsed': self.get_run_collapsed_stacks(run_id),
+        }
 
-        t = threading.Thread(target=_thread_target)
-        t.daemon = True # makes sure it dies with parent process
-        return t
 
+    def get_run_collapsed_stacks(self, run_id):
+        self._profile_path(run_id) # raises if there is no profile
+        return profiling.cached_collapsed_stacks(self.runs_path, run_id, self.src_path)
 
-    def run_with_progress(self, epid):
-        '''generator that yields progress messages'''
-        msg_queue = queue.Queue()
-        run_thread = self.create_run_thread(epid, msg_queue=msg_queue)
 
-        run_thread.start()
-        while run_thread.is_alive():
-            yield msg_queue.get()
-        while not msg_queue.empty():
-            yield msg_queue.get()
-        run_thread.join()
+    def _profile_path(self, run_id):
+        self.get_run(run_id) # raises if it isn't a run of this project
+        path = profiling.profile_path(self.runs_path, run_id)
+        if not os.path.isfile(path):
+            raise Exception("Run was not profiled, it hasn't finished, or it is too old - see runlog.RunLog.KEEP_RUNS")
+        return path
 
 
-    def blocking_run(self, epid):
-        for msg in self.run_with_progress(epid):
-            print(msg)
+    def cancel_run(self, run_id):
+        '''stop a queued or running run. it is recorded as cancelled once its worker has let go of it'''
+        self.get_run(run_id) # raises if it isn't a run of this project
+        run = get_active_run(run_id)
+        if run is None:
+            raise Exception("Run is not queued or running")
+        run.cancel()
+        return True
+
+
+    def get_run_log(self, run_id, offset=0):
+        '''
+        output of a run after byte offset. see runlog.read_range
+        - returns (start, end, chunks, is_running)
+        '''
+        self.get_run(run_id)
+        start, end, chunks = runlog.read_range(self.runs_path, run_id, offset=max(0, offset))
+        return start, end, chunks, runlog.is_live(run_id)
@@ -0,0 +1,317 @@
+'''
+named queries used across the app package
+
+every statement is declared once here with bound parameters (:name style),
+so the sql text is identical on every call and sqlite's per-connection
+statement cache can reuse the compiled statement instead of re-parsing it
+'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# users
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+USER_BY_EMAIL = '''SELECT * FROM users WHERE email = :email'''
+
+USER_EMAIL_EXISTS = '''SELECT email FROM users WHERE email = :email'''
+
+INSERT_USER = '''
+    INSERT INTO users (
+        first_name, last_name, email,
+        password, salt, create_dt
+    )
+    VALUES (
+        :first_name, :last_name, :email,
+        :password, :salt, :create_dt
+    )
+'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# projects
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+USER_PROJECTS_SUMMARY = '''
+    SELECT p.*,
+    count(ep.id) AS entry_points,
+    count(sch.id) AS schedules,
+    sum(sch.is_scheduled) AS schedules_enabled
+    FROM projects p
+    LEFT JOIN entry_points ep
+        ON ep.project_id = p.id
+    LEFT JOIN schedule sch
+        ON sch.ep_id = ep.id
+    WHERE p.user_id = :user_id
+    GROUP BY p.id
+'''
+
+USER_PROJECTS = '''SELECT * FROM projects WHERE user_id = :user_id'''
+
+PROJECT_BY_HASH = '''SELECT id, name, descr FROM projects WHERE user_id = :user_id AND name_hash = :name_hash'''
+
+INSERT_PROJECT = '''
+    INSERT INTO projects (
+        user_id, name, name_hash, descr, create_dt
+    )
+    VALUES (
+        :user_id, :name, :name_hash, :descr, :create_dt
+    )
+'''
+
+RENAME_PROJECT = '''UPDATE projects SET name = :name WHERE id = :project_id'''
+
+DELETE_PROJECT = '''DELETE FROM projects WHERE id = :project_id'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# entry points
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+DEFAULT_ENTRY_POINT = '''SELECT id, file, func, timeout, warm FROM entry_points WHERE project_id = :project_id AND is_default = 1'''
+
+ENTRY_POINT_BY_ID = '''SELECT id, file, func, timeout, warm FROM entry_points WHERE project_id = :project_id AND id = :epid'''
+
+PROJECT_ENTRY_POINTS = '''
+    SELECT
+    p.name || '::' || ep.file || '::' || ep.func as name,
+    ep.*
+    FROM projects p
+    LEFT JOIN entry_points ep
+        ON p.id = ep.project_id
+    WHERE p.id = :project_id
+    order by ep.id
+'''
+
+CLEAR_DEFAULT_ENTRY_POINT = '''UPDATE entry_points SET is_default = 0 WHERE project_id = :project_id'''
+
+INSERT_ENTRY_POINT = '''
+    INSERT INTO entry_points (
+        project_id, file, func, is_default, timeout, warm, create_dt
+    )
+    VALUES (
+        :project_id, :file, :func, :is_default, :timeout, :warm, :create_dt
+    )
+'''
+
+DELETE_ENTRY_POINT = '''DELETE FROM entry_points WHERE project_id = :project_id AND id = :epid'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# callables index
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+CALLABLE_FILE_STAMPS = '''SELECT file, mtime_ns, size FROM callable_files WHERE project_id = :project_id'''
+
+CALLABLE_FILE_ERROR = '''SELECT error FROM callable_files WHERE project_id = :project_id AND file = :file'''
+
+DELETE_CALLABLE_FILE = '''DELETE FROM callable_files WHERE project_id = :project_id AND file = :file'''
+
+INSERT_CALLABLE_FILE = '''
+    INSERT INTO callable_files (
+        project_id, file, mtime_ns, size, error
+    )
+    VALUES (
+        :project_id, :file, :mtime_ns, :size, :error
+    )
+'''
+
+INSERT_CALLABLE = '''
+    INSERT OR REPLACE INTO callables (
+        project_id, file, name, kind, lineno, signature, required, decorators
+    )
+    VALUES (
+        :project_id, :file, :name, :kind, :lineno, :signature, :required, :decorators
+    )
+'''
+
+PROJECT_CALLABLES = '''
+    SELECT file, name, kind, lineno, signature, required, decorators
+    FROM callables
+    WHERE project_id = :project_id
+    ORDER BY file, lineno
+'''
+
+PROJECT_CALLABLE_ERRORS = '''
+    SELECT file, error
+    FROM callable_files
+    WHERE project_id = :project_id AND error IS NOT NULL
+    ORDER BY file
+'''
+
+CALLABLE_BY_NAME = '''
+    SELECT file, name, kind, lineno, signature, required, decorators
+    FROM callables
+    WHERE project_id = :project_id AND file = :file AND name = :name
+'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# schedule
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+INSERT_SCHEDULE = '''
+    INSERT INTO schedule (
+        ep_id, every, at, tzname, priority, jitter, overlap, profile, create_dt
+    )
+    VALUES (
+        :epid, :every, :at, :tzname, :priority, :jitter, :overlap, :profile, :create_dt
+    )
+'''
+
+LAST_INSERT_ID = '''SELECT last_insert_rowid() AS id'''
+
+DELETE_SCHEDULE = '''DELETE FROM schedule WHERE ep_id = :epid AND id = :sched_id'''
+
+SCHEDULE_RUN_OPTIONS = '''SELECT priority, overlap, profile FROM schedule WHERE id = :sched_id'''
+
+SET_SCHEDULE_OFFSET = '''UPDATE schedule SET jitter_offset = :offset WHERE id = :sched_id'''
+
+ALL_SCHEDULE_JOBS = '''
+    SELECT
+    sched.id,
+    sched.ep_id,
+    sched.every,
+    sched.at,
+    sched.tzname,
+    sched.jitter,
+    sched.jitter_offset,
+    sched.is_scheduled,
+    p.name_hash,
+    u.email
+    FROM schedule sched
+    JOIN entry_points ep
+        ON ep.id = sched.ep_id
+    JOIN projects p
+        ON p.id = ep.project_id
+    JOIN users u
+        ON u.id = p.user_id
+'''
+
+PROJECT_FULL_SCHEDULE = '''
+    SELECT
+    p.name || '::' || ep.file || '::' || ep.func as name,
+    sched.*
+    FROM projects p
+    LEFT JOIN entry_points ep
+        ON p.id = ep.project_id
+    LEFT JOIN schedule sched
+        ON ep.id = sched.ep_id
+    WHERE p.id = :project_id
+    AND sched.id IS NOT NULL
+    order by sched.id
+'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# run history
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+UPSERT_RUN = '''
+    INSERT INTO runs (
+        id, project_id, ep_id, sched_id, trigger, status,
+        queue_dt, start_dt, end_dt, duration, output_bytes,
+        cpu_user, cpu_system, peak_rss, top_allocs, import_time, import_saved
+    )
+    VALUES (
+        :id, :project_id, :ep_id, :sched_id, :trigger, :status,
+        :queue_dt, :start_dt, :end_dt, :duration, :output_bytes,
+        :cpu_user, :cpu_system, :peak_rss, :top_allocs, :import_time, :import_saved
+    )
+    ON CONFLICT(id) DO UPDATE SET
+        status = excluded.status,
+        start_dt = excluded.start_dt,
+        end_dt = excluded.end_dt,
+        duration = excluded.duration,
+        output_bytes = excluded.output_bytes,
+        cpu_user = excluded.cpu_user,
+        cpu_system = excluded.cpu_system,
+        peak_rss = excluded.peak_rss,
+        top_allocs = excluded.top_allocs,
+        import_time = excluded.import_time,
+        import_saved = excluded.import_saved
+'''
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# schedule leases
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+ACQUIRE_LEASE = '''
+    INSERT INTO schedule_leases (sched_id, owner, expires_ts, pending)
+    VALUES (:sched_id, :owner, :expires_ts, 0)
+    ON CONFLICT(sched_id) DO UPDATE SET
+        owner = excluded.owner,
+        expires_ts = excluded.expires_ts
+    WHERE schedule_leases.expires_ts < :now
+'''
+
+QUEUE_ON_LEASE = '''UPDATE schedule_leases SET pending = 1 WHERE sched_id = :sched_id AND pending = 0'''
+
+TAKE_QUEUED_ON_LEASE = '''
+    UPDATE schedule_leases SET pending = 0, expires_ts = :expires_ts
+    WHERE sched_id = :sched_id AND owner = :owner AND pending = 1
+'''
+
+RENEW_LEASE = '''UPDATE schedule_leases SET expires_ts = :expires_ts WHERE sched_id = :sched_id AND owner = :owner'''
+
+RELEASE_LEASE = '''DELETE FROM schedule_leases WHERE sched_id = :sched_id AND owner = :owner'''
+
+CHANGES = '''SELECT changes() AS n'''
+
+UPDATE_SCHEDULE_LAST_RUN = '''UPDATE schedule SET last_run_dt = :end_dt, last_run_res = :status WHERE id = :sched_id'''
+
+PROJECT_RUNS_PAGE = '''
+    SELECT
+    p.name || '::' || ep.file || '::' || ep.func as name,
+    r.*
+    FROM runs r
+    JOIN projects p
+        ON p.id = r.project_id
+    LEFT JOIN entry_points ep
+        ON ep.id = r.ep_id
+    WHERE r.project_id = :project_id
+    ORDER BY r.queue_dt DESC, r.rowid DESC
+    LIMIT :limit OFFSET :offset
+'''
+
+PROJECT_RUN_BY_ID = '''SELECT * FROM runs WHERE project_id = :project_id AND id = :run_id'''
+
+PROJECT_RUNS_COUNT = '''SELECT count(*) AS total FROM runs WHERE project_id = :project_id'''
+
+PROJECT_RUN_USAGE = '''
+    SELECT
+    p.name || '::' || ep.file || '::' || ep.func as name,
+    r.ep_id,
+    count(*) AS runs,
+    avg(r.duration) AS avg_wall,
+    avg(r.cpu_user + r.cpu_system) AS avg_cpu,
+    max(r.cpu_user + r.cpu_system) AS max_cpu,
+    max(r.peak_rss) AS max_rss,
+    avg(r.import_time) AS avg_import,
+    sum(r.import_saved) AS import_saved
+    FROM runs r
+    JOIN projects p
+        ON p.id = r.project_id
+    JOIN entry_points ep
+        ON ep.id = r.ep_id
+    WHERE r.project_id = :project_id
+    AND r.queue_dt >= :since_dt
+    AND r.cpu_user IS NOT NULL
+    GROUP BY r.ep_id
+    ORDER BY avg_cpu DESC
+'''
+
+# nearest-rank percentiles: the value at rank ceil(n * pct / 100)
+PROJECT_RUN_DURATION_STATS = '''
+    SELECT
+    ep_id,
+    n AS runs,
+    max(CASE WHEN rn = (n * 50 + 99) / 100 THEN duration END) AS p50,
+    max(CASE WHEN rn = (n * 95 + 99) / 100 THEN duration END) AS p95,
+    max(duration) AS max
+    FROM (
+        SELECT
+        ep_id,
+        duration,
+        row_number() OVER (PARTITION BY ep_id ORDER BY duration) AS rn,
+        count(*) OVER (PARTITION BY ep_id) AS n
+        FROM runs
+        WHERE project_id = :project_id
+        AND duration IS NOT NULL
+        AND queue_dt >= :since_dt
+    )
+    GROUP BY ep_id
+'''
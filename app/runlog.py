@@ -0,0 +1,245 @@
+'''
+per-run output logs
+
+every run's output is appended to a log under <project>/.runs/. writes are
+buffered in memory and spilled to disk in chunks, and the log is split into
+size-capped segments so a chatty run can't fill the disk - once MAX_SEGMENTS
+exist the oldest one is deleted.
+
+offsets are byte positions in the whole run output, not in a segment. segment
+files are named <run_id>.<start offset>.log, so a reader can find the bytes after
+any offset from a directory listing without an index.
+
+old runs are pruned too: when a run starts, every file of the runs of the project
+beyond the KEEP_RUNS most recently written ones (logs, .pstats, .collapsed) is deleted - at most
+once every PRUNE_INTERVAL seconds per project. live runs are always kept.
+'''
+import os
+import re
+import time
+import threading
+
+
+RUNS_DIR = '.runs'
+RUN_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_SEGMENT_RE = re.compile(r'^([0-9a-f]{32})\.(\d+)\.log$')
+_RUN_FILE_RE = re.compile(r'^([0-9a-f]{32})\.') # any file of a run - log segments, <run_id>.pstats
+
+
+
+class RunLog:
+    '''
+    buffered, rotating writer for one run
+    - write() only appends to an in-memory buffer
+    - the buffer is written out once it reaches BUFFER_BYTES or FLUSH_INTERVAL seconds have passed, and on close()
+    '''
+    BUFFER_BYTES = 64 * 1024
+    FLUSH_INTERVAL = 1.0
+    SEGMENT_BYTES = 1024 * 1024
+    MAX_SEGMENTS = 8
+    KEEP_RUNS = 500 # runs whose files are kept per log dir
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, log_dir, run_id):
+        self.log_dir = log_dir
+        self.run_id = run_id
+        self.size = 0 # bytes written to disk so far
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment_size = 0
+        self._last_flush = time.monotonic()
+        os.makedirs(log_dir, exist_ok=True)
+        _maybe_prune(log_dir, self.KEEP_RUNS, self.PRUNE_INTERVAL)
+        _register(self)
+
+
+    @property
+    def end(self):
+        '''offset just after the last byte written, including the buffer'''
+        return self.size + len(self._buf)
+
+
+    def write(self, data):
+        '''append bytes (or str) to the log'''
+        with self._lock:
+            self._buf += data.encode(errors='replace') if isinstance(data, str) else data
+            if len(self._buf) >= self.BUFFER_BYTES or time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+                self._flush()
+
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        while self._buf:
+            if self._file is None or self._segment_size >= self.SEGMENT_BYTES:
+                self._rotate()
+            n = min(len(self._buf), self.SEGMENT_BYTES - self._segment_size)
+            self._file.write(self._buf[:n])
+            del self._buf[:n]
+            self._segment_size += n
+            self.size += n
+        if self._file is not None:
+            self._file.flush()
+
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(os.path.join(self.log_dir, f"{self.run_id}.{self.size}.log"), 'ab')
+        self._segment_size = 0
+
+        segments = list_segments(self.log_dir, self.run_id)
+        for _, path in segments[:-self.MAX_SEGMENTS]:
+            os.remove(path)
+
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        _unregister(self)
+
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# logs of runs that are still running, so readers can flush them first
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+_LIVE = {}
+_LIVE_LOCK = threading.Lock()
+
+def _register(log):
+    with _LIVE_LOCK:
+        _LIVE[log.run_id] = log
+
+def _unregister(log):
+    with _LIVE_LOCK:
+        if _LIVE.get(log.run_id) is log:
+            del _LIVE[log.run_id]
+
+def is_live(run_id):
+    return run_id in _LIVE
+
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# retention
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+_LAST_PRUNE = {} # log_dir -> time.monotonic() of its last prune
+_PRUNE_LOCK = threading.Lock()
+
+def _maybe_prune(log_dir, keep, interval):
+    now = time.monotonic()
+    with _PRUNE_LOCK:
+        last = _LAST_PRUNE.get(log_dir)
+        if last is not None and now - last < interval:
+            return
+        _LAST_PRUNE[log_dir] = now
+    try:
+        prune(log_dir, keep)
+    except OSError as e:
+        print("run-log-prune-error:", str(e))
+
+
+def prune(log_dir, keep):
+    '''delete the files of every run but the keep most recently written ones, and the live ones. returns the run_ids removed'''
+    runs = {} # run_id -> [latest mtime, paths]
+    with os.scandir(log_dir) as it:
+        for entry in it:
+            m = _RUN_FILE_RE.match(entry.name)
+            if m is None:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            run = runs.setdefault(m.group(1), [0, []])
+            run[0] = max(run[0], mtime)
+            run[1].append(entry.path)
+
+    ordered = sorted(runs.items(), key=lambda kv: kv[1][0], reverse=True)
+    removed = []
+    for run_id, (_, paths) in ordered[keep:]:
+        if is_live(run_id):
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        removed.append(run_id)
+    return removed
+
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# readers
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+def list_segments(log_dir, run_id):
+    '''[(start offset, path)] of a run's log segments, oldest first'''
+    segments = []
+    try:
+        with os.scandir(log_dir) as it:
+            for entry in it:
+                m = _SEGMENT_RE.match(entry.name)
+                if m and m.group(1) == run_id:
+                    segments.append((int(m.group(2)), entry.path))
+    except FileNotFoundError:
+        pass
+    segments.sort()
+    return segments
+
+
+def read_range(log_dir, run_id, offset=0, chunk_size=64*1024):
+    '''
+    bytes of a run's output after offset
+    - returns (start, end, chunks). start is > offset if the requested bytes were rotated away
+    - end is fixed when this is called; chunks is a generator that reads exactly end - start bytes with os.pread
+    '''
+    live = _LIVE.get(run_id)
+    if live is not None:
+        live.flush()
+
+    segments = []
+    for seg_start, path in list_segments(log_dir, run_id):
+        try:
+            segments.append((seg_start, seg_start + os.path.getsize(path), path))
+        except FileNotFoundError: # rotated away since the listing
+            pass
+
+    if segments:
+        start = min(max(offset, segments[0][0]), segments[-1][1])
+        end = segments[-1][1]
+    else:
+        start = end = offset
+
+    def _chunks():
+        pos = start
+        for seg_start, seg_end, path in segments:
+            if seg_end <= pos:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                return # rotated away while streaming - the client resumes from its last offset
+            try:
+                while pos < seg_end:
+                    data = os.pread(fd, min(chunk_size, seg_end - pos), pos - seg_start)
+                    if not data:
+                        return
+                    pos += len(data)
+                    yield data
+            finally:
+                os.close(fd)
+
+    return start, end, _chunks()
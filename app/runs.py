@@ -0,0 +1,265 @@
+'''
+run history - every execution of an entry point, scheduled or manual
+
+Run objects are created when a run is requested and updated as it moves through
+queued -> running -> success/error. RunHistory persists them to the runs table
+in batches from a background thread, so frequent jobs don't each take the
+sqlite write lock several times per run.
+'''
+import time
+import json
+import uuid
+import threading
+import atexit
+import sqlite3
+from datetime import datetime as dt, timedelta
+
+from .base import DB, dict_factory
+from . import queries
+
+
+DT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+
+def _fmt_ts(ts):
+    return dt.fromtimestamp(ts).strftime(DT_FORMAT) if ts is not None else None
+
+
+def _decode(record):
+    '''a runs row as returned by the API'''
+    if record is not None and record.get('top_allocs') is not None:
+        record['top_allocs'] = json.loads(record['top_allocs'])
+    return record
+
+
+class Run:
+    '''a single execution of an entry point'''
+
+    def __init__(self, project_id, ep_id, trigger='manual', sched_id=None, priority=0, profile=False):
+        self.run_id = uuid.uuid4().hex
+        self.project_id = project_id
+        self.ep_id = ep_id
+        self.sched_id = sched_id
+        self.trigger = trigger # 'manual' or 'schedule'
+        self.priority = priority # place in the executor's queue, higher first. not stored
+        self.profile = profile # run under cProfile - see profiling.py. not stored, the stats file is the record
+        self.status = 'queued' # -> running -> success/error. skipped/coalesced for scheduled firings that didn't run (see leases.py)
+        self.queue_ts = time.time()
+        self.start_ts = None
+        self.end_ts = None
+        self.output_bytes = 0
+        self.usage = {} # resources it used on its worker - see worker._RunUsage
+        self.cancel_event = threading.Event() # set to stop the run - see executor.RunStopped
+
+
+    @property
+    def duration(self):
+        if self.start_ts is None or self.end_ts is None:
+            return None
+        return self.end_ts - self.start_ts
+
+
+    def start(self):
+        self.status = 'running'
+        self.start_ts = time.time()
+
+
+    def finish(self, status):
+        self.status = status
+        self.end_ts = time.time()
+        if self.start_ts is None: # never started (ex: entry point lookup failed)
+            self.start_ts = self.end_ts
+
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+    def drop(self, status):
+        '''end a run that never executed (ex: skipped by its schedule's overlap policy). it has no duration'''
+        self.status = status
+        self.end_ts = time.time()
+
+
+    def set_usage(self, usage):
+        self.usage = usage or {}
+
+
+    def count_output(self, data):
+        self.output_bytes += len(data)
+
+
+    def to_record(self):
+        return {
+            'id': self.run_id,
+            'project_id': self.project_id,
+            'ep_id': self.ep_id,
+            'sched_id': self.sched_id,
+            'trigger': self.trigger,
+            'status': self.status,
+            'queue_dt': _fmt_ts(self.queue_ts),
+            'start_dt': _fmt_ts(self.start_ts),
+            'end_dt': _fmt_ts(self.end_ts),
+            'duration': self.duration,
+            'output_bytes': self.output_bytes,
+            'cpu_user': self.usage.get('cpu_user'),
+            'cpu_system': self.usage.get('cpu_system'),
+            'peak_rss': self.usage.get('peak_rss'),
+            'top_allocs': json.dumps(self.usage['top_allocs']) if self.usage.get('top_allocs') is not None else None,
+            'import_time': self.usage.get('import_time'),
+            'import_saved': self.usage.get('import_saved'),
+        }
+
+
+
+class RunHistory(DB):
+    '''
+    batched writer and reader for the runs table
+    - record() only updates an in-memory pending map (latest state of a run wins)
+    - pending records are written in one transaction every flush_interval seconds, or sooner once max_batch is reached
+    - readers flush first, so they always see their own writes
+    '''
+
+    def __init__(self, db_path, flush_interval=1.0, max_batch=500):
+        super().__init__(db_path)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+                    self._thread.start()
+
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("run-history-flush-error:", str(e))
+
+
+    def record(self, run: Run):
+        with self._lock:
+            self._pending[run.run_id] = run.to_record()
+            n_pending = len(self._pending)
+        self._ensure_thread()
+        if n_pending >= self.max_batch:
+            self._wake.set()
+
+
+    def flush(self):
+        with self._flush_lock: # keeps batches in order
+            with self._lock:
+                batch, self._pending = list(self._pending.values()), {}
+            if not batch:
+                return 0
+
+            try:
+                self._write(batch)
+            except BaseException:
+                # ex: database is locked, pool exhausted - the batch goes back, to be retried by the next flush.
+                # a state recorded since it was taken is newer and stays
+                with self._lock:
+                    for r in batch:
+                        self._pending.setdefault(r['id'], r)
+                raise
+            return len(batch)
+
+
+    def _write(self, batch):
+        finished_scheds = [r for r in batch if r['sched_id'] is not None and r['end_dt'] is not None and r['start_dt'] is not None] # not dropped firings
+        try:
+            with self.connection() as conn:
+                self.executemany(queries.UPSERT_RUN, batch, conn=conn)
+                self.executemany(queries.UPDATE_SCHEDULE_LAST_RUN, finished_scheds, conn=conn)
+        except sqlite3.IntegrityError:
+            # a project or entry point was deleted while its run was pending - write the rest one by one
+            for r in batch:
+                try:
+                    self.execute(queries.UPSERT_RUN, r)
+                except sqlite3.IntegrityError:
+                    pass
+            self.executemany(queries.UPDATE_SCHEDULE_LAST_RUN, finished_scheds)
+
+
+    def get_project_runs(self, project_id, page=1, page_size=50):
+        self.flush()
+        page = max(1, int(page))
+        page_size = min(max(1, int(page_size)), 500)
+        params = {'project_id': project_id}
+        total = self.execute(queries.PROJECT_RUNS_COUNT, params, fetch_one=True).total
+        runs = self.execute(queries.PROJECT_RUNS_PAGE, {
+            **params,
+            'limit': page_size,
+            'offset': (page - 1) * page_size,
+        }, row_factory=dict_factory)
+        return {
+            'page': page,
+            'page_size': page_size,
+            'total': total,
+            'runs': [_decode(r) for r in runs],
+        }
+
+
+    def get_run(self, project_id, run_id):
+        self.flush()
+        return _decode(self.execute(queries.PROJECT_RUN_BY_ID, {'project_id': project_id, 'run_id': run_id}, fetch_one=True, row_factory=dict_factory))
+
+
+    def get_duration_stats(self, project_id, days=7):
+        '''p50/p95 run duration per entry point over the last n days - computed by sqlite, the durations aren't loaded'''
+        self.flush()
+        since = (dt.now() - timedelta(days=days)).strftime(DT_FORMAT)
+        return self.execute(queries.PROJECT_RUN_DURATION_STATS, {'project_id': project_id, 'since_dt': since}, row_factory=dict_factory)
+
+
+    def get_usage_stats(self, project_id, days=7):
+        '''wall time, cpu time, peak memory and import time per entry point over the last n days - most cpu first'''
+        self.flush()
+        since = (dt.now() - timedelta(days=days)).strftime(DT_FORMAT)
+        return self.execute(queries.PROJECT_RUN_USAGE, {'project_id': project_id, 'since_dt': since}, row_factory=dict_factory)
+
+
+
+_ACTIVE_RUNS = {} # run_id -> Run, while it is queued or running in this process
+_ACTIVE_RUNS_LOCK = threading.Lock()
+
+def track_run(run):
+    with _ACTIVE_RUNS_LOCK:
+        _ACTIVE_RUNS[run.run_id] = run
+
+
+def untrack_run(run):
+    with _ACTIVE_RUNS_LOCK:
+        _ACTIVE_RUNS.pop(run.run_id, None)
+
+
+def get_active_run(run_id):
+    '''the Run if it is queued or running in this process, else None'''
+    with _ACTIVE_RUNS_LOCK:
+        return _ACTIVE_RUNS.get(run_id)
+
+
+
+_HISTORIES = {}
+_HISTORIES_LOCK = threading.Lock()
+
+def get_run_history(db_path) -> RunHistory:
+    '''one shared RunHistory per database'''
+    with _HISTORIES_LOCK:
+        if db_path not in _HISTORIES:
+            _HISTORIES[db_path] = RunHistory(db_path)
+            atexit.register(_HISTORIES[db_path].flush)
+        return _HISTORIES[db_path]
@@ -1,33 +1,359 @@
+'''
+schedule runner
+
+flask_production's TaskScheduler asks every job whether it is due on every tick. here
+jobs are kept in a min-heap keyed by their next fire time instead: the scheduler
+thread sleeps until the earliest one is due, pops whatever is due and goes back to
+sleep. adding, enabling or firing a job pushes a new heap entry and wakes the
+thread if the new entry is now the earliest. jobs should be enabled and disabled
+through enable_job() / disable_job() so the index follows.
+
+heap entries are (timestamp, seq, sched_id). an entry is only valid while seq is the
+latest one pushed for that schedule, so stale entries (job deleted, disabled or
+rescheduled) are skipped when they surface instead of being searched for and removed.
+
+a job's next firing is scheduled when it is dispatched, not when its run ends, so a slow
+run doesn't hold back its schedule. whether a firing may run while the previous one is
+still going is the job's business - scheduled runs follow their overlap policy (leases.py).
+
+jobs can be given an offset, so schedules that share a round time (every hour, at 09:00)
+don't all fire in the same second. a job fires offset seconds after its slot; the
+offset is a hash of its sched_id inside a window (see jitter_offset), so it is the same
+on every restart. the window is the schedule's own jitter, or the scheduler's spread
+for schedules without one. 0 for neither keeps the exact time.
+
+every firing is timed (see metrics.py, served at /metrics with --metrics-enable):
+    dispatch lag - from the slot the job was scheduled for to when the scheduler started it
+    queue wait   - how long its run waited for a worker (observed by Project, see executor.py)
+    run duration - how long its run took on the worker, by run status (observed by Project)
+the metrics are totals over all schedules - a series per schedule would be millions of them
+with many schedules. the timings of a single schedule are in its runs (runs.py).
+'''
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
 from flask_production import TaskScheduler
 
+from .metrics import Histogram, Gauge, LAG_BUCKETS, DURATION_BUCKETS
 
-class SS_Scheduler(TaskScheduler):
+
+DISPATCH_LAG = Histogram('ss_sched_dispatch_lag_seconds', "Time from a job's scheduled slot to its dispatch", LAG_BUCKETS)
+QUEUE_WAIT = Histogram('ss_sched_queue_wait_seconds', "Time a scheduled run waited for a worker", LAG_BUCKETS)
+RUN_DURATION = Histogram('ss_sched_run_duration_seconds', "Run time of scheduled jobs", DURATION_BUCKETS, ('status',))
+LAST_SCHEDULED = Gauge('ss_sched_last_scheduled_timestamp_seconds', "Slot of the latest firing of any job")
+LAST_DISPATCH = Gauge('ss_sched_last_dispatch_timestamp_seconds', "When the latest firing of any job was dispatched")
+
+MAX_JITTER = 3600
+
+
+
+def jitter_offset(sched_id, window):
+	'''offset of a schedule in [0, window) seconds - a hash of its id, not random, so it is stable'''
+	if not window or window <= 0:
+		return 0
+	h = hashlib.blake2b(str(sched_id).encode(), digest_size=8).digest()
+	return int.from_bytes(h, 'big') % int(window)
+
+
+
+class JobStore:
+	'''
+	the scheduler's jobs in insertion order, stored as dict keys
+	- stands in for TaskScheduler's jobs list, so removing a job doesn't scan the list
+	'''
 
 	def __init__(self):
+		self._jobs = {}
+
+	def append(self, j):
+		self._jobs[j] = None
+
+	def remove(self, j):
+		del self._jobs[j]
+
+	def discard(self, j):
+		self._jobs.pop(j, None)
+
+	def copy(self):
+		return list(self._jobs)
+
+	def __iter__(self):
+		return iter(list(self._jobs)) # jobs may be added or removed while iterating
+
+	def __len__(self):
+		return len(self._jobs)
+
+	def __contains__(self, j):
+		return j in self._jobs
+
+
+
+class SS_Scheduler(TaskScheduler):
+
+	MAX_SLEEP = 60 # fire times are wall clock - re-check now and then in case the system clock jumps
+
+	def __init__(self, spread=0):
 		super().__init__(persist_states=False)
+		self.spread = spread # offset window of schedules without their own jitter. 0 for none
+		self.jobs = JobStore()
 		self._sched_mapping = {}
+		self._offsets = {} # sched_id -> seconds its firings are delayed by
+		self._on_complete = {} # sched_id -> fn(job) called after each run
+		self._running = {} # sched_id -> runs of it going on
+		self._heap = []
+		self._entry_seq = {} # sched_id -> seq of its valid heap entry
+		self._seq = itertools.count()
+		self._cond = threading.Condition()
+		self._running_auto = False
+		self._thread = None
+
+
+	def register_metrics(self):
+		'''expose this scheduler's gauges at /metrics - once, for the app's scheduler'''
+		Gauge('ss_sched_jobs', "Registered jobs", fn=lambda: len(self.jobs))
+		Gauge('ss_sched_next_fire_timestamp_seconds', "Slot of the earliest scheduled job", fn=self.next_fire_time)
+
+
+	def offset_for(self, sched_id, jitter=0):
+		'''offset of a schedule with the given jitter window, or the spread window if it has none'''
+		return jitter_offset(sched_id, min(jitter or self.spread or 0, MAX_JITTER))
+
+
+	def assign_offsets(self, rows):
+		'''
+		offsets of schedule rows (with id, jitter and jitter_offset columns)
+		- a stored offset is kept, so changing the spread doesn't move existing schedules
+		- returns ({sched_id: offset}, [{'sched_id', 'offset'} of rows given a new one - to store])
+		'''
+		offsets, new = {}, []
+		for r in rows:
+			if r.jitter_offset is not None:
+				offsets[r.id] = r.jitter_offset
+			elif r.jitter or self.spread:
+				offsets[r.id] = self.offset_for(r.id, r.jitter)
+				new.append({'sched_id': r.id, 'offset': offsets[r.id]})
+		return offsets, new
+
+
+	def add_job(self, sched_id, every, at, tz, func, enabled=False, on_complete_cb=None, offset=0):
+		self.add_jobs([dict(sched_id=sched_id, every=every, at=at, tz=tz, func=func, enabled=enabled, on_complete_cb=on_complete_cb, offset=offset)])
 
 
-	def add_job(self, sched_id, every, at, tz, func, enabled=False, on_complete_cb=None):
+	def add_jobs(self, specs):
+		'''
+		register many jobs and index them in one go - specs are dicts of add_job() arguments
+		- raises on the first spec that can't be added. the ones before it stay scheduled
+		'''
+		added = []
+		try:
+			for spec in specs:
+				self._build_job(**spec)
+				added.append(spec['sched_id'])
+		finally:
+			self._push_many(added)
+
+
+	def _build_job(self, sched_id, every, at, tz, func, enabled=False, on_complete_cb=None, offset=0):
 		if sched_id in self._sched_mapping:
 			raise Exception("Job already scheduled")
 
-		j = self.every(every).at(at).tz(tz).do_parallel(func)
+		self.every(every).at(at)
+		if tz:
+			self.tz(tz) # otherwise the scheduler's default (local) zone - by name, so dateutil caches it
+		j = self.do_parallel(func)
 		if not enabled:
 			j.disable()
-		if on_complete_cb:
-			j.register_callback(on_complete_cb, cb_type='oncomplete')
 
-		self._sched_mapping[sched_id] = j
+		with self._cond:
+			self._sched_mapping[sched_id] = j
+			if offset:
+				if isinstance(j.job.interval, (int, float)):
+					offset %= j.job.interval # an "every n seconds" job would otherwise fall behind its own interval
+				self._offsets[sched_id] = offset
+			if on_complete_cb:
+				self._on_complete[sched_id] = on_complete_cb
 
 
 	def get_job(self, sched_id):
 		return self._sched_mapping.get(sched_id)
 
 
-	def delete_job(self, sched_id):
+	def enable_job(self, sched_id):
 		j = self.get_job(sched_id)
 		if j:
-			self.jobs.remove(j)
-			del self._sched_mapping[sched_id]
+			j.enable() # computes its next run
+			self._push(sched_id)
+
+
+	def disable_job(self, sched_id):
+		j = self.get_job(sched_id)
+		if j:
+			j.disable()
+			self._push(sched_id) # drops it from the index
+
+
+	def delete_job(self, sched_id):
+		self.delete_jobs((sched_id,))
+
+
+	def delete_jobs(self, sched_ids):
+		'''remove many jobs under one lock. unknown ids are ignored'''
+		with self._cond:
+			for sched_id in sched_ids:
+				j = self._sched_mapping.pop(sched_id, None)
+				if j is None:
+					continue
+				self._entry_seq.pop(sched_id, None) # its heap entry is skipped when it surfaces
+				self._on_complete.pop(sched_id, None)
+				self._offsets.pop(sched_id, None)
+				self.jobs.discard(j)
+
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+	# next-fire index
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+	def _push(self, sched_id):
+		'''(re)index a job by its next fire time. disabled and never-again jobs are only dropped from the index'''
+		self._push_many((sched_id,))
+
+
+	def _push_many(self, sched_ids):
+		with self._cond:
+			entries = []
+			for sched_id in sched_ids:
+				j = self._sched_mapping.get(sched_id)
+				if j is None:
+					continue
+				if j.is_disabled or not j.next_timestamp:
+					self._entry_seq.pop(sched_id, None)
+					continue
+				seq = next(self._seq)
+				self._entry_seq[sched_id] = seq
+				entries.append((j.next_timestamp + self._offsets.get(sched_id, 0), seq, sched_id))
+			if not entries:
+				return
+
+			earliest = self._heap[0][0] if self._heap else None
+			if len(entries) * 8 > len(self._heap): # cheaper to rebuild than to push one by one
+				self._heap.extend(entries)
+				heapq.heapify(self._heap)
+			else:
+				for e in entries:
+					heapq.heappush(self._heap, e)
+			if len(self._heap) > 2 * len(self._entry_seq) + 1024:
+				self._compact()
+			if earliest is None or self._heap[0][0] < earliest: # the scheduler thread may be sleeping past the new earliest run
+				self._cond.notify()
+
+
+	def _compact(self):
+		'''drop stale entries. caller holds the lock'''
+		self._heap = [e for e in self._heap if self._entry_seq.get(e[2]) == e[1]]
+		heapq.heapify(self._heap)
+
+
+	def next_fire_time(self):
+		'''timestamp of the earliest scheduled run (offset included), or None'''
+		with self._cond:
+			while self._heap and self._entry_seq.get(self._heap[0][2]) != self._heap[0][1]:
+				heapq.heappop(self._heap)
+			return self._heap[0][0] if self._heap else None
+
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+	# scheduler control
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+	def check(self):
+		'''run the jobs that are due - only the ones at the top of the heap are looked at'''
+		now = time.time()
+		due = []
+		with self._cond:
+			while self._heap and self._heap[0][0] <= now:
+				fire_ts, seq, sched_id = heapq.heappop(self._heap)
+				if self._entry_seq.get(sched_id) != seq:
+					continue
+				del self._entry_seq[sched_id]
+				due.append((sched_id, fire_ts))
+		for sched_id, fire_ts in due:
+			j = self._sched_mapping.get(sched_id)
+			if j is not None and not j.is_disabled and 0 < j.next_timestamp <= now: # fire_ts is its slot plus offset
+				self._dispatch(sched_id, j, fire_ts) # puts it back on the heap
+			# else: deleted or disabled
+
+
+	def _dispatch(self, sched_id, j, fire_ts):
+		'''start a due job on its own thread, like AsyncJobWrapper.run'''
+		dispatch_ts = time.time()
+		DISPATCH_LAG.observe(dispatch_ts - fire_ts)
+		LAST_SCHEDULED.set(fire_ts)
+		LAST_DISPATCH.set(dispatch_ts)
+		j.job.schedule_next_run(just_ran=True)
+		self._push(sched_id)
+		j.proc = threading.Thread(target=self._run_job, args=(sched_id, j), daemon=True)
+		j.proc.start()
+
+
+	def _run_job(self, sched_id, j):
+		'''
+		Job.run without its stdout capture. that capture swaps sys.stdout for the whole process,
+		and jobs starting and ending out of order would leave it in place under other runs' captures
+		'''
+		job = j.job
+		with self._cond:
+			self._running[sched_id] = self._running.get(sched_id, 0) + 1
+			job.is_running = True
+		try:
+			job.func(**job.kwargs)
+		except Exception:
+			print(f"Job {sched_id} failed!")
+			traceback.print_exc()
+		finally:
+			with self._cond:
+				n = self._running.pop(sched_id, 1) - 1
+				if n > 0:
+					self._running[sched_id] = n
+				job.is_running = n > 0
+		cb = self._on_complete.get(sched_id)
+		if cb is not None:
+			try:
+				cb(job)
+			except Exception as e:
+				print("on-complete-cb-error:", str(e))
+
+
+	def start(self):
+		'''blocking loop that sleeps until the next job is due'''
+		self._running_auto = True
+		try:
+			while self._running_auto:
+				self.check()
+				with self._cond:
+					if not self._running_auto:
+						break
+					timeout = self.MAX_SLEEP
+					if self._heap:
+						timeout = min(timeout, self._heap[0][0] - time.time())
+					if timeout > 0:
+						self._cond.wait(timeout)
+		finally:
+			self.join()
+
+
+	def start_thread(self):
+		'''run start() in a daemon thread'''
+		if self._thread is None or not self._thread.is_alive():
+			self._thread = threading.Thread(target=self.start, name='ss-scheduler', daemon=True)
+			self._thread.start()
+		return self._thread
+
 
+	def stop(self):
+		with self._cond:
+			self._running_auto = False
+			self._cond.notify()
@@ -0,0 +1,266 @@
+'''
+server-sent events for live run output
+
+a small asyncio http server that runs next to the flask app, on its own port and
+event loop thread. every viewer is a coroutine and a socket instead of a server
+thread, so hundreds of open run tabs cost a few MB.
+
+    GET /project/<hash>/runs/<run_id>/events[?offset=N]
+
+events:
+    output  - data is run output. id is the byte offset in the run log after it,
+              so a reconnecting EventSource resumes from Last-Event-ID
+    end     - the run has finished. data is {"status": ...}
+heartbeat comments are sent while a run is quiet so proxies keep the connection open.
+a client has HEADER_TIMEOUT seconds to send its request, then it is disconnected.
+
+viewers of a running job read its stream.RunChannel, so they can attach at any
+time - including to runs started by the scheduler or by another user session -
+without starting another execution. finished runs are read from the run log.
+'''
+import asyncio
+import codecs
+import json
+import re
+import threading
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, parse_qs
+
+from . import runlog, stream
+
+
+EVENTS_ROUTE_RE = re.compile(r'^/project/([^/]+)/runs/([0-9a-f]{32})/events$')
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n') # every line ending of the event stream format - a bare \r ends a field too
+
+
+
+class RunEventServer:
+    '''
+    - get_project(cookies, project_hash) is called in a thread pool to authenticate a viewer. it should raise if not allowed
+    - start() runs the server in a daemon thread. raises if it can't listen, ex: port in use
+    '''
+    HEARTBEAT = 15
+    HEADER_TIMEOUT = 10
+    READ_SIZE = 256 * 1024
+    RETRY_MS = 2000
+
+    def __init__(self, get_project, host='0.0.0.0', port=5001, heartbeat=None):
+        self.get_project = get_project
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat or self.HEARTBEAT
+        self.loop = None
+        self._waiters = {} # stream.RunChannel -> set of asyncio.Event, one per viewer
+        self._watchers = {} # stream.RunChannel -> its watcher
+        self.n_viewers = 0
+
+
+    def start(self):
+        ready = threading.Event()
+        failed = []
+        def _serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            except BaseException as e:
+                failed.append(e)
+                self.loop.close()
+                return
+            finally:
+                ready.set()
+            self.loop.run_forever()
+        threading.Thread(target=_serve, name='ss-sse', daemon=True).start()
+        ready.wait()
+        if failed:
+            raise Exception(f"server-sent events server can't listen on {self.host}:{self.port} - {failed[0]}") from failed[0]
+
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # channel notifications - one watcher per watched run, however many viewers it has
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    def _subscribe(self, channel):
+        ev = asyncio.Event()
+        if channel is None: # run is over
+            return ev
+        if channel not in self._waiters:
+            self._waiters[channel] = set()
+            watcher = lambda: self.loop.call_soon_threadsafe(self._wake, channel)
+            self._watchers[channel] = watcher
+            channel.add_watcher(watcher)
+        self._waiters[channel].add(ev)
+        return ev
+
+
+    def _unsubscribe(self, channel, ev):
+        waiters = self._waiters.get(channel)
+        if waiters is None:
+            return
+        waiters.discard(ev)
+        if not waiters:
+            del self._waiters[channel]
+            channel.remove_watcher(self._watchers.pop(channel))
+
+
+    def _wake(self, channel):
+        for ev in self._waiters.get(channel, ()):
+            ev.set()
+
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # http
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    async def _read_request(self, reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        return method, target, headers
+
+
+    def _cors_headers(self, headers):
+        '''EventSource withCredentials needs CORS - only allow pages served from the same host'''
+        origin = headers.get('origin')
+        if origin is None:
+            return ''
+        host = headers.get('host', '').rsplit(':', 1)[0]
+        if urlsplit(origin).hostname != host:
+            return ''
+        return f'Access-Control-Allow-Origin: {origin}\r\nAccess-Control-Allow-Credentials: true\r\nVary: Origin\r\n'
+
+
+    async def _respond_error(self, writer, status, msg):
+        body = json.dumps({'error': msg}).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, target, headers = await asyncio.wait_for(self._read_request(reader), self.HEADER_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+                return
+
+            url = urlsplit(target)
+            m = EVENTS_ROUTE_RE.match(url.path)
+            if method != 'GET' or m is None:
+                return await self._respond_error(writer, '404 Not Found', "Not found")
+            project_hash, run_id = m.groups()
+
+            cookies = {k: v.value for k, v in SimpleCookie(headers.get('cookie', '')).items()}
+            try:
+                project = await self.loop.run_in_executor(None, self._get_run_project, cookies, project_hash, run_id)
+            except Exception as e:
+                return await self._respond_error(writer, '403 Forbidden', str(e))
+
+            offset = headers.get('last-event-id') or parse_qs(url.query).get('offset', ['0'])[0]
+            try:
+                offset = max(0, int(offset))
+            except ValueError:
+                offset = 0
+
+            writer.write((
+                'HTTP/1.1 200 OK\r\n'
+                'Content-Type: text/event-stream\r\n'
+                'Cache-Control: no-cache\r\n'
+                'Connection: keep-alive\r\n'
+                'X-Accel-Buffering: no\r\n'
+                + self._cors_headers(headers)
+                + f'\r\nretry: {self.RETRY_MS}\n\n'
+            ).encode())
+            await writer.drain()
+            await self._stream(writer, project, run_id, offset)
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+    def _get_run_project(self, cookies, project_hash, run_id):
+        project = self.get_project(cookies, project_hash)
+        project.get_run(run_id) # raises if the run isn't in this project
+        return project
+
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # events
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    @staticmethod
+    def _event(event, data, event_id=None):
+        out = f'id: {event_id}\n' if event_id is not None else ''
+        out += f'event: {event}\n'
+        out += ''.join(f'data: {line}\n' for line in LINE_BREAK_RE.split(data)) # the client joins data lines with \n
+        return (out + '\n').encode()
+
+
+    def _read_log(self, log_dir, run_id, offset):
+        start, _, chunks = runlog.read_range(log_dir, run_id, offset=offset)
+        data = bytearray()
+        try:
+            for chunk in chunks:
+                data += chunk
+                if len(data) >= self.READ_SIZE:
+                    break
+        finally:
+            chunks.close()
+        return start, bytes(data)
+
+
+    async def _stream(self, writer, project, run_id, offset):
+        '''
+        events from the run's channel while it runs - straight from the shared memory buffer, no copy per viewer.
+        from the run log for finished runs and for viewers that are behind the buffer
+        '''
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        channel = stream.get_channel(run_id)
+        ev = self._subscribe(channel)
+        self.n_viewers += 1
+        try:
+            while True:
+                ev.clear() # before reading, so a publish during the read isn't missed
+                live = False
+                data = None
+                if channel is not None:
+                    with channel._cond:
+                        live = not channel.closed
+                        data = channel.read(offset, self.READ_SIZE) # None if behind the buffer
+                    start = offset
+                if data is None:
+                    start, data = await self.loop.run_in_executor(None, self._read_log, project.runs_path, run_id, offset)
+
+                if data:
+                    if start != offset: # rotated away - restart decoding at a segment boundary
+                        decoder.reset()
+                    offset = start + len(data)
+                    text = decoder.decode(data)
+                    event_id = offset - len(decoder.getstate()[0]) # don't count bytes of a split character
+                    writer.write(self._event('output', text, event_id))
+                    await writer.drain()
+                    continue
+
+                if not live:
+                    run = await self.loop.run_in_executor(None, project.get_run, run_id)
+                    writer.write(self._event('end', json.dumps({'status': run['status']})))
+                    await writer.drain()
+                    return
+
+                try:
+                    await asyncio.wait_for(ev.wait(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    writer.write(b': heartbeat\n\n')
+                    await writer.drain()
+        finally:
+            self.n_viewers -= 1
+            self._unsubscribe(channel, ev)
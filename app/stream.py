@@ -0,0 +1,300 @@
+'''
+run output fan-out
+
+each running job publishes its output once into a RunChannel, a shared in-memory
+buffer keyed by run id. any number of consumers read it:
+    listeners  - called in the publishing thread for every chunk (run log writer, output counters)
+    readers    - OutputStream objects with their own cursor (http responses, server-sent events)
+offsets are byte positions in the run output, the same as in the run log (see runlog.py),
+so a reader that falls behind the in-memory buffer continues from the log on disk.
+
+a channel keeps at most MAX_BUFFER bytes in memory. what happens to a reader that
+falls further behind than that is its OVERFLOW policy:
+    block       - the buffer isn't trimmed past the reader, so the job waits for it (backpressure through the worker pipe)
+    drop-oldest - the reader skips ahead to the oldest buffered byte and gets a marker saying how much it missed
+    spill       - the reader continues from the run log on disk and catches up from there
+a 'block' reader that holds the job back for STALL_TIMEOUT seconds in a row is switched to
+drop-oldest, so a stuck viewer can't hold a run (and its worker) forever.
+'''
+import bisect
+import threading
+import time
+
+from . import runlog
+
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'spill')
+
+
+def configure(max_buffer=None, overflow=None):
+    '''set defaults for new channels and readers'''
+    if overflow is not None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception(f"Unknown overflow policy '{overflow}'. Expected one of {OVERFLOW_POLICIES}")
+        OutputStream.OVERFLOW = overflow
+    if max_buffer:
+        RunChannel.MAX_BUFFER = int(max_buffer)
+
+
+
+class RunChannel:
+    '''
+    output of one run, published once and shared by every consumer
+    - publish() is called by the run. close() marks the end of the output
+    '''
+    MAX_BUFFER = 1024 * 1024
+    STALL_TIMEOUT = 10
+
+    def __init__(self, run_id, log_dir=None, max_buffer=None):
+        self.run_id = run_id
+        self.log_dir = log_dir
+        self.max_buffer = max_buffer or self.MAX_BUFFER
+        self.base = 0 # offset of the oldest byte still in memory
+        self.end = 0 # offset after the last published byte
+        self.closed = False
+
+        self._stalled_since = None # when the publisher was first held back by a blocking reader, None while it isn't
+        self._cond = threading.Condition()
+        self._publish_lock = threading.Lock() # keeps listeners in publish order when more than one thread publishes
+        self._offsets = [] # start offset of each buffered chunk, for bisect
+        self._chunks = []
+        self._head = 0 # index of the oldest buffered chunk - the lists are compacted now and then instead of popped from the front
+        self._listeners = []
+        self._watchers = []
+        self._readers = set()
+
+
+    def add_listener(self, fn):
+        '''fn(data: bytes) is called in the publishing thread for every chunk'''
+        self._listeners.append(fn)
+
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+
+    def add_watcher(self, fn):
+        '''fn() is called after every publish and on close - for readers that poll read() on their own loop'''
+        self._watchers.append(fn)
+
+
+    def remove_watcher(self, fn):
+        if fn in self._watchers:
+            self._watchers.remove(fn)
+
+
+    def publish(self, msg, timeout=None):
+        '''
+        append msg to the output. returns True
+        - with timeout, it gives up after that many seconds while a blocking reader holds it back, and returns False.
+          nothing was published then - call it again with the same msg
+        - without, it waits - at most until the reader holding it back is switched to drop-oldest (STALL_TIMEOUT)
+        '''
+        data = msg.encode(errors='replace') if isinstance(msg, str) else bytes(msg)
+        if not data:
+            return True
+        with self._publish_lock:
+            with self._cond:
+                if self.closed:
+                    return True
+                if not self._wait_room(len(data), timeout):
+                    return False
+                self._offsets.append(self.end)
+                self._chunks.append(data)
+                self.end += len(data)
+                self._trim()
+                self._cond.notify_all()
+            for fn in list(self._listeners):
+                fn(data)
+            for fn in list(self._watchers):
+                fn()
+        return True
+
+
+    def _wait_room(self, n, timeout):
+        '''wait until n more bytes can be published, or timeout seconds. False if it timed out. caller holds the lock'''
+        if not self._blocked_by(n):
+            self._stalled_since = None
+            return True
+        now = time.monotonic()
+        if self._stalled_since is None:
+            self._stalled_since = now
+        give_up = now + timeout if timeout is not None else None
+        while self._blocked_by(n):
+            stall_end = self._stalled_since + self.STALL_TIMEOUT
+            if now >= stall_end:
+                self._unblock(n)
+                break
+            if give_up is not None and now >= give_up:
+                return False
+            self._cond.wait(min(stall_end, give_up) - now if give_up is not None else stall_end - now)
+            now = time.monotonic()
+        self._stalled_since = None
+        return True
+
+
+    def _unblock(self, n):
+        '''switch the blocking readers that keep n more bytes out to drop-oldest. caller holds the lock'''
+        for r in self._readers:
+            if r.overflow == 'block' and self.end + n - r.cursor > self.max_buffer:
+                r.overflow = 'drop-oldest'
+
+
+    def _blocked_by(self, n):
+        '''true while publishing n more bytes would push a blocking reader out of the buffer'''
+        cursors = [r.cursor for r in self._readers if r.overflow == 'block']
+        return bool(cursors) and self.end + n - min(cursors) > self.max_buffer and min(cursors) < self.end
+
+
+    def _trim(self):
+        keep_from = min((r.cursor for r in self._readers if r.overflow == 'block'), default=self.end)
+        while self._head < len(self._chunks) and self.end - self.base > self.max_buffer:
+            chunk_end = self._offsets[self._head] + len(self._chunks[self._head])
+            if chunk_end > keep_from:
+                break
+            self._chunks[self._head] = None
+            self._head += 1
+            self.base = chunk_end
+
+        if self._head > 1024 and self._head * 2 > len(self._chunks):
+            del self._offsets[:self._head]
+            del self._chunks[:self._head]
+            self._head = 0
+
+
+    def read(self, offset, limit):
+        '''bytes from the memory buffer starting at offset, up to about limit. None if offset was already trimmed. caller holds the lock'''
+        if offset < self.base:
+            return None
+        if offset >= self.end:
+            return b''
+        i = max(self._head, bisect.bisect_right(self._offsets, offset, lo=self._head) - 1)
+        parts = []
+        n = 0
+        while i < len(self._chunks) and n < limit:
+            chunk = self._chunks[i]
+            skip = offset + n - self._offsets[i]
+            parts.append(chunk[skip:] if skip else chunk)
+            n += len(parts[-1])
+            i += 1
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        _unregister(self)
+        for fn in list(self._watchers):
+            fn()
+
+
+
+class OutputStream:
+    '''
+    reader of a RunChannel with its own cursor. iterating yields bytes until the channel is closed and drained
+    - chunks are coalesced up to CHUNK_SIZE bytes or CHUNK_INTERVAL seconds
+    - the reader detaches when iteration stops, so a dead client never holds back the run
+    '''
+    CHUNK_SIZE = 64 * 1024
+    CHUNK_INTERVAL = 0.1
+    OVERFLOW = 'block'
+
+    def __init__(self, channel, offset=0, overflow=None, chunk_size=None, chunk_interval=None):
+        self.channel = channel
+        self.cursor = offset
+        self.overflow = overflow or self.OVERFLOW
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise Exception(f"Unknown overflow policy '{self.overflow}'. Expected one of {OVERFLOW_POLICIES}")
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.chunk_interval = chunk_interval or self.CHUNK_INTERVAL
+        with channel._cond:
+            channel._readers.add(self)
+
+
+    def detach(self):
+        ch = self.channel
+        with ch._cond:
+            ch._readers.discard(self)
+            ch._cond.notify_all() # may unblock the publisher
+
+
+    def _read_log(self, until):
+        '''bytes from cursor towards until, read from the run log - for readers behind the memory buffer'''
+        start, _, chunks = runlog.read_range(self.channel.log_dir, self.channel.run_id, offset=self.cursor)
+        data = bytearray()
+        try:
+            for chunk in chunks:
+                data += chunk
+                if start + len(data) >= until or len(data) >= self.chunk_size:
+                    break
+        finally:
+            chunks.close()
+        if not data: # no log to catch up from
+            start = until
+        marker = b''
+        if start != self.cursor: # rotated out of the log as well
+            marker = f"\n[... {start - self.cursor} bytes dropped ...]\n".encode()
+        self.cursor = start + len(data)
+        return marker + bytes(data)
+
+
+    def __iter__(self):
+        ch = self.channel
+        try:
+            while True:
+                with ch._cond:
+                    deadline = time.monotonic() + self.chunk_interval
+                    while not ch.closed and ch.end - self.cursor < self.chunk_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        ch._cond.wait(remaining)
+
+                    done = ch.closed and self.cursor >= ch.end
+                    behind = self.cursor < ch.base
+                    marker = b''
+                    if behind and self.overflow == 'drop-oldest':
+                        marker = f"\n[... {ch.base - self.cursor} bytes dropped - output is in the run log ...]\n".encode()
+                        self.cursor = ch.base
+                        behind = False
+                    data = ch.read(self.cursor, self.chunk_size) if not behind else None
+                    if data:
+                        self.cursor += len(data)
+                        ch._cond.notify_all() # a blocked publisher may have room now
+                    base = ch.base
+
+                if data is None: # behind the memory buffer - catch up from disk
+                    data = self._read_log(base)
+                if marker or data:
+                    yield marker + data if marker else data
+                elif done:
+                    break
+        finally:
+            self.detach()
+
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# channels of runs in progress, by run id
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+_CHANNELS = {}
+_CHANNELS_LOCK = threading.Lock()
+
+def open_channel(run_id, log_dir=None):
+    with _CHANNELS_LOCK:
+        if run_id in _CHANNELS:
+            raise Exception(f"Run {run_id} is already publishing")
+        ch = _CHANNELS[run_id] = RunChannel(run_id, log_dir=log_dir)
+        return ch
+
+def get_channel(run_id):
+    '''channel of a run in progress, or None'''
+    return _CHANNELS.get(run_id)
+
+def _unregister(ch):
+    with _CHANNELS_LOCK:
+        if _CHANNELS.get(ch.run_id) is ch:
+            del _CHANNELS[ch.run_id]
@@ -0,0 +1,201 @@
+'''
+cached project file trees - what /project/<hash>/tree returns
+
+each project's tree is scanned once with os.scandir and kept in memory, one node per
+directory with the mtime it had when it was listed. a directory's mtime changes whenever an
+entry is added, removed or renamed in it, so on the next request only the directories whose
+mtime moved are listed again - a stat per directory instead of a walk of every entry.
+
+an mtime is only as fine as the filesystem's clock tick, so a directory listed within
+RACY_NS of its last change could change again without its mtime moving. such a directory
+is listed again on every request until its change is older than that.
+
+the FS operations of Project re-list the directory they changed right away (refresh()),
+and every version of the tree has an etag, so an unchanged tree can be answered with a 304.
+'''
+import os
+import re
+import json
+import fnmatch
+import hashlib
+import threading
+import time
+
+
+RACY_NS = 2 * 10**9
+
+
+
+class _Dir:
+    '''a listed directory: names of its files, and its subdirectories by name'''
+    __slots__ = ('mtime_ns', 'listed_ns', 'files', 'dirs')
+
+    def __init__(self):
+        self.mtime_ns = None # not listed yet
+        self.listed_ns = 0
+        self.files = []
+        self.dirs = {}
+
+
+
+class ProjectTree:
+    '''
+    file tree of one project folder
+    - ignores: fnmatch patterns of names left out, like FS_IGNORES. hidden names are always left out
+    - languages: file extension -> editor language
+    '''
+
+    def __init__(self, src_path, ignores=(), languages=None):
+        self.src_path = src_path
+        self.languages = languages or {}
+        self._ignore = re.compile('|'.join(fnmatch.translate(pat) for pat in ignores) or '(?!)')
+        self._root = _Dir()
+        self._lock = threading.Lock()
+        self._changes = 0 # listings that came out different - the rendered tree is rebuilt when it moves
+        self._rendered = (None, None, None) # (changes, children of the root, etag)
+
+
+    def ignored(self, name):
+        return name.startswith('.') or self._ignore.match(name) is not None
+
+
+    def get(self):
+        '''(list of the root's children - see file_dict() and folder_dict(), etag). only lists the directories that changed'''
+        with self._lock:
+            self._check(self._root, self.src_path, time.time_ns())
+            changes, children, etag = self._rendered
+            if changes != self._changes:
+                children = self._render(self._root, '')
+                etag = hashlib.blake2b(json.dumps(children).encode(), digest_size=16).hexdigest()
+                self._rendered = (self._changes, children, etag)
+            return children, etag
+
+
+    def children(self, rel_path):
+        '''list of the children of a directory, relative to src_path'''
+        with self._lock:
+            node = self._node(rel_path)
+            if node is None:
+                return []
+            self._check(node, os.path.join(self.src_path, rel_path), time.time_ns())
+            return self._render(node, rel_path)
+
+
+    def refresh(self, rel_path):
+        '''list a directory again, after it was changed - the rest of the tree is kept'''
+        with self._lock:
+            node = self._node(rel_path)
+            if node is not None:
+                self._list(node, os.path.join(self.src_path, rel_path), time.time_ns())
+
+
+    def file_dict(self, rel_path):
+        '''
+        returns a dictionary describing a file with keys:
+            name:str, type:str, path:str, language:str, selected:bool
+        '''
+        name = os.path.basename(rel_path)
+        return {
+            'name': name,
+            'type': 'file',
+            'path': rel_path,
+            'language': self.languages.get(os.path.splitext(name)[-1], ''),
+            'selected': (name == "main.py"),
+        }
+
+
+    def folder_dict(self, rel_path):
+        '''
+        returns a dictionary describing a folder with keys:
+            name:str, type:str, path:str, open:bool, children:list
+        '''
+        return {
+            'name': os.path.basename(rel_path),
+            'type': 'folder',
+            'path': rel_path,
+            'open': True,
+            'children': self.children(rel_path),
+        }
+
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+    # caller holds the lock
+    # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+    def _node(self, rel_path):
+        node = self._root
+        for part in os.path.normpath(rel_path).split(os.sep):
+            if part in ('', '.'):
+                continue
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+
+    def _check(self, node, path, now):
+        '''list node again if its directory changed since it was, then its subdirectories'''
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError: # removed - its parent's listing drops it
+            return
+        if mtime_ns != node.mtime_ns or node.listed_ns - node.mtime_ns < RACY_NS:
+            self._list(node, path, now)
+        for name, child in node.dirs.items():
+            self._check(child, os.path.join(path, name), now)
+
+
+    def _list(self, node, path, now):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns # before listing - a change while listing leaves a newer mtime
+            files, dirs = [], {}
+            with os.scandir(path) as it:
+                for entry in it:
+                    if self.ignored(entry.name):
+                        continue
+                    if entry.is_file():
+                        files.append(entry.name)
+                    elif entry.is_dir():
+                        dirs[entry.name] = node.dirs.get(entry.name) or _Dir()
+        except OSError:
+            mtime_ns, files, dirs = None, [], {}
+        files.sort()
+        if files != node.files or dirs.keys() != node.dirs.keys():
+            self._changes += 1
+        node.mtime_ns, node.listed_ns = mtime_ns, now
+        node.files, node.dirs = files, dict(sorted(dirs.items()))
+
+
+    def _render(self, node, rel_path):
+        out = []
+        for name in sorted(list(node.files) + list(node.dirs)):
+            path = os.path.join(rel_path, name)
+            child = node.dirs.get(name)
+            if child is None:
+                out.append(self.file_dict(path))
+            else:
+                out.append({
+                    'name': name,
+                    'type': 'folder',
+                    'path': path,
+                    'open': True, # open by default??
+                    'children': self._render(child, path),
+                })
+        return out
+
+
+
+_TREES = {}
+_TREES_LOCK = threading.Lock()
+
+def get_tree(src_path, ignores=(), languages=None) -> ProjectTree:
+    '''one shared ProjectTree per project folder'''
+    with _TREES_LOCK:
+        if src_path not in _TREES:
+            _TREES[src_path] = ProjectTree(src_path, ignores, languages)
+        return _TREES[src_path]
+
+
+def drop_tree(src_path):
+    '''forget the tree of a project folder that was deleted or renamed'''
+    with _TREES_LOCK:
+        _TREES.pop(src_path, None)
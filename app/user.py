@@ -3,8 +3,9 @@ import hashlib
 from datetime import datetime as dt
 from typing import List
 
-from .base import DB
+from .base import DB, dict_factory
 from .project import Project
+from . import queries
 
 
 
@@ -20,7 +21,7 @@ class User(DB):
         super().__init__(db_path)
         if not User.email_format_ok(email):
             raise Exception("Invalid email")
-        u = self.execute(f'''SELECT * FROM users WHERE email = '{email}' ''', fetch_one=True)
+        u = self.execute(queries.USER_BY_EMAIL, {'email': email}, fetch_one=True)
         if u is None:
             raise LoginError("Incorrect credentials")
 
@@ -61,26 +62,13 @@ class User(DB):
 
     def get_projects_dict(self):
         self.check_logged_in() # ensure user is logged in
-        projs = self.execute(f'''
-        SELECT p.*,
-        count(ep.id) AS entry_points,
-        count(sch.id) AS schedules,
-        sum(sch.is_scheduled) AS schedules_enabled
-        FROM projects p
-        LEFT JOIN entry_points ep
-            ON ep.project_id = p.id
-        LEFT JOIN schedule sch
-            ON sch.ep_id = ep.id
-        WHERE p.user_id = {self.user_id}
-        GROUP BY p.id
-        ''')
-        return [proj._asdict() for proj in projs]
+        return self.execute(queries.USER_PROJECTS_SUMMARY, {'user_id': self.user_id}, row_factory=dict_factory)
 
 
     def get_all_projects(self) -> List[Project]:
         self.check_logged_in() # ensure user is logged in
         projects = []
-        res = self.execute(f'''SELECT * FROM projects WHERE user_id = {self.user_id}''')
+        res = self.execute(queries.USER_PROJECTS, {'user_id': self.user_id})
         for r in res:
             if r.id is None:
                 continue
@@ -90,15 +78,13 @@ class User(DB):
 
 
     def project_exists(self, name_hash):
-        res = self.execute(f'''
-            SELECT id FROM projects WHERE user_id = {self.user_id} AND name_hash = '{name_hash}'
-        ''', fetch_one=True)
+        res = self.execute(queries.PROJECT_BY_HASH, {'user_id': self.user_id, 'name_hash': name_hash}, fetch_one=True)
         return res is not None
 
 
     def get_project(self, name_hash):
         self.check_logged_in() # ensure user is logged in
-        res = self.execute(f'''SELECT id, name, descr FROM projects WHERE user_id = {self.user_id} AND name_hash = '{name_hash}' ''', fetch_one=True)
+        res = self.execute(queries.PROJECT_BY_HASH, {'user_id': self.user_id, 'name_hash': name_hash}, fetch_one=True)
         if res is None:
             raise Exception("Project not found")
         return Project(self.workspace_path, self.db_path, self, res.id, res.name, name_hash, res.descr)
@@ -115,16 +101,13 @@ class User(DB):
         if self.project_exists(name_hash):
             raise Exception("Project already exists")
 
-        descr = descr.replace("'", "''")
-        self.execute(f'''
-            INSERT INTO projects (
-                user_id, name, name_hash, descr, create_dt
-            )
-            VALUES (
-                '{self.user_id}', '{name}', '{name_hash}', '{descr}',
-                '{dt.now().strftime('%Y-%m-%d %H:%M:%S')}'
-            );
-        ''')
+        self.execute(queries.INSERT_PROJECT, {
+            'user_id': self.user_id,
+            'name': name,
+            'name_hash': name_hash,
+            'descr': descr,
+            'create_dt': dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+        })
 
         P = self.get_project(name_hash)
         P.create_default_files() # only create default files the first time a project is created
@@ -0,0 +1,380 @@
+'''
+run worker process - executes project entry points outside the server process
+
+started by executor.RunExecutor as `python app/worker.py <recv_fd> <send_fd>` - as a script, not a
+module of the app package, so the worker doesn't import the server (flask_production, the
+scheduler, the executor, the db) before any user code runs. it only needs capture.py.
+the worker stays warm between runs and handles one run at a time, so changes to
+cwd, sys.path and sys.modules made for a run never leak into the server or other runs.
+SIGINT stops the current run with a KeyboardInterrupt and is ignored between runs.
+one that arrives while the run's thread is writing a message is held until the message
+is written - a message cut short would leave the pipe unreadable.
+
+project modules are dropped from sys.modules after every run, so the next one imports
+them from scratch - unless the task is 'warm' (see _WarmCache): then they are set aside
+and put back for the project's next warm run, minus the ones whose source changed.
+
+messages sent back to the server:
+    ('out', str)    captured stdout of the run
+    ('done', dict)  end of run - {'ok': bool, 'error': traceback str or None, 'usage': dict (see _RunUsage)}
+'''
+import os, sys
+import asyncio
+import cProfile
+import inspect
+import signal
+import hashlib
+import importlib
+import functools
+import resource
+import time
+import types
+import traceback
+import tracemalloc
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+
+try:
+    from .capture import print_capture
+except ImportError: # started as a script, see above
+    from capture import print_capture
+    del sys.modules['capture'] # the name is free for a project's own module - runs replace sys.path[0], this folder
+
+
+
+def _format_user_traceback(e):
+    '''traceback of e without the worker's own frames'''
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename == __file__:
+        tb = tb.tb_next
+    return ''.join(traceback.format_exception(type(e), e, tb))
+
+
+
+def _reset_peak_rss():
+    '''start a new peak RSS (VmHWM) for the next run. linux only - see clear_refs in proc(5)'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss(since_reset):
+    '''peak resident set size in bytes - of the run if the peak could be reset, else of the worker's lifetime'''
+    if since_reset:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on linux
+
+
+
+class _RunUsage:
+    '''
+    resources used by one run: cpu time, peak memory and - with trace_alloc - where its memory went
+    - top_allocs are the biggest allocations from project files still held when the run ended
+    '''
+    TOP_ALLOCS = 10
+
+    def __init__(self, trace_alloc=False):
+        self.trace_alloc = trace_alloc
+        self._top_allocs = None
+        self._traced_peak = None
+        self.imports = {} # import time of the entry point, and what warm modules saved - see _Worker._run
+
+
+    def start(self):
+        self._peak_reset = _reset_peak_rss()
+        self._ru = resource.getrusage(resource.RUSAGE_SELF)
+        if self.trace_alloc:
+            tracemalloc.start()
+
+
+    def snapshot(self, src_path):
+        '''take the top allocations - before the project's modules are dropped'''
+        if not tracemalloc.is_tracing():
+            return
+        snap = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, os.path.join(src_path, '*'))])
+        self._traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self._top_allocs = [{
+            'file': os.path.relpath(s.traceback[0].filename, src_path),
+            'line': s.traceback[0].lineno,
+            'size': s.size,
+            'count': s.count,
+        } for s in snap.statistics('lineno')[:self.TOP_ALLOCS]]
+
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'cpu_user': ru.ru_utime - self._ru.ru_utime,
+            'cpu_system': ru.ru_stime - self._ru.ru_stime,
+            'peak_rss': _peak_rss(self._peak_reset),
+            'traced_peak': self._traced_peak,
+            'top_allocs': self._top_allocs,
+            **self.imports,
+        }
+
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+_real_path = functools.lru_cache(maxsize=4096)(os.path.realpath) # a module's file is resolved once, not on every run
+
+
+def _project_modules(src_path):
+    '''names of the modules in sys.modules loaded from under src_path'''
+    prefix = os.path.join(_real_path(src_path), '')
+    return [
+        name for name, mod in list(sys.modules.items())
+        if getattr(mod, '__file__', None) is not None and _real_path(mod.__file__).startswith(prefix)
+    ]
+
+
+
+class _WarmCache:
+    '''
+    project modules kept loaded between warm runs - for the last MAX_PROJECTS projects
+
+    when a warm run starts, its project's modules go back into sys.modules, except the ones
+    whose source file changed since they were imported (mtime and size, then sha1 - a file
+    saved without changes keeps its module) and the modules that refer to those. they are
+    imported again by the run. when it ends they are all set aside again, out of sys.modules.
+
+    module level state persists between warm runs, like in a long running process.
+    a module is taken to refer to another if one of its globals is that module or was defined
+    in it (import x, from x import f). a plain value (from x import LIMIT) isn't tracked
+    '''
+    MAX_PROJECTS = 4
+
+    def __init__(self):
+        self._projects = OrderedDict() # src_path -> {'modules': {name: module}, 'stamps': {name: (stamp, sha1)}, 'cold_import': seconds}
+
+
+    def restore(self, src_path):
+        '''put the project's still valid modules back in sys.modules. returns (n modules reused, cold import time or None)'''
+        entry = self._projects.get(src_path)
+        if entry is None:
+            return 0, None
+        self._projects.move_to_end(src_path)
+        modules, stamps = entry['modules'], entry['stamps']
+
+        changed = set()
+        for name, mod in modules.items():
+            path = mod.__file__
+            try:
+                stamp = _file_stamp(path)
+                if stamp != stamps[name][0]:
+                    sha1 = _file_hash(path)
+                    if sha1 != stamps[name][1]:
+                        changed.add(name)
+                    else:
+                        stamps[name] = (stamp, sha1) # touched, not changed
+            except OSError: # deleted
+                changed.add(name)
+
+        if changed:
+            importers = {} # name -> modules that refer to it
+            for name, mod in modules.items():
+                for value in list(vars(mod).values()):
+                    ref = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, '__module__', None)
+                    if ref in modules and ref != name:
+                        importers.setdefault(ref, set()).add(name)
+            stack = list(changed)
+            while stack:
+                for name in importers.get(stack.pop(), ()):
+                    if name not in changed:
+                        changed.add(name)
+                        stack.append(name)
+            for name in changed:
+                del modules[name]
+                del stamps[name]
+            importlib.invalidate_caches()
+
+        sys.modules.update(modules)
+        return len(modules), entry['cold_import']
+
+
+    def set_aside(self, src_path, import_time=None):
+        '''take the project's modules out of sys.modules and keep them for its next warm run'''
+        entry = self._projects.setdefault(src_path, {'modules': {}, 'stamps': {}, 'cold_import': None})
+        self._projects.move_to_end(src_path)
+        if import_time is not None:
+            entry['cold_import'] = import_time
+        for name in _project_modules(src_path):
+            mod = sys.modules.pop(name)
+            if name not in entry['stamps'] or entry['modules'].get(name) is not mod:
+                try:
+                    entry['stamps'][name] = (_file_stamp(mod.__file__), _file_hash(mod.__file__))
+                except OSError:
+                    continue
+            entry['modules'][name] = mod
+        while len(self._projects) > self.MAX_PROJECTS:
+            self._projects.popitem(last=False)
+
+
+
+class _Worker:
+
+    def __init__(self, recv_fd, send_fd):
+        self._recv = Connection(recv_fd, writable=False)
+        self._send = Connection(send_fd, readable=False)
+        self._send_lock = threading.Lock()
+        self._base_dir = os.getcwd()
+        self._base_syspath = sys.path.copy()
+        self._running = False
+        self._sending = False # the main thread is writing a message - see _interrupt
+        self._interrupted = False
+        self._usage = None
+        self._warm = _WarmCache()
+        signal.signal(signal.SIGINT, self._interrupt)
+
+
+    def _interrupt(self, signum, frame):
+        if not self._running: # a stop that arrives after the run ended is dropped
+            return
+        if self._sending: # raised by send() once the message is written
+            self._interrupted = True
+            return
+        raise KeyboardInterrupt()
+
+
+    def send(self, kind, payload):
+        # signal handlers run in the main thread - only its sends can be cut short by a stop
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            self._sending = True
+        try:
+            with self._send_lock:
+                self._send.send((kind, payload))
+        finally:
+            if main:
+                self._sending = False
+        if main and self._interrupted:
+            self._interrupted = False
+            if self._running:
+                raise KeyboardInterrupt()
+
+
+    def serve(self):
+        while True:
+            try:
+                task = self._recv.recv()
+            except (EOFError, OSError): # server went away
+                break
+            with print_capture(lambda msg: self.send('out', msg)):
+                result = self.run_task(task)
+            self.send('done', result)
+
+
+    def run_task(self, task):
+        self._usage = _RunUsage(trace_alloc=task.get('trace_alloc', False))
+        self._usage.start()
+        try:
+            self._run(task)
+            return {'ok': True, 'error': None, 'usage': self._usage.stop()}
+        except BaseException as e:
+            return {'ok': False, 'error': _format_user_traceback(e), 'usage': self._usage.stop()}
+
+
+    def _run(self, task):
+        src_path = task['src_path']
+
+        # caution: path[0] is reserved for script path (or '' in REPL)
+        sys.path[:] = self._base_syspath
+        sys.path[0] = src_path
+        os.chdir(src_path)
+
+        warm = task.get('warm', False)
+        reused, cold_import = self._warm.restore(src_path) if warm else (0, None)
+        import_time = None
+
+        self._interrupted = False
+        self._running = True
+        try:
+            print(f"> {task['file']}::{task['func']}")
+            main_file = os.path.realpath(task['file'])
+            main_function = task['func']
+
+            if not os.path.isfile(main_file):
+                raise FileNotFoundError(f"{main_file} file not found")
+
+            main_path = os.path.dirname(main_file)
+            main_file = os.path.splitext(os.path.basename(main_file))[0]
+            if main_path not in sys.path: # if main_file is in a subfolder, it should be added to sys.path for import to work
+                sys.path.insert(0, main_path)
+
+            start = time.perf_counter()
+            module = importlib.import_module(main_file)
+            import_time = time.perf_counter() - start
+            self._usage.imports = {'import_time': import_time}
+            if reused:
+                saved = max(0.0, cold_import - import_time) if cold_import is not None else None
+                self._usage.imports['import_saved'] = saved
+                print(f"> imported {module.__name__} from {task['label']} - warm, {reused} modules reused" + (f", {saved:.3f}s saved\n" if saved is not None else "\n"))
+            else:
+                print(f"> imported {module.__name__} from {task['label']}\n")
+            runner = self._entry_point(getattr(module, main_function))
+            if task.get('profile_path'):
+                self._profile(runner, task['profile_path'])
+            else:
+                runner()
+            print("\n> done")
+
+        finally:
+            self._running = False # the clean up isn't interrupted
+            self._usage.snapshot(src_path)
+            sys.path[:] = self._base_syspath
+            os.chdir(self._base_dir)
+            if warm:
+                self._warm.set_aside(src_path, import_time=None if reused else import_time)
+            else:
+                self._purge_modules(src_path)
+
+
+    def _entry_point(self, func):
+        '''func, made to also run async defs (or decorated ones returning a coroutine) to completion in a new event loop'''
+        def runner():
+            res = func()
+            if inspect.iscoroutine(res):
+                asyncio.run(res)
+        return runner
+
+
+    def _profile(self, runner, path):
+        '''call runner under cProfile and dump the stats to path - also if it raises'''
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(runner)
+        finally:
+            profiler.dump_stats(path)
+
+
+    def _purge_modules(self, src_path):
+        '''drop modules imported from the project so the next run picks up any changes'''
+        print("> clean up sys.modules")
+        for mod_name in _project_modules(src_path):
+            del sys.modules[mod_name]
+
+
+
+if __name__ == '__main__':
+    _Worker(int(sys.argv[1]), int(sys.argv[2])).serve()
@@ -0,0 +1,131 @@
+'''
+benchmark - print() throughput under app.capture.print_capture
+
+compares the capture engine with the original _pyio based one (kept below for reference)
+on jobs that print n_lines short lines, one long line written in pieces, and chunks
+with newlines in the middle. the output is sent over a pipe, the way app.worker streams it
+
+usage: python benchmarks/capture_throughput.py [n_lines]
+'''
+import os, sys
+import _pyio
+import threading
+import time
+from multiprocessing import Pipe
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.capture import print_capture
+
+
+
+class _LegacyProxy(_pyio.TextIOWrapper):
+    '''the original stdout proxy - pure python TextIOWrapper with a thread-local buffer'''
+    def __init__(self, *args, **kwargs):
+        self._local_objects = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def buffer(self):
+        buf = getattr(self._local_objects, 'buffer', None)
+        return buf if buf is not None else self._buffer
+
+    def close(self):
+        pass # never close the real stdout
+
+
+class _LegacyPrintCapture(_pyio.BytesIO):
+    '''the original capture - bytes concatenation, flushes only on chunks ending with a newline'''
+    def __init__(self, callback):
+        self._buf = b''
+        self._write_cb = callback
+
+    def write(self, b):
+        self._buf += b
+        if b.endswith(b'\n'):
+            self._write_cb(self._buf.decode(errors='ignore'))
+            self._buf = b''
+
+
+class legacy_print_capture:
+    def __init__(self, callback):
+        self._capture = _LegacyPrintCapture(callback)
+
+    def __enter__(self):
+        self._original = sys.stdout
+        self._proxy = _LegacyProxy(self._original.buffer, 'utf-8', 'strict', None, True)
+        self._proxy._local_objects.buffer = self._capture
+        sys.stdout = self._proxy
+
+    def __exit__(self, *args):
+        self._proxy._local_objects.buffer = None
+        sys.stdout = self._original
+
+
+
+def short_lines(n):
+    for i in range(n):
+        print("line", i)
+
+
+def long_line(n):
+    '''one line built from n small writes, newline at the very end'''
+    for i in range(n):
+        print("x", end='')
+    print()
+
+
+def mixed_chunks(n):
+    '''writes that contain newlines but don't end with one'''
+    for i in range(n):
+        sys.stdout.write(f"{i}\n{i}")
+    print()
+
+
+SCENARIOS = {
+    'short lines': short_lines,
+    'long line': long_line,
+    'mixed chunks': mixed_chunks,
+}
+
+QUADRATIC_ON_LEGACY = ('long line', 'mixed chunks') # partial lines are concatenated and never flushed
+
+ENGINES = {
+    'legacy (_pyio)': legacy_print_capture,
+    'print_capture': print_capture,
+}
+
+
+def measure(engine, job, n):
+    '''run job under engine, sending every callback over a pipe like app.worker does'''
+    recv, send = Pipe(duplex=False)
+    stats = {'calls': 0, 'chars': 0}
+    def _drain():
+        while True:
+            msg = recv.recv()
+            if msg is None:
+                break
+            stats['calls'] += 1
+            stats['chars'] += len(msg)
+    reader = threading.Thread(target=_drain)
+    reader.start()
+
+    start = time.perf_counter()
+    with engine(send.send):
+        job(n)
+    send.send(None)
+    reader.join()
+    return time.perf_counter() - start, stats
+
+
+if __name__ == '__main__':
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    for scenario, job in SCENARIOS.items():
+        print(scenario)
+        for name, engine in ENGINES.items():
+            n = n_lines
+            if engine is legacy_print_capture and scenario in QUADRATIC_ON_LEGACY:
+                n = min(n, 20000) # keep it small enough to finish
+            elapsed, stats = measure(engine, job, n)
+            print(f"    {name:16} n={n:<9} {elapsed:8.3f} s  {n/elapsed:12,.0f} writes/s  {stats['calls']:9} callbacks  {stats['chars']:11} chars")
@@ -0,0 +1,64 @@
+'''
+microbenchmark - sqlite row factories on a 10k row result set
+
+usage: python benchmarks/row_factories.py [n_rows] [repeat]
+'''
+import os, sys
+import sqlite3
+import timeit
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.base import namedtuple_factory, dict_factory
+
+
+def uncached_namedtuple_factory(cursor, row):
+    '''the original factory - builds a new class for every row'''
+    fields = [col[0] for col in cursor.description]
+    Row = namedtuple("Row", fields)
+    return Row(*row)
+
+
+FACTORIES = {
+    'namedtuple (uncached)': uncached_namedtuple_factory,
+    'namedtuple (cached)': namedtuple_factory,
+    'dict': dict_factory,
+    'sqlite3.Row': sqlite3.Row,
+    'tuple': None,
+}
+
+
+def setup(n_rows):
+    conn = sqlite3.connect(":memory:")
+    conn.execute('''
+        CREATE TABLE schedule (
+            id INTEGER PRIMARY KEY, ep_id INTEGER, every TEXT, at TEXT,
+            tzname TEXT, is_scheduled INTEGER, create_dt TEXT
+        )
+    ''')
+    conn.executemany(
+        '''INSERT INTO schedule (ep_id, every, at, tzname, is_scheduled, create_dt) VALUES (?, ?, ?, ?, ?, ?)''',
+        ((i % 500, 'weekday', '09:30', 'UTC', i % 2, '2022-01-01 00:00:00') for i in range(n_rows))
+    )
+    return conn
+
+
+def fetch_all(conn, factory):
+    cur = conn.cursor()
+    cur.row_factory = factory
+    cur.execute('''SELECT * FROM schedule''')
+    return cur.fetchall()
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    conn = setup(n_rows)
+
+    print(f"{n_rows} rows, best of {repeat}")
+    baseline = None
+    for name, factory in FACTORIES.items():
+        best = min(timeit.repeat(lambda: fetch_all(conn, factory), number=1, repeat=repeat))
+        baseline = baseline or best
+        print(f"{name:24} {best*1000:9.2f} ms   {baseline/best:6.1f}x")
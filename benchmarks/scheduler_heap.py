@@ -0,0 +1,89 @@
+'''
+benchmark - idle cost and dispatch latency of app.sched.SS_Scheduler
+
+registers n daily schedules that aren't due for hours, plus a few repeating jobs that
+fire every second. then, for the heap-based SS_Scheduler loop and for flask_production's
+polling TaskScheduler loop (check_interval=1, scanning the same jobs), measures
+    - cpu time used by the scheduler thread while nothing but the repeating jobs is due
+    - dispatch latency: how late each repeating job is started after its fire time
+
+usage: python benchmarks/scheduler_heap.py [n_schedules] [seconds]
+'''
+import os, sys
+import io
+import contextlib
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_production import TaskScheduler
+from app.sched import SS_Scheduler
+
+
+N_REPEATING = 5
+
+
+
+def noop():
+    pass
+
+
+def build(n):
+    '''a scheduler with n idle daily schedules and N_REPEATING repeating ones that record their lag'''
+    sched = SS_Scheduler()
+    lags = []
+    idle_at = (datetime.utcnow() + timedelta(hours=3)).strftime('%H:%M')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(n):
+            sched.add_job(i, 'day', idle_at, 'UTC', noop, enabled=True)
+        for i in range(N_REPEATING):
+            sched_id = f'repeat-{i}'
+            def fire(sched_id=sched_id):
+                lags.append(time.time() - sched.get_job(sched_id).next_timestamp)
+            sched.add_job(sched_id, 1, None, 'UTC', fire, enabled=True)
+            sched.get_job(sched_id).silently() # no start/end banners
+    return sched, lags
+
+
+def measure(loop, stop, lags, seconds):
+    '''run loop in a thread for a while. returns (cpu seconds per second, lags)'''
+    lags.clear()
+    t = threading.Thread(target=loop, daemon=True)
+    cpu = time.process_time()
+    t.start()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    stop()
+    t.join()
+    return cpu / seconds, sorted(lags)
+
+
+def report(name, cpu, lags):
+    p50 = lags[len(lags) // 2] * 1000 if lags else float('nan')
+    worst = lags[-1] * 1000 if lags else float('nan')
+    print(f"    {name:28} cpu {cpu * 100:6.2f} %   dispatches {len(lags):4}   lag p50 {p50:8.1f} ms   max {worst:8.1f} ms")
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    start = time.perf_counter()
+    sched, lags = build(n)
+    print(f"registered {n + N_REPEATING} schedules in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    TaskScheduler.check(sched) # the polling scheduler's tick - one is_due() per job
+    print(f"one polling scan of all jobs: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    cpu, heap = measure(sched.start, sched.stop, lags, seconds)
+    report('heap SS_Scheduler', cpu, heap)
+
+    polling = TaskScheduler(persist_states=False, check_interval=1)
+    polling.jobs = sched.jobs
+    for i in range(N_REPEATING):
+        sched.get_job(f'repeat-{i}').schedule_next_run() # start from now, like the heap run did
+    cpu, polled = measure(polling.start, polling.stop, lags, seconds)
+    report('polling TaskScheduler', cpu, polled)
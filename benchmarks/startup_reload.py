@@ -0,0 +1,128 @@
+'''
+benchmark - startup cost of SelfSchedulerDB._reload_jobs
+
+fills a fresh inventory.db with n_users users, one project each, and n_schedules enabled
+schedules spread over their entry points. then times registering every schedule with
+    - the original reload: User per email, get_all_projects per user, Project.reload_schedules per project (kept below for reference)
+    - SelfSchedulerDB._reload_jobs: one joined query, bulk add_jobs, projects built when a job fires
+
+usage: python benchmarks/startup_reload.py [n_users] [n_schedules]
+'''
+import os, sys
+import io
+import contextlib
+import shutil
+import sqlite3
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app.main_db
+from app import migrations, queries
+from app.main_db import SelfSchedulerDB
+from app.sched import SS_Scheduler
+
+
+EPS_PER_PROJECT = 2
+TZNAMES = [None, 'UTC', 'US/Eastern', 'Europe/London']
+
+# queries of the original reload - the app doesn't use them any more
+ALL_USER_EMAILS = '''SELECT DISTINCT email FROM users'''
+
+PROJECT_SCHEDULE_JOBS = '''
+    SELECT
+    sched.id,
+    sched.ep_id,
+    sched.every,
+    sched.at,
+    sched.tzname,
+    sched.jitter,
+    sched.jitter_offset,
+    sched.is_scheduled
+    FROM entry_points ep
+    LEFT JOIN schedule sched
+        ON ep.id = sched.ep_id
+    WHERE ep.project_id = :project_id
+'''
+
+
+
+def fill(db_path, n_users, n_schedules):
+    conn = sqlite3.connect(db_path)
+    migrations.migrate(conn)
+    now = '2024-01-01 00:00:00'
+    conn.executemany('''INSERT INTO users (id, first_name, email, password, salt, create_dt) VALUES (?, 'u', ?, '', '', ?)''',
+        ((i, f'user{i}@example.com', now) for i in range(1, n_users + 1)))
+    conn.executemany('''INSERT INTO projects (id, user_id, name, name_hash, create_dt) VALUES (?, ?, ?, ?, ?)''',
+        ((i, i, f'p{i}', f'{i:032x}', now) for i in range(1, n_users + 1)))
+    n_eps = n_users * EPS_PER_PROJECT
+    conn.executemany('''INSERT INTO entry_points (id, project_id, file, func, create_dt) VALUES (?, ?, 'main.py', ?, ?)''',
+        ((i, (i - 1) // EPS_PER_PROJECT + 1, f'f{i}', now) for i in range(1, n_eps + 1)))
+    conn.executemany('''INSERT INTO schedule (ep_id, every, at, tzname, is_scheduled, create_dt) VALUES (?, 'day', ?, ?, 1, ?)''',
+        (((i % n_eps) + 1, f'{(i // n_eps) // 60 % 24:02}:{(i // n_eps) % 60:02}', TZNAMES[i % len(TZNAMES)], now) for i in range(n_schedules)))
+    conn.commit()
+    conn.close()
+
+
+def legacy_reload_schedules(project, sched):
+    '''the original Project.reload_schedules - one query and one add_job per schedule of a project'''
+    jobs = [j for j in project.execute(PROJECT_SCHEDULE_JOBS, {'project_id': project.project_id}) if j.id is not None]
+    offsets, new = sched.assign_offsets(jobs)
+    if new:
+        project.executemany(queries.SET_SCHEDULE_OFFSET, new)
+    for j in jobs:
+        sched.add_job(
+            sched_id=j.id,
+            every=j.every,
+            at=j.at,
+            tz=j.tzname,
+            func=lambda epid=j.ep_id, sched_id=j.id: project.blocking_run(epid, sched_id=sched_id), # bind now, not when the job fires
+            enabled=(True if j.is_scheduled else False),
+            offset=offsets.get(j.id, 0),
+        )
+
+
+def legacy_reload_jobs(db):
+    '''the original _reload_jobs - N+1 queries, a Project per project'''
+    res = db.execute(ALL_USER_EMAILS)
+    for r in res:
+        if r.email is None:
+            continue
+        u = db.get_user(r.email)
+        u.logged_in = True
+        for p in u.get_all_projects():
+            legacy_reload_schedules(p, app.main_db.ss_sched)
+
+
+def timed(reload, db):
+    sched = SS_Scheduler()
+    app.main_db.ss_sched = sched # both reload paths register into a fresh scheduler
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # the scheduler prints every job it registers
+        reload(db)
+    return time.perf_counter() - start, len(sched.jobs)
+
+
+if __name__ == '__main__':
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_schedules = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+    ws = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        fill(os.path.join(ws, 'inventory.db'), n_users, n_schedules)
+        print(f"filled inventory.db with {n_users} users and {n_schedules} schedules in {time.perf_counter() - start:.1f} s")
+
+        reload_jobs = SelfSchedulerDB._reload_jobs
+        SelfSchedulerDB._reload_jobs = lambda self: None # time the reload on its own, not as part of __init__
+        db = SelfSchedulerDB(ws)
+
+        for name, reload in (('original', legacy_reload_jobs), ('_reload_jobs', reload_jobs)):
+            stats = db.statement_cache_stats()
+            elapsed, n_jobs = timed(reload, db)
+            after = db.statement_cache_stats()
+            n_queries = after['statements'] - stats['statements']
+            print(f"    {name:14} {elapsed:8.2f} s   {n_jobs:7} jobs   {n_queries:7} queries")
+    finally:
+        shutil.rmtree(ws)
@@ -6,8 +6,11 @@ import argparse
 from flask import Flask, send_file, request, redirect, make_response, Response
 from itsdangerous import URLSafeSerializer
 
-from app import get_ss_db_object
+from app import get_ss_db_object, ss_executor, ss_sched
 from app.project import SUPPORTED_LANGUAGES
+from app.stream import OVERFLOW_POLICIES, configure as configure_streams
+from app.sse import RunEventServer
+from app import metrics
 
 
 CWD = os.path.dirname(os.path.abspath(__file__))
@@ -16,21 +19,62 @@ CWD = os.path.dirname(os.path.abspath(__file__))
 parser = argparse.ArgumentParser(__name__)
 parser.add_argument("--workspace-path", "-w", help="Path to workspace directory", type=str, default=None)
 parser.add_argument("--signup-enable", help="Run app with signup page enabled", action="store_true")
+parser.add_argument("--db-pool-size", help="Max number of pooled database connections", type=int, default=None)
+parser.add_argument("--db-statement-cache", help="Prepared statements cached per database connection", type=int, default=None)
+parser.add_argument("--run-workers", help="Number of worker processes that execute project runs", type=int, default=None)
+parser.add_argument("--run-user-limit", help="Max runs of one user executing at a time (0 for no limit)", type=int, default=None)
+parser.add_argument("--run-timeout", help="Seconds a run may take before it is stopped, for entry points without their own timeout (0 for no limit)", type=int, default=None)
+parser.add_argument("--run-trace-alloc", help="Record the top memory allocations of every run (slows runs down)", action="store_true")
+parser.add_argument("--sched-spread", help="Spread scheduled runs over this many seconds after their time, for schedules without their own jitter (0 to disable)", type=int, default=None)
+parser.add_argument("--stream-buffer", help="Max bytes of a run's output kept in memory for its viewers", type=int, default=None)
+parser.add_argument("--sse-port", help="Port of the server-sent events endpoint for live run output (0 to disable)", type=int, default=None)
+parser.add_argument("--metrics-enable", help="Serve scheduler metrics at /metrics, without login - keep it off where the app is public", action="store_true")
+parser.add_argument("--stream-overflow", help="What to do when a client falls behind", choices=OVERFLOW_POLICIES, default=None)
 args = parser.parse_args()
 
 
 WORKSPACE_PATH = args.workspace_path or os.environ.get('SS_WORKSPACE_PATH', 'projects')
 SIGNUP_ENABLED = args.signup_enable or os.environ.get('SS_SIGNUP_ENABLED') == '1'
+DB_POOL_SIZE = args.db_pool_size or int(os.environ.get('SS_DB_POOL_SIZE', 8))
+DB_STATEMENT_CACHE = args.db_statement_cache or int(os.environ.get('SS_DB_STATEMENT_CACHE', 128))
+RUN_WORKERS = args.run_workers or int(os.environ.get('SS_RUN_WORKERS', os.cpu_count() or 2))
+RUN_USER_LIMIT = args.run_user_limit if args.run_user_limit is not None else int(os.environ.get('SS_RUN_USER_LIMIT', 0))
+RUN_TIMEOUT = args.run_timeout if args.run_timeout is not None else int(os.environ.get('SS_RUN_TIMEOUT', 0))
+RUN_TRACE_ALLOC = args.run_trace_alloc or os.environ.get('SS_RUN_TRACE_ALLOC') == '1'
+SCHED_SPREAD = args.sched_spread if args.sched_spread is not None else int(os.environ.get('SS_SCHED_SPREAD', 0))
+STREAM_BUFFER = args.stream_buffer or int(os.environ.get('SS_STREAM_BUFFER', 1024 * 1024))
+STREAM_OVERFLOW = args.stream_overflow or os.environ.get('SS_STREAM_OVERFLOW', 'block')
+SSE_PORT = args.sse_port if args.sse_port is not None else int(os.environ.get('SS_SSE_PORT', 5001))
+METRICS_ENABLED = args.metrics_enable or os.environ.get('SS_METRICS_ENABLED') == '1'
 
 print("WORKSPACE_PATH:", WORKSPACE_PATH)
 print("SIGNUP_ENABLED:", SIGNUP_ENABLED)
+print("DB_POOL_SIZE:", DB_POOL_SIZE)
+print("DB_STATEMENT_CACHE:", DB_STATEMENT_CACHE)
+print("RUN_WORKERS:", RUN_WORKERS)
+print("RUN_USER_LIMIT:", RUN_USER_LIMIT)
+print("RUN_TIMEOUT:", RUN_TIMEOUT)
+print("RUN_TRACE_ALLOC:", RUN_TRACE_ALLOC)
+print("SCHED_SPREAD:", SCHED_SPREAD)
+print("STREAM_BUFFER:", STREAM_BUFFER)
+print("STREAM_OVERFLOW:", STREAM_OVERFLOW)
+print("SSE_PORT:", SSE_PORT)
+print("METRICS_ENABLED:", METRICS_ENABLED)
 
 
 
 app = Flask(__name__)
 crypt = URLSafeSerializer("secret")
 
-db = get_ss_db_object(os.path.realpath(WORKSPACE_PATH))
+ss_sched.spread = SCHED_SPREAD # before the schedules are loaded
+db = get_ss_db_object(os.path.realpath(WORKSPACE_PATH), pool_size=DB_POOL_SIZE, statement_cache_size=DB_STATEMENT_CACHE)
+ss_executor.start(size=RUN_WORKERS, user_limit=RUN_USER_LIMIT, timeout=RUN_TIMEOUT, trace_alloc=RUN_TRACE_ALLOC)
+metrics.Gauge('ss_runs_waiting', "Runs waiting for a worker", fn=lambda: ss_executor.queue_stats()['waiting'])
+metrics.Gauge('ss_runs_running', "Runs executing on a worker", fn=lambda: ss_executor.queue_stats()['running'])
+metrics.Gauge('ss_db_statements', "Statements executed on inventory.db", fn=lambda: db.statement_cache_stats()['statements'])
+metrics.Gauge('ss_db_statement_cache_est_hit_rate', "Estimated hit rate of the prepared statement cache (see base.StatementCacheStats)", fn=lambda: db.statement_cache_stats()['est_hit_rate'])
+ss_sched.start_thread()
+configure_streams(max_buffer=STREAM_BUFFER, overflow=STREAM_OVERFLOW)
 
 
 class SimpleTemplate:
@@ -68,11 +112,27 @@ def set_cookie_token(resp, user):
 	resp.set_cookie('Authorization', enc)
 
 
-def set_user_from_cookie():
-	auth = request.cookies.get("Authorization")
+def get_user_from_cookies(cookies):
+	auth = cookies.get("Authorization")
+	if auth is None:
+		raise Exception("Not logged in")
 	dec = crypt.loads(auth)
-	request.user = db.get_user(dec['email'])
-	request.user.logged_in = True
+	user = db.get_user(dec['email'])
+	user.logged_in = True
+	return user
+
+
+def set_user_from_cookie():
+	request.user = get_user_from_cookies(request.cookies)
+
+
+def get_project_from_cookies(cookies, project_hash):
+	'''used by the server-sent events endpoint, which runs outside flask'''
+	return get_user_from_cookies(cookies).get_project(project_hash)
+
+
+if SSE_PORT:
+	RunEventServer(get_project_from_cookies, port=SSE_PORT).start()
 
 
 def cookie_login(f):
@@ -106,6 +166,7 @@ def cookie_login_stream(f):
 			set_user_from_cookie()
 			return f(*args, **kwargs)
 		except Exception as e:
+			traceback.print_exc()
 			return json.dumps({'error': str(e)})
 
 	_wrapper.__name__ = f.__name__
@@ -119,6 +180,13 @@ def static_files(folder, filename):
 	return send_file(os.path.join(CWD, 'web', folder, filename))
 
 
+if METRICS_ENABLED:
+	@app.route("/metrics", methods=['GET'])
+	def prometheus_metrics():
+		'''scheduler, run queue and database metrics in the prometheus text format. no login, for the scraper - only with --metrics-enable'''
+		return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/", methods=['GET'])
 @cookie_login
 def home():
@@ -210,14 +278,21 @@ def open_project(project_hash):
 	request.user.get_project(project_hash)  # basic file structure init
 	# P.create_default_entry_point()
 	# P.get_properties()
-	return SimpleTemplate.send_file(os.path.join(CWD, 'web', 'project.html'), project_hash=project_hash)
+	return SimpleTemplate.send_file(os.path.join(CWD, 'web', 'project.html'), project_hash=project_hash, sse_port=SSE_PORT)
 
 
 @app.route("/project/<project_hash>/tree", methods=['GET'])
-@cookie_login_json
+@cookie_login_stream
 def tree(project_hash):
 	P = request.user.get_project(project_hash)
-	return P.get_file_struct_dict()
+	tree, etag = P.get_file_tree()
+	if request.if_none_match.contains(etag):
+		resp = Response(status=304)
+	else:
+		resp = make_response(json.dumps({'success': tree}))
+	resp.set_etag(etag)
+	resp.headers['Cache-Control'] = 'no-cache' # always revalidate - unchanged trees are a 304
+	return resp
 
 
 @app.route("/project/<project_hash>/properties", methods=['GET'])
@@ -260,6 +335,13 @@ def save_file(project_hash):
 	return res
 
 
+@app.route("/project/<project_hash>/compile", methods=['POST'])
+@cookie_login_json
+def compile_project(project_hash):
+	P = request.user.get_project(project_hash)
+	return P.compile_all()
+
+
 @app.route("/project/<project_hash>/file/delete", methods=['POST'])
 @cookie_login_json
 def delete_file(project_hash):
@@ -318,10 +400,19 @@ def new_entrypoint(project_hash):
 	file = str(data['file']).strip()
 	func = str(data['func']).strip()
 	is_default = data.get('make_default', False)
-	P.create_entry_point(file, func, is_default=is_default)
+	timeout = int(data.get('timeout', 0) or 0)
+	warm = bool(data.get('warm', False))
+	P.create_entry_point(file, func, is_default=is_default, timeout=timeout, warm=warm)
 	return P.get_all_entry_points()
 
 
+@app.route("/project/<project_hash>/callables", methods=['GET'])
+@cookie_login_json
+def callables(project_hash):
+	P = request.user.get_project(project_hash)
+	return P.get_callables()
+
+
 @app.route("/project/<project_hash>/entry-point/delete", methods=['POST'])
 @cookie_login_json
 def delete_entrypoint(project_hash):
@@ -340,7 +431,11 @@ def new_schedule(project_hash):
 	every = str(data['every']).strip()
 	at = str(data['at']).strip()
 	tzname = data.get('tzname', None)
-	P.create_schedule(epid, every, at, tzname)
+	priority = int(data.get('priority', 0) or 0)
+	jitter = int(data.get('jitter', 0) or 0)
+	overlap = data.get('overlap', 'skip')
+	profile = bool(data.get('profile', False))
+	P.create_schedule(epid, every, at, tzname, priority=priority, jitter=jitter, overlap=overlap, profile=profile)
 	return P.get_full_schedule()
 
 
@@ -359,6 +454,79 @@ def delete_schedule(project_hash):
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 
+@app.route("/project/<project_hash>/runs", methods=['GET'])
+@cookie_login_json
+def runs(project_hash):
+	P = request.user.get_project(project_hash)
+	return P.get_runs(
+		page=request.args.get('page', 1, type=int),
+		page_size=request.args.get('page_size', 50, type=int),
+		days=request.args.get('days', 7, type=int),
+	)
+
+
+@app.route("/project/<project_hash>/runs", methods=['POST'])
+@cookie_login_json
+def start_run(project_hash):
+	'''start a run without streaming it. watch it on the server-sent events port (see app/sse.py)'''
+	P = request.user.get_project(project_hash)
+	return P.start_run(
+		request.json.get('epid'),
+		priority=int(request.json.get('priority', 0) or 0),
+		profile=bool(request.json.get('profile', False)),
+	)
+
+
+@app.route("/project/<project_hash>/runs/<run_id>/cancel", methods=['POST'])
+@cookie_login_json
+def cancel_run(project_hash, run_id):
+	'''stop a queued or running run. its worker is freed and the run recorded as cancelled'''
+	P = request.user.get_project(project_hash)
+	return P.cancel_run(run_id)
+
+
+@app.route("/project/<project_hash>/runs/<run_id>/profile", methods=['GET'])
+@cookie_login_json
+def run_profile(project_hash, run_id):
+	'''cProfile summary of a run started with profile=true: {top: [...by cumulative time], collapsed: folded stacks}'''
+	P = request.user.get_project(project_hash)
+	return P.get_run_profile(run_id, top=request.args.get('top', 30, type=int))
+
+
+@app.route("/project/<project_hash>/runs/<run_id>/profile.collapsed", methods=['GET'])
+@cookie_login_stream
+def run_profile_collapsed(project_hash, run_id):
+	'''the folded stacks alone, as text - for flamegraph.pl, speedscope and the like'''
+	P = request.user.get_project(project_hash)
+	return Response(P.get_run_collapsed_stacks(run_id), mimetype='text/plain')
+
+
+@app.route("/project/<project_hash>/runs/<run_id>/stream", methods=['GET'])
+@cookie_login_stream
+def watch_run(project_hash, run_id):
+	'''attach to a run - its output from ?offset=N, followed live while it runs'''
+	P = request.user.get_project(project_hash)
+	return Response(P.watch_run(run_id, offset=request.args.get('offset', 0, type=int)), mimetype='text/plain')
+
+
+@app.route("/project/<project_hash>/runs/<run_id>/log", methods=['GET'])
+@cookie_login_stream
+def run_log(project_hash, run_id):
+	'''
+	run output after ?offset=N (bytes). only the new bytes are sent, so clients can poll or reconnect cheaply
+	- X-Log-Start: offset of the first byte sent (larger than N if those bytes were rotated away)
+	- X-Log-End: offset to request next
+	- X-Run-Running: 1 while the run is still producing output
+	'''
+	P = request.user.get_project(project_hash)
+	start, end, chunks, is_running = P.get_run_log(run_id, offset=request.args.get('offset', 0, type=int))
+	resp = Response(chunks, mimetype='text/plain', direct_passthrough=True)
+	resp.headers['X-Log-Start'] = str(start)
+	resp.headers['X-Log-End'] = str(end)
+	resp.headers['X-Run-Running'] = '1' if is_running else '0'
+	return resp
+
+
 @app.route("/project/<project_hash>/run", methods=['POST'])
 @cookie_login_stream
 def run(project_hash):
@@ -376,7 +544,8 @@ def run(project_hash):
 	# 		yield msg_queue.get()
 	# 	run_thread.join()
 
-	return Response(P.run_with_progress(epid))
+	run = P.new_run(epid, profile=bool(request.json.get('profile', False)))
+	return Response(P.run_with_progress(epid, run=run), headers={'X-Run-Id': run.run_id}) # see run_log()
 
 
 
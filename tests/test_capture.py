@@ -0,0 +1,85 @@
+'''
+print capture batching - see app/capture.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import sys
+import threading
+import time
+import unittest
+
+from app.capture import print_capture
+
+
+
+class PrintCaptureTest(unittest.TestCase):
+
+    def capture(self, **kwargs):
+        chunks = []
+        return chunks, print_capture(chunks.append, **kwargs)
+
+    def test_small_output_is_flushed_on_exit(self):
+        chunks, cap = self.capture()
+        with cap:
+            print("one")
+            print("two", end='')
+        self.assertEqual(chunks, ["one\ntwo"])
+
+    def test_complete_lines_are_batched(self):
+        chunks, cap = self.capture(batch_bytes=10, max_line_bytes=100, flush_interval=60)
+        with cap:
+            print("abcd") # 5 bytes - held
+            print("efgh") # 10 - emitted
+            print("ij", end='') # partial line - held until the end
+            self.assertEqual(chunks, ["abcd\nefgh\n"])
+        self.assertEqual(chunks, ["abcd\nefgh\n", "ij"])
+
+    def test_batch_is_cut_at_the_last_newline(self):
+        chunks, cap = self.capture(batch_bytes=8, max_line_bytes=100, flush_interval=60)
+        with cap:
+            print("abc\ndefghij", end='')
+            self.assertEqual(chunks, ["abc\n"])
+        self.assertEqual(chunks, ["abc\n", "defghij"])
+
+    def test_long_partial_line_is_flushed(self):
+        chunks, cap = self.capture(batch_bytes=100, max_line_bytes=4, flush_interval=60)
+        with cap:
+            print("abcdef", end='')
+            self.assertEqual(chunks, ["abcdef"])
+        self.assertEqual(chunks, ["abcdef"])
+
+    def test_multibyte_char_split_across_flushes(self):
+        chunks, cap = self.capture(batch_bytes=100, max_line_bytes=3, flush_interval=60)
+        with cap:
+            sys.stdout.buffer.write("abé".encode()[:3]) # the é is cut after its first byte
+            sys.stdout.buffer.write("é".encode()[1:] + b"c")
+        self.assertEqual(''.join(chunks), "abéc")
+
+    def test_timer_flushes_idle_output(self):
+        chunks, cap = self.capture(flush_interval=0.05)
+        with cap:
+            print("tick", end='')
+            deadline = time.monotonic() + 5
+            while not chunks and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(chunks, ["tick"])
+        self.assertEqual(chunks, ["tick"])
+
+    def test_other_threads_are_not_captured(self):
+        chunks, cap = self.capture()
+        other = []
+        with cap:
+            print("mine")
+            t = threading.Thread(target=lambda: other.append(sys.stdout.write("elsewhere\n")))
+            t.start()
+            t.join()
+        self.assertEqual(chunks, ["mine\n"])
+        self.assertEqual(other, [len("elsewhere\n")]) # written to the real stdout
+
+    def test_stop_does_not_wait_out_the_flush_interval(self):
+        chunks, cap = self.capture(flush_interval=30)
+        start = time.monotonic()
+        with cap:
+            print("x")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(chunks, ["x\n"])
@@ -0,0 +1,91 @@
+'''
+stopping runs on real worker processes - see app/executor.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+from app.executor import RunExecutor, RunStopped, WorkerProcess
+from app.stream import RunChannel, OutputStream
+
+
+CHATTY = '''
+def main():
+    while True:
+        print("x" * 1000)
+
+def hello():
+    print("hello")
+'''
+
+
+
+class StopWithStuckReaderTest(unittest.TestCase):
+    '''a viewer that never reads must not keep a run from being cancelled or timed out'''
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        with open(os.path.join(self.src, 'main.py'), 'w') as f:
+            f.write(CHATTY)
+        self.ex = RunExecutor(size=1)
+        self.ex.start()
+        self.stop_grace = WorkerProcess.STOP_GRACE
+        WorkerProcess.STOP_GRACE = 1
+
+    def tearDown(self):
+        WorkerProcess.STOP_GRACE = self.stop_grace
+        self.ex.shutdown()
+        shutil.rmtree(self.src)
+
+    def task(self, func='main'):
+        return {'src_path': os.path.realpath(self.src), 'file': 'main.py', 'func': func, 'label': 'test', 'warm': False}
+
+    def stuck_channel(self):
+        ch = RunChannel(uuid.uuid4().hex, max_buffer=64 * 1024)
+        ch.STALL_TIMEOUT = 60 # the stop, not the stall switch, has to free the run
+        reader = OutputStream(ch, overflow='block') # never iterated
+        return ch, reader
+
+    def run_stuck(self, **kwargs):
+        ch, reader = self.stuck_channel()
+        offered, taken = set(), set()
+        def msg_cb(data):
+            offered.add(id(data))
+            ok = ch.publish(data, timeout=WorkerProcess.POLL)
+            if ok:
+                taken.add(id(data))
+            return ok
+        start = time.monotonic()
+        with self.assertRaises(RunStopped) as cm:
+            self.ex.submit(self.task(), msg_cb=msg_cb, **kwargs)
+        self.assertTrue(ch._stalled_since is not None) # the reader did hold the output back
+        self.assertLessEqual(len(offered - taken), 1) # held back output is offered again, not dropped - bar the one held when it stopped
+        reader.detach()
+        return cm.exception.reason, time.monotonic() - start
+
+    def assert_pool_usable(self):
+        out = []
+        res = self.ex.submit(self.task('hello'), msg_cb=out.append, timeout=30)
+        self.assertTrue(res['ok'])
+        self.assertIn('hello', ''.join(out))
+        self.assertEqual(self.ex.queue_stats(), {'waiting': 0, 'running': 0})
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        threading.Timer(1, cancel.set).start()
+        reason, took = self.run_stuck(cancel=cancel)
+        self.assertEqual(reason, 'cancelled')
+        self.assertLess(took, 1 + WorkerProcess.POLL * 2 + WorkerProcess.STOP_GRACE + 2)
+        self.assert_pool_usable()
+
+    def test_timeout(self):
+        reason, took = self.run_stuck(timeout=1)
+        self.assertEqual(reason, 'timeout')
+        self.assertLess(took, 1 + WorkerProcess.POLL * 2 + WorkerProcess.STOP_GRACE + 2)
+        self.assert_pool_usable()
@@ -0,0 +1,119 @@
+'''
+the executor's fair queue - which waiting run gets a free worker. see app/executor.py
+
+workers are stand-ins here: the queue only needs to know whether one is alive
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import queue
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+from app.executor import RunExecutor, RunStopped
+
+
+
+class _Worker:
+    def __init__(self):
+        self.warm = OrderedDict()
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+    kill = close
+
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def executor(self, size=1, user_limit=None):
+        ex = RunExecutor(size=size, user_limit=user_limit)
+        ex._idle = [_Worker() for _ in range(size)]
+        ex._n_workers = size
+        return ex
+
+    def wait_for(self, cond):
+        deadline = time.monotonic() + 5
+        while not cond():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.005)
+
+    def enqueue(self, ex, runs):
+        '''start a waiting _acquire per (user, priority, tag), in order. returns a queue of (worker, user, tag) as they are granted'''
+        granted = queue.Queue()
+        for user, priority, tag in runs:
+            n = ex.queue_stats()['waiting']
+            threading.Thread(target=lambda u=user, p=priority, t=tag: granted.put((ex._acquire(u, p), u, t)), daemon=True).start()
+            self.wait_for(lambda: ex.queue_stats()['waiting'] == n + 1)
+        return granted
+
+    def drain(self, ex, holder, holder_user, granted, n):
+        '''release the worker in turn to n waiting runs - the order they got it in'''
+        order = []
+        for _ in range(n):
+            ex._release(holder, holder_user)
+            holder, holder_user, tag = granted.get(timeout=5)
+            order.append(tag)
+        ex._release(holder, holder_user)
+        return order
+
+    def test_higher_priority_goes_first(self):
+        ex = self.executor()
+        holder = ex._acquire('h')
+        granted = self.enqueue(ex, [('a', 0, 'a-low'), ('b', 0, 'b-low'), ('b', 5, 'b-high'), ('a', 1, 'a-mid')])
+        self.assertEqual(self.drain(ex, holder, 'h', granted, 4), ['b-high', 'a-mid', 'b-low', 'a-low']) # equal priorities: b was served longer ago
+
+    def test_users_take_turns(self):
+        ex = self.executor()
+        holder = ex._acquire('h')
+        granted = self.enqueue(ex, [('a', 0, 'a1'), ('a', 0, 'a2'), ('a', 0, 'a3'), ('b', 0, 'b1'), ('c', 0, 'c1')])
+        self.assertEqual(self.drain(ex, holder, 'h', granted, 5), ['a1', 'b1', 'c1', 'a2', 'a3'])
+
+    def test_runs_without_a_user(self):
+        ex = self.executor()
+        holder = ex._acquire(None)
+        granted = self.enqueue(ex, [(None, 0, 'n1'), (None, 0, 'n2')])
+        self.assertEqual(self.drain(ex, holder, None, granted, 2), ['n1', 'n2'])
+        self.assertEqual(ex.queue_stats(), {'waiting': 0, 'running': 0})
+
+    def test_user_limit(self):
+        ex = self.executor(size=2, user_limit=1)
+        a = ex._acquire('a')
+        granted = self.enqueue(ex, [('a', 9, 'a2')])
+        self.assertTrue(granted.empty()) # a worker is free, but a is at its limit
+        b = ex._acquire('b') # not held back by a's waiting run
+        self.assertEqual(ex.queue_stats(), {'waiting': 1, 'running': 2})
+        ex._release(a, 'a')
+        worker, user, tag = granted.get(timeout=5)
+        self.assertEqual(tag, 'a2')
+        ex._release(worker, 'a')
+        ex._release(b, 'b')
+        self.assertEqual(ex.queue_stats(), {'waiting': 0, 'running': 0})
+
+    def test_cancel_while_waiting(self):
+        ex = self.executor()
+        holder = ex._acquire('h')
+        cancel = threading.Event()
+        errors = queue.Queue()
+        def wait():
+            try:
+                ex._acquire('a', cancel=cancel)
+            except RunStopped as e:
+                errors.put(e.reason)
+        threading.Thread(target=wait, daemon=True).start()
+        self.wait_for(lambda: ex.queue_stats()['waiting'] == 1)
+        cancel.set()
+        self.assertEqual(errors.get(timeout=5), 'cancelled')
+        self.assertEqual(ex.queue_stats(), {'waiting': 0, 'running': 1})
+        ex._release(holder, 'h')
+
+    def test_warm_run_prefers_a_worker_holding_its_project(self):
+        ex = self.executor(size=2)
+        cold, warm = ex._idle
+        warm.warm['/p'] = True
+        self.assertIs(ex._acquire('a', warm='/p'), warm)
+        self.assertIs(ex._acquire('b', warm='/p'), cold) # no other choice
@@ -0,0 +1,95 @@
+'''
+schedule leases and overlap policies - see app/leases.py
+
+two LeaseRegistry objects on one inventory.db stand for two server processes
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from app import migrations
+from app.base import DB
+from app.leases import LeaseRegistry, LEASED, QUEUED, SKIPPED, COALESCED
+
+
+NOW = '2024-01-01 00:00:00'
+
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = DB(os.path.join(self.dir, 'inventory.db'))
+        with self.db.connection() as conn:
+            migrations.migrate(conn)
+            conn.execute('''INSERT INTO users (id, first_name, email, password, salt, create_dt) VALUES (1, 'u', 'u@example.com', '', '', ?)''', (NOW,))
+            conn.execute('''INSERT INTO projects (id, user_id, name, name_hash, create_dt) VALUES (1, 1, 'p', 'h', ?)''', (NOW,))
+            conn.execute('''INSERT INTO entry_points (id, project_id, file, func, create_dt) VALUES (1, 1, 'main.py', 'main', ?)''', (NOW,))
+            conn.execute('''INSERT INTO schedule (id, ep_id, every, at, create_dt) VALUES (1, 1, 'day', '09:00', ?)''', (NOW,))
+        self.a = LeaseRegistry()
+        self.b = LeaseRegistry()
+
+    def tearDown(self):
+        self.db.pool.close()
+        shutil.rmtree(self.dir)
+
+    def lease_row(self):
+        return self.db.execute('''SELECT owner, expires_ts, pending FROM schedule_leases WHERE sched_id = 1''', fetch_one=True)
+
+    def expire(self):
+        self.db.execute('''UPDATE schedule_leases SET expires_ts = :ts WHERE sched_id = 1''', {'ts': time.time() - 1})
+
+    def test_skip_while_held(self):
+        self.assertEqual(self.a.acquire(self.db, 1), LEASED)
+        self.assertEqual(self.b.acquire(self.db, 1), SKIPPED)
+        self.assertEqual(self.a.acquire(self.db, 1), SKIPPED) # one run at a time in the same process too
+        self.assertFalse(self.a.release(self.db, 1, take_queued=True))
+        self.assertIsNone(self.lease_row())
+        self.assertEqual(self.b.acquire(self.db, 1), LEASED)
+
+    def test_queue_and_coalesce(self):
+        self.assertEqual(self.a.acquire(self.db, 1), LEASED)
+        self.assertEqual(self.b.acquire(self.db, 1, queue=True), QUEUED)
+        self.assertEqual(self.b.acquire(self.db, 1, queue=True), COALESCED)
+        self.assertTrue(self.a.release(self.db, 1, take_queued=True)) # the holder runs the queued firing
+        self.assertEqual(self.lease_row().pending, 0)
+        self.assertEqual(self.b.acquire(self.db, 1, queue=True), QUEUED)
+        self.assertTrue(self.a.release(self.db, 1, take_queued=True))
+        self.assertFalse(self.a.release(self.db, 1, take_queued=True))
+        self.assertIsNone(self.lease_row())
+
+    def test_release_without_take_queued_drops_it(self):
+        self.a.acquire(self.db, 1)
+        self.b.acquire(self.db, 1, queue=True)
+        self.assertFalse(self.a.release(self.db, 1))
+        self.assertIsNone(self.lease_row())
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertEqual(self.a.acquire(self.db, 1), LEASED)
+        self.expire() # a died
+        self.assertEqual(self.b.acquire(self.db, 1), LEASED)
+        self.assertTrue(self.lease_row().owner.startswith(self.b.owner_prefix))
+        self.assertFalse(self.a.release(self.db, 1)) # the late holder can't free b's lease
+        self.assertIsNotNone(self.lease_row())
+        self.b.release(self.db, 1)
+
+    def test_takeover_runs_the_dead_holders_queued_firing(self):
+        self.a.acquire(self.db, 1)
+        self.assertEqual(self.b.acquire(self.db, 1, queue=True), QUEUED)
+        self.expire() # a died before running it
+        self.assertEqual(self.b.acquire(self.db, 1, queue=True), LEASED)
+        self.assertTrue(self.b.release(self.db, 1, take_queued=True))
+        self.assertFalse(self.b.release(self.db, 1, take_queued=True))
+        self.assertIsNone(self.lease_row())
+
+    def test_renew_pushes_expiry_back(self):
+        self.a.acquire(self.db, 1)
+        self.expire()
+        self.assertEqual(self.a.renew(), 1)
+        self.assertGreater(self.lease_row().expires_ts, time.time() + self.a.ttl / 2)
+        self.assertEqual(self.b.acquire(self.db, 1), SKIPPED)
+        self.a.release(self.db, 1)
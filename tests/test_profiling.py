@@ -0,0 +1,96 @@
+'''
+folded stacks of profiled runs - see app/profiling.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from app import profiling
+
+
+
+def leaf():
+    return sum(range(2000))
+
+def mid(n):
+    for _ in range(n):
+        leaf()
+
+def rec(n):
+    return rec(n - 1) if n else leaf()
+
+def top():
+    mid(50)
+    mid(5)
+    rec(10)
+
+
+
+class CollapsedStacksTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.run_id = uuid.uuid4().hex
+        cls.path = profiling.profile_path(cls.dir, cls.run_id)
+        prof = cProfile.Profile()
+        prof.runcall(top)
+        prof.dump_stats(cls.path)
+        stats = pstats.Stats(cls.path).stats
+        cls.total_us = sum(ct for (_, _, _, ct, callers) in stats.values() if not callers) * 1e6
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.limits = profiling.MIN_STACK_SHARE, profiling.MAX_STACK_LINES
+
+    def tearDown(self):
+        profiling.MIN_STACK_SHARE, profiling.MAX_STACK_LINES = self.limits
+
+    def fold(self):
+        lines = profiling.collapsed_stacks(self.path, self.dir).splitlines()
+        parsed = []
+        for line in lines:
+            stack, us = line.rsplit(' ', 1)
+            parsed.append((stack.split(';'), int(us)))
+        return parsed
+
+    def test_stacks_follow_the_calls(self):
+        stacks = [';'.join(frames) for frames, _ in self.fold()]
+        self.assertTrue(any('top (' in s and ';mid (' in s and ';leaf (' in s for s in stacks))
+        for frames, us in self.fold():
+            self.assertGreater(us, 0)
+            self.assertLessEqual(sum(f.startswith('rec (') for f in frames), 1) # recursion is counted where it starts
+
+    def test_time_is_kept_when_branches_are_folded(self):
+        counts = []
+        for share in (1e-4, 0.2, 0.95):
+            profiling.MIN_STACK_SHARE = share
+            folded = self.fold()
+            self.assertAlmostEqual(sum(us for _, us in folded), self.total_us, delta=len(folded) + 1)
+            counts.append(len(folded))
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertLess(counts[-1], counts[0])
+
+    def test_line_cap_keeps_the_most_expensive(self):
+        everything = self.fold()
+        profiling.MAX_STACK_LINES = 2
+        capped = self.fold()
+        self.assertEqual(sorted(us for _, us in capped), sorted(us for _, us in everything)[-2:])
+
+    def test_folded_once_and_kept(self):
+        text = profiling.cached_collapsed_stacks(self.dir, self.run_id, self.dir)
+        self.assertTrue(os.path.isfile(profiling.collapsed_path(self.dir, self.run_id)))
+        self.assertEqual(text, profiling.collapsed_stacks(self.path, self.dir))
+        with open(profiling.collapsed_path(self.dir, self.run_id), 'w') as f:
+            f.write('cached 1\n')
+        self.assertEqual(profiling.cached_collapsed_stacks(self.dir, self.run_id, self.dir), 'cached 1\n')
+        os.remove(profiling.collapsed_path(self.dir, self.run_id))
@@ -0,0 +1,81 @@
+'''
+the lookups the app makes on every request must be served by an index, not a table scan
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import re
+import sqlite3
+import unittest
+
+from app import migrations, queries
+
+
+# query -> tables it must not scan
+INDEXED_LOOKUPS = {
+    'PROJECT_BY_HASH': ['projects'],
+    'USER_PROJECTS': ['projects'],
+    'USER_PROJECTS_SUMMARY': ['projects', 'entry_points', 'schedule'],
+    'DEFAULT_ENTRY_POINT': ['entry_points'],
+    'ENTRY_POINT_BY_ID': ['entry_points'],
+    'PROJECT_ENTRY_POINTS': ['projects', 'entry_points'],
+    'DELETE_ENTRY_POINT': ['entry_points'],
+    'PROJECT_FULL_SCHEDULE': ['projects', 'entry_points', 'schedule'],
+    'DELETE_SCHEDULE': ['schedule'],
+    'SCHEDULE_RUN_OPTIONS': ['schedule'],
+    'PROJECT_RUNS_PAGE': ['runs'],
+    'PROJECT_RUN_BY_ID': ['runs'],
+    'PROJECT_RUNS_COUNT': ['runs'],
+}
+
+_SCAN_RE = re.compile(r'^SCAN (\w+)')
+_ALIAS_RE = r'\b{table}\b(?:\s+(?:AS\s+)?(\w+))?'
+
+
+
+def _aliases(sql, table):
+    '''the names table goes by in sql - itself and its aliases'''
+    names = {table}
+    for m in re.finditer(r'\b(?:FROM|JOIN)\s+' + _ALIAS_RE.format(table=table), sql, re.IGNORECASE):
+        if m.group(1) and m.group(1).upper() not in ('ON', 'WHERE', 'LEFT', 'JOIN', 'GROUP', 'ORDER'):
+            names.add(m.group(1))
+    return names
+
+
+def _plan(conn, sql):
+    params = {name: 1 for name in re.findall(r':(\w+)', sql)}
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = sqlite3.connect(':memory:')
+        cls.conn.create_function('sched_delete_job', 1, lambda sched_id: None) # called by a trigger - see main_db.py
+        migrations.migrate(cls.conn)
+        cls.conn.execute('ANALYZE') # plans as on a db that has been analyzed - sqlite's defaults otherwise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+
+
+    def test_lookups_use_an_index(self):
+        for name, tables in INDEXED_LOOKUPS.items():
+            sql = getattr(queries, name)
+            plan = _plan(self.conn, sql)
+            with self.subTest(query=name, plan=plan):
+                scanned = {m.group(1) for m in map(_SCAN_RE.match, plan) if m}
+                for table in tables:
+                    self.assertFalse(scanned & _aliases(sql, table), f"{name} scans {table}:\n" + '\n'.join(plan))
+                self.assertTrue(any('USING' in step for step in plan), f"{name} uses no index:\n" + '\n'.join(plan))
+
+
+    def test_schema_is_current(self):
+        self.assertEqual(migrations.get_version(self.conn), migrations.LATEST_VERSION)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
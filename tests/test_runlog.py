@@ -0,0 +1,97 @@
+'''
+rotating run logs and offset reads - see app/runlog.py. the SSE endpoint and readers that fall behind read through read_range
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+
+from app import runlog
+
+
+
+def _read(log_dir, run_id, offset=0, chunk_size=64*1024):
+    start, end, chunks = runlog.read_range(log_dir, run_id, offset=offset, chunk_size=chunk_size)
+    return start, end, b''.join(chunks)
+
+
+
+class RunLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.run_id = uuid.uuid4().hex
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def new_log(self, segment_bytes=None, max_segments=None):
+        log = runlog.RunLog(self.log_dir, self.run_id)
+        if segment_bytes:
+            log.SEGMENT_BYTES = segment_bytes
+        if max_segments:
+            log.MAX_SEGMENTS = max_segments
+        return log
+
+    def test_read_from_offsets(self):
+        log = self.new_log()
+        log.write(b'hello ')
+        log.write('world')
+        log.close()
+        self.assertEqual(_read(self.log_dir, self.run_id), (0, 11, b'hello world'))
+        self.assertEqual(_read(self.log_dir, self.run_id, offset=6), (6, 11, b'world'))
+        self.assertEqual(_read(self.log_dir, self.run_id, offset=50), (11, 11, b'')) # past the end
+
+    def test_live_log_is_flushed_for_readers(self):
+        log = self.new_log()
+        log.write(b'buffered')
+        self.assertEqual(log.size, 0) # still in memory
+        self.assertEqual(_read(self.log_dir, self.run_id), (0, 8, b'buffered'))
+        log.close()
+
+    def test_segments_split_at_offsets(self):
+        log = self.new_log(segment_bytes=10)
+        data = bytes(range(65, 65 + 25))
+        log.write(data)
+        log.close()
+        starts = [start for start, _ in runlog.list_segments(self.log_dir, self.run_id)]
+        self.assertEqual(starts, [0, 10, 20])
+        self.assertEqual(_read(self.log_dir, self.run_id, offset=7, chunk_size=4), (7, 25, data[7:]))
+
+    def test_rotation_drops_the_oldest_segments(self):
+        log = self.new_log(segment_bytes=10, max_segments=2)
+        data = bytes(range(65, 65 + 45))
+        log.write(data)
+        log.close()
+        starts = [start for start, _ in runlog.list_segments(self.log_dir, self.run_id)]
+        self.assertEqual(starts, [30, 40])
+        start, end, out = _read(self.log_dir, self.run_id)
+        self.assertEqual((start, end), (30, 45)) # start > offset: the rest was rotated away
+        self.assertEqual(out, data[30:])
+
+    def test_unknown_run(self):
+        self.assertEqual(_read(self.log_dir, uuid.uuid4().hex, offset=5), (5, 5, b''))
+
+    def test_prune_keeps_recent_and_live_runs(self):
+        old = [uuid.uuid4().hex for _ in range(3)]
+        for i, run_id in enumerate(old):
+            path = os.path.join(self.log_dir, f"{run_id}.0.log")
+            with open(path, 'wb') as f:
+                f.write(b'x')
+            open(os.path.join(self.log_dir, f"{run_id}.pstats"), 'wb').close()
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+            os.utime(path[:-len('0.log')] + 'pstats', (time.time() - 100 + i, time.time() - 100 + i))
+        live = runlog.RunLog(self.log_dir, self.run_id) # the oldest of all, but still running
+        live.write(b'y')
+        live.flush()
+        os.utime(os.path.join(self.log_dir, f"{self.run_id}.0.log"), (time.time() - 1000, time.time() - 1000))
+
+        removed = runlog.prune(self.log_dir, keep=1)
+        self.assertEqual(sorted(removed), sorted(old[:2]))
+        left = {name.split('.')[0] for name in os.listdir(self.log_dir)}
+        self.assertEqual(left, {old[2], self.run_id})
+        live.close()
@@ -0,0 +1,125 @@
+'''
+the scheduler's next-fire index and firing offsets - see app/sched.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import random
+import time
+import unittest
+from collections import namedtuple
+
+from app.sched import SS_Scheduler, jitter_offset, MAX_JITTER
+
+
+
+def _noop():
+    pass
+
+
+
+class NextFireIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sched = SS_Scheduler()
+
+    def add(self, sched_id, interval, enabled=True, func=_noop, **kwargs):
+        self.sched.add_job(sched_id, interval, None, None, func, enabled=enabled, **kwargs)
+        return self.sched.get_job(sched_id)
+
+    def earliest(self):
+        '''next fire time by looking at every job - what the index must agree with'''
+        s = self.sched
+        times = [j.next_timestamp + s._offsets.get(sched_id, 0) for sched_id, j in s._sched_mapping.items() if not j.is_disabled and j.next_timestamp]
+        return min(times, default=None)
+
+    def test_earliest_job_is_on_top(self):
+        for sched_id, interval in ((1, 30), (2, 10), (3, 20)):
+            self.add(sched_id, interval)
+        self.assertEqual(self.sched.next_fire_time(), self.sched.get_job(2).next_timestamp)
+
+    def test_disabled_jobs_are_not_indexed(self):
+        self.add(1, 30)
+        self.add(2, 10, enabled=False)
+        self.assertEqual(self.sched.next_fire_time(), self.sched.get_job(1).next_timestamp)
+        self.sched.enable_job(2)
+        self.assertEqual(self.sched.next_fire_time(), self.sched.get_job(2).next_timestamp)
+        self.sched.disable_job(2)
+        self.assertEqual(self.sched.next_fire_time(), self.sched.get_job(1).next_timestamp)
+
+    def test_deleted_job_leaves_the_index(self):
+        self.add(1, 30)
+        self.add(2, 10)
+        self.sched.delete_job(2)
+        self.assertIsNone(self.sched.get_job(2))
+        self.assertEqual(self.sched.next_fire_time(), self.sched.get_job(1).next_timestamp)
+        self.sched.delete_job(1)
+        self.assertIsNone(self.sched.next_fire_time())
+        self.sched.delete_job(99) # unknown ids are ignored
+
+    def test_index_agrees_with_a_full_scan(self):
+        rnd = random.Random(7)
+        ids = list(range(200))
+        self.sched.add_jobs([dict(sched_id=i, every=rnd.randint(10, 10000), at=None, tz=None, func=_noop, enabled=rnd.random() < 0.7) for i in ids])
+        self.assertEqual(self.sched.next_fire_time(), self.earliest())
+        for _ in range(500):
+            sched_id = rnd.choice(ids)
+            op = rnd.random()
+            if op < 0.4:
+                self.sched.enable_job(sched_id)
+            elif op < 0.8:
+                self.sched.disable_job(sched_id)
+            elif self.sched.get_job(sched_id) is not None:
+                self.sched.delete_job(sched_id)
+                ids.remove(sched_id)
+            self.assertEqual(self.sched.next_fire_time(), self.earliest())
+        self.assertLessEqual(len(self.sched._heap), 2 * len(self.sched._entry_seq) + 1024 + 1)
+
+    def test_check_runs_only_due_jobs(self):
+        ran = []
+        jobs = {sched_id: self.add(sched_id, 60, func=lambda sched_id=sched_id: ran.append(sched_id)) for sched_id in (1, 2, 3)}
+        now = time.time()
+        for sched_id in (1, 3): # make them due
+            jobs[sched_id].job.next_timestamp = now - 1
+            self.sched._push(sched_id)
+        self.sched.check()
+        for j in jobs.values():
+            if j.proc is not None:
+                j.proc.join(5)
+        self.assertEqual(sorted(ran), [1, 3])
+        for sched_id in (1, 3): # rescheduled one interval on
+            self.assertAlmostEqual(jobs[sched_id].next_timestamp, now - 1 + 60, places=3)
+        self.assertEqual(self.sched.next_fire_time(), self.earliest())
+
+
+
+class JitterOffsetTest(unittest.TestCase):
+
+    def test_offset_is_stable_and_in_its_window(self):
+        for sched_id in range(1, 500):
+            offset = jitter_offset(sched_id, 300)
+            self.assertTrue(0 <= offset < 300)
+            self.assertEqual(offset, jitter_offset(sched_id, 300))
+        self.assertEqual(jitter_offset(1, 0), 0)
+        self.assertGreater(len({jitter_offset(i, 3600) for i in range(1, 200)}), 150) # spread out, not bunched
+
+    def test_window_is_the_jitter_or_the_spread(self):
+        sched = SS_Scheduler(spread=60)
+        self.assertEqual(sched.offset_for(7, 0), jitter_offset(7, 60))
+        self.assertEqual(sched.offset_for(7, 600), jitter_offset(7, 600))
+        self.assertEqual(sched.offset_for(7, 10**6), jitter_offset(7, MAX_JITTER))
+        self.assertEqual(SS_Scheduler().offset_for(7, 0), 0)
+
+    def test_stored_offsets_are_kept(self):
+        Row = namedtuple('Row', 'id jitter jitter_offset')
+        sched = SS_Scheduler(spread=60)
+        offsets, new = sched.assign_offsets([Row(1, 0, 5), Row(2, 0, None), Row(3, 120, None)])
+        self.assertEqual(offsets, {1: 5, 2: jitter_offset(2, 60), 3: jitter_offset(3, 120)})
+        self.assertEqual(new, [{'sched_id': 2, 'offset': offsets[2]}, {'sched_id': 3, 'offset': offsets[3]}])
+        self.assertEqual(SS_Scheduler().assign_offsets([Row(1, 0, None)]), ({}, []))
+
+    def test_offset_delays_the_fire_time(self):
+        sched = SS_Scheduler()
+        sched.add_job(1, 'day', '09:00', 'UTC', _noop, enabled=True, offset=90)
+        self.assertEqual(sched.next_fire_time(), sched.get_job(1).next_timestamp + 90)
+        sched.add_job(2, 60, None, None, _noop, enabled=True, offset=150) # kept within the interval
+        self.assertEqual(sched._offsets[2], 30)
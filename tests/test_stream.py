@@ -0,0 +1,96 @@
+'''
+run output fan-out and the overflow policies of its readers - see app/stream.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+
+from app import runlog
+from app.stream import RunChannel, OutputStream
+
+
+
+def _read_all(reader):
+    return b''.join(reader)
+
+
+
+class OverflowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.run_id = uuid.uuid4().hex
+        self.ch = RunChannel(self.run_id, log_dir=self.log_dir, max_buffer=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def reader(self, overflow):
+        return OutputStream(self.ch, overflow=overflow, chunk_interval=0.01)
+
+    def test_every_reader_gets_the_whole_output(self):
+        readers = [self.reader('block'), self.reader('spill')]
+        its = [iter(r) for r in readers]
+        for i in range(5):
+            self.ch.publish(f"{i}")
+            for it in its:
+                self.assertEqual(next(it), f"{i}".encode())
+        self.ch.close()
+        for it in its:
+            self.assertEqual(b''.join(it), b'')
+
+    def test_block_holds_the_publisher_back(self):
+        it = iter(self.reader('block'))
+        self.assertTrue(self.ch.publish(b'0123456789'))
+        self.assertFalse(self.ch.publish(b'abcde', timeout=0.05)) # would push the reader out of the buffer
+        self.assertEqual(self.ch.end, 10)
+        self.assertEqual(next(it), b'0123456789')
+        self.assertTrue(self.ch.publish(b'abcde', timeout=0.05))
+        self.ch.close()
+        self.assertEqual(_read_all(it), b'abcde')
+
+    def test_stalled_block_reader_is_dropped_to_drop_oldest(self):
+        self.ch.STALL_TIMEOUT = 0.2
+        reader = self.reader('block')
+        it = iter(reader)
+        self.ch.publish(b'0123456789')
+        self.assertFalse(self.ch.publish(b'abcde', timeout=0.05)) # retries count towards the same stall
+        start = time.monotonic()
+        self.assertTrue(self.ch.publish(b'abcde'))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(reader.overflow, 'drop-oldest')
+        self.ch.publish(b'fghij')
+        self.ch.close()
+        out = _read_all(it)
+        self.assertIn(b'bytes dropped', out)
+        self.assertTrue(out.endswith(b'abcdefghij'))
+
+    def test_drop_oldest_skips_ahead(self):
+        it = iter(self.reader('drop-oldest'))
+        for chunk in (b'0123456789', b'abcdefghij', b'ABCDEFGHIJ'):
+            self.assertTrue(self.ch.publish(chunk, timeout=0)) # never held back
+        self.ch.close()
+        out = _read_all(it)
+        self.assertTrue(out.startswith(b'\n[... 20 bytes dropped'))
+        self.assertTrue(out.endswith(b'ABCDEFGHIJ'))
+
+    def test_spill_catches_up_from_the_run_log(self):
+        log = runlog.RunLog(self.log_dir, self.run_id)
+        self.ch.add_listener(log.write)
+        it = iter(self.reader('spill'))
+        chunks = [bytes([65 + i]) * 10 for i in range(6)]
+        for chunk in chunks:
+            self.assertTrue(self.ch.publish(chunk, timeout=0))
+        self.ch.close()
+        log.close()
+        self.assertEqual(_read_all(it), b''.join(chunks))
+
+    def test_detached_reader_no_longer_blocks(self):
+        reader = self.reader('block')
+        self.ch.publish(b'0123456789')
+        reader.detach()
+        self.assertTrue(self.ch.publish(b'abcde', timeout=0))
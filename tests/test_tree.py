@@ -0,0 +1,101 @@
+'''
+cached project file trees and their etags - see app/tree.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from app import tree
+from app.tree import ProjectTree
+
+
+
+def _names(children):
+    return [c['name'] for c in children]
+
+
+
+class ProjectTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        for rel in ('main.py', 'lib/util.py', 'lib/deep/x.txt', '.hidden', '__pycache__/main.cpython-311.pyc'):
+            self.touch(rel)
+        self.tree = ProjectTree(self.src, ignores=['__pycache__', '*.pyc'], languages={'.py': 'python'})
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+
+    def touch(self, rel):
+        path = os.path.join(self.src, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    def age(self, seconds=60):
+        '''make every directory look last changed a while ago, out of the racy window'''
+        past = time.time() - seconds
+        for root, dirs, _ in os.walk(self.src):
+            os.utime(root, (past, past))
+
+    def test_listing(self):
+        children, _ = self.tree.get()
+        self.assertEqual(_names(children), ['lib', 'main.py'])
+        lib = children[0]
+        self.assertEqual((lib['type'], lib['path']), ('folder', 'lib'))
+        self.assertEqual(_names(lib['children']), ['deep', 'util.py'])
+        self.assertEqual(lib['children'][1]['language'], 'python')
+        self.assertEqual(_names(self.tree.children('lib/deep')), ['x.txt'])
+        self.assertEqual(self.tree.children('nope'), [])
+
+    def test_etag_follows_changes(self):
+        _, etag = self.tree.get()
+        self.assertEqual(self.tree.get()[1], etag) # unchanged - the client gets a 304
+        self.touch('lib/deep/new.py')
+        children, etag2 = self.tree.get()
+        self.assertNotEqual(etag2, etag)
+        self.assertIn('new.py', _names(children[0]['children'][0]['children']))
+        os.remove(os.path.join(self.src, 'lib/deep/new.py'))
+        self.assertEqual(self.tree.get()[1], etag) # same tree, same etag
+        self.touch('.another_hidden')
+        self.assertEqual(self.tree.get()[1], etag)
+
+    def test_only_changed_directories_are_listed_again(self):
+        self.age()
+        self.tree.get()
+        listed = []
+        real_list = self.tree._list
+        self.tree._list = lambda node, path, now: (listed.append(os.path.relpath(path, self.src)), real_list(node, path, now))
+        self.tree.get()
+        self.assertEqual(listed, [])
+        self.touch('lib/other.py')
+        self.tree.get()
+        self.assertEqual(listed, ['lib'])
+
+    def test_racy_directory_is_listed_until_its_change_is_old(self):
+        self.tree.get() # just created - every directory is within RACY_NS of its change
+        listed = []
+        real_list = self.tree._list
+        self.tree._list = lambda node, path, now: (listed.append(path), real_list(node, path, now))
+        self.tree.get()
+        self.assertIn(self.src, listed)
+
+    def test_refresh(self):
+        self.age()
+        _, etag = self.tree.get()
+        mtime = os.stat(os.path.join(self.src, 'lib')).st_mtime_ns
+        self.touch('lib/made_by_project.py')
+        os.utime(os.path.join(self.src, 'lib'), ns=(mtime, mtime)) # a change that didn't move the mtime
+        self.assertEqual(self.tree.get()[1], etag)
+        self.tree.refresh('lib')
+        self.assertNotEqual(self.tree.get()[1], etag)
+
+    def test_shared_per_folder(self):
+        self.assertIs(tree.get_tree(self.src), tree.get_tree(self.src))
+        first = tree.get_tree(self.src)
+        tree.drop_tree(self.src)
+        self.assertIsNot(tree.get_tree(self.src), first)
+        tree.drop_tree(self.src)
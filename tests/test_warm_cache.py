@@ -0,0 +1,110 @@
+'''
+project modules kept between warm runs, and what invalidates them - see app/worker.py
+
+run from the repository root: python -m pytest tests   (or python -m unittest discover tests)
+'''
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+from app.worker import _WarmCache, _project_modules
+
+
+
+class WarmCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.p = 'm' + uuid.uuid4().hex[:8] # module name prefix, unique to this test
+        self.src = self.project('proj')
+        self.cache = _WarmCache()
+
+    def tearDown(self):
+        for name in [n for n in sys.modules if n.startswith(self.p)]:
+            del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def project(self, name):
+        src = os.path.realpath(os.path.join(self.root, name))
+        os.makedirs(src)
+        files = {
+            'b': 'X = 1\ndef f():\n    return X\n',
+            'a': f'import {self.p}_b\n', # refers to b by module
+            'd': f'from {self.p}_b import f\n', # refers to b by something defined in it
+            'c': 'Y = 2\n',
+        }
+        for mod, code in files.items():
+            self.write(src, mod, code)
+        return src
+
+    def write(self, src, mod, code):
+        with open(os.path.join(src, f'{self.p}_{mod}.py'), 'w') as f:
+            f.write(code)
+
+    def run_imports(self, src, mods='abcd'):
+        '''import like a run does, then set the project's modules aside like the end of a warm run'''
+        sys.path.insert(0, src)
+        try:
+            loaded = {m: importlib.import_module(f'{self.p}_{m}') for m in mods}
+        finally:
+            sys.path.remove(src)
+        self.cache.set_aside(src, import_time=0.5)
+        return loaded
+
+    def test_unchanged_modules_are_reused(self):
+        first = self.run_imports(self.src)
+        self.assertFalse(any(n.startswith(self.p) for n in sys.modules)) # set aside between runs
+        self.assertEqual(self.cache.restore(self.src), (4, 0.5))
+        for m, mod in first.items():
+            self.assertIs(sys.modules[f'{self.p}_{m}'], mod)
+
+    def test_changed_module_and_its_importers_are_dropped(self):
+        first = self.run_imports(self.src)
+        self.write(self.src, 'b', 'X = 10\ndef f():\n    return X\n')
+        self.assertEqual(self.cache.restore(self.src), (1, 0.5))
+        self.assertIs(sys.modules[f'{self.p}_c'], first['c'])
+        for m in 'abd':
+            self.assertNotIn(f'{self.p}_{m}', sys.modules)
+        self.assertEqual(self.run_imports(self.src)['d'].f(), 10) # imported again from the new source
+
+    def test_touched_but_unchanged_module_is_kept(self):
+        self.run_imports(self.src)
+        path = os.path.join(self.src, f'{self.p}_b.py')
+        later = time.time() + 10
+        os.utime(path, (later, later))
+        self.assertEqual(self.cache.restore(self.src), (4, 0.5))
+
+    def test_deleted_module_is_dropped(self):
+        self.run_imports(self.src)
+        os.remove(os.path.join(self.src, f'{self.p}_c.py'))
+        self.assertEqual(self.cache.restore(self.src), (3, 0.5))
+        self.assertNotIn(f'{self.p}_c', sys.modules)
+
+    def test_least_recently_run_project_is_evicted(self):
+        srcs = [self.src] + [self.project(f'proj{i}') for i in range(_WarmCache.MAX_PROJECTS)]
+        for src in srcs:
+            self.run_imports(src, mods='c') # the same module name in each - the one of each project is kept
+            for name in [n for n in sys.modules if n.startswith(self.p)]:
+                del sys.modules[name]
+        self.assertEqual(self.cache.restore(srcs[0]), (0, None))
+        for src in srcs[1:]:
+            self.assertEqual(self.cache.restore(src), (1, 0.5))
+            self.assertEqual(sys.modules[f'{self.p}_c'].__file__, os.path.join(src, f'{self.p}_c.py'))
+
+    def test_project_modules_match_by_folder(self):
+        sibling = self.project('proj-old') # shares a prefix with src, isn't under it
+        self.write(sibling, 'e', '')
+        sys.path[:0] = [self.src, sibling]
+        try:
+            importlib.import_module(f'{self.p}_c') # found in src
+            importlib.import_module(f'{self.p}_e') # found in sibling
+            self.assertEqual(_project_modules(self.src), [f'{self.p}_c'])
+            self.assertEqual(_project_modules(sibling), [f'{self.p}_e'])
+        finally:
+            sys.path.remove(self.src)
+            sys.path.remove(sibling)
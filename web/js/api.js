@@ -1,7 +1,8 @@
 
 class SS_Project_API {
-    constructor(project) {
+    constructor(project, ssePort) {
         this.project = project
+        this.ssePort = ssePort
     }
 
     getProperties() {
@@ -60,6 +61,10 @@ class SS_Project_API {
         return modFetch(`/project/${this.project}/entry-points`, "GET")
     }
 
+    getCallables() {
+        return modFetch(`/project/${this.project}/callables`, "GET")
+    }
+
     newEntryPoint(file, func, make_default) {
         return modFetch(`/project/${this.project}/entry-point/new`, "POST", {
             file, func, make_default
@@ -86,5 +91,31 @@ class SS_Project_API {
     runAsync(epid, msg_cb) {
         return streamFetch(`/project/${this.project}/run`, "POST", {epid}, msg_cb)
     }
+
+    startRun(epid) {
+        return modFetch(`/project/${this.project}/runs`, "POST", {epid})
+    }
+
+    watchRun(run_id, msg_cb) {
+        // live output of a run, from the start or from wherever it is now. resolves with the final status
+        return new Promise((resolve, reject)=>{
+            if (this.ssePort === "0") {
+                return reject("Live run output is disabled")
+            }
+            const url = `${location.protocol}//${location.hostname}:${this.ssePort}/project/${this.project}/runs/${run_id}/events`
+            const source = new EventSource(url, {withCredentials: true})
+            source.addEventListener("output", (e)=>msg_cb(e.data))
+            source.addEventListener("end", (e)=>{
+                source.close()
+                resolve(JSON.parse(e.data).status)
+            })
+            source.onerror = ()=>{
+                // EventSource reconnects by itself - unless the server refused the request
+                if (source.readyState === EventSource.CLOSED) {
+                    reject("Lost the live run output")
+                }
+            }
+        })
+    }
 }
 
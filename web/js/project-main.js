@@ -44,10 +44,14 @@ const SAVE = () => {
     const editorElem = document.getElementById('editor')
     const path = editorElem.getAttribute('data-path')
     const src = window.editor.getValue()
-    API.saveFile(path, src).then(()=>{
+    API.saveFile(path, src).then(res=>{
         const item = TREE.getItemFromPath(path)
         item.src = src
         TREE.markItemClean(item)
+        if (res && res.diagnostics && res.diagnostics.length) {
+            const d = res.diagnostics[0]
+            AlertModal.open(`${d.type}: ${d.msg} (${d.path}, line ${d.line})`)
+        }
     }).catch(err=>AlertModal.open(err))
 }
 
@@ -57,10 +61,16 @@ const RUN = (epid) => {
     if (!IS_RUNNING) {
         IS_RUNNING = true
         const outputElem = openOutputWindow()
-        API.runAsync(epid, (msg)=>{
+        const show = (msg)=>{
             outputElem.innerText = outputElem.innerText + msg
             outputElem.scrollTop = outputElem.scrollHeight
-        }).then(()=>{
+        }
+        // watched on the server-sent events port, which doesn't hold a server thread per viewer.
+        // streamed from the run request itself if that port is disabled
+        const run = API.ssePort === "0"
+            ? API.runAsync(epid, show)
+            : API.startRun(epid).then(run_id=>API.watchRun(run_id, show))
+        run.catch(err=>AlertModal.open(err)).finally(()=>{
             IS_RUNNING = false
         })
     }
@@ -54,7 +54,7 @@ const displayEntryPoints = (eps, epElem) => {
         }
 
         epElem.innerHTML = epElem.innerHTML + `
-            <button class="gen-btn new-entry-btn" onclick="newEntryPointModal.open()">&plus;</button>`
+            <button class="gen-btn new-entry-btn" onclick="openNewEntryPoint()">&plus;</button>`
     }
 }
 
@@ -104,15 +104,62 @@ const displaySchedule = (sched, schedElem) => {
 }
 
 
+const fmtSeconds = (s) => (s === null || s === undefined) ? "-" : `${s.toFixed(2)}s`
+const fmtBytes = (b) => (b === null || b === undefined) ? "-" : `${(b / (1024 * 1024)).toFixed(1)} MB`
+
+const displayUsage = (usage, usageElem) => {
+    usageElem = usageElem || document.getElementById("usage")
+    if(usageElem) {
+        usageElem.innerHTML = ""
+        const headers = document.createElement("div")
+        headers.classList.add("props-header", "usage-header")
+        headers.innerHTML = `
+            <span>Entry Point Name (last 7 days)</span>
+            <span>Runs</span>
+            <span>Avg Wall</span>
+            <span>Avg CPU</span>
+            <span>Peak Memory</span>
+        `
+        usageElem.appendChild(headers)
+
+        for (const u of usage) {
+            const container = document.createElement("div")
+            container.classList.add("props-row", "usage-row")
+            container.innerHTML = `
+                <span>${u.name}</span>
+                <span>${u.runs}</span>
+                <span>${fmtSeconds(u.avg_wall)}</span>
+                <span title="max ${fmtSeconds(u.max_cpu)}">${fmtSeconds(u.avg_cpu)}</span>
+                <span>${fmtBytes(u.max_rss)}</span>
+            `
+            usageElem.appendChild(container)
+        }
+    }
+}
+
+
 const loadProjectProps = () => {
     API.getProperties().then(props=>{
         // console.log(props)
         displayEntryPoints(props.entry_points)
         displaySchedule(props.schedule)
+        displayUsage(props.usage)
     })
 }
 
 
+const openNewEntryPoint = () => {
+    // suggest the functions that can be entry points - callable without arguments
+    API.getCallables().then(res=>{
+        const fns = res.callables.filter(fn=>fn.required === 0)
+        const files = [...new Set(fns.map(fn=>fn.file))]
+        document.getElementById("callable-files").innerHTML = files.map(f=>`<option value="${f}">`).join('')
+        document.getElementById("callable-funcs").innerHTML = fns.map(fn=>`<option value="${fn.name}">${fn.file}: ${fn.kind} ${fn.name}${fn.signature}</option>`).join('')
+    }).catch(err=>console.log(err))
+    newEntryPointModal.open()
+}
+
+
 const addNewEntryPoint = (btn) => {
     const file = btn.parentElement.querySelector('input[name="file"]').value.trim()
     const func = btn.parentElement.querySelector('input[name="func"]').value.trim()